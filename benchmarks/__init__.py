@@ -0,0 +1,11 @@
+from __future__ import annotations
+
+import os
+
+import django
+
+
+def setup() -> None:
+    """Configure Django with the test project settings unless other settings are given."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+    django.setup()
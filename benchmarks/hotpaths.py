@@ -0,0 +1,167 @@
+"""
+Latency, queries and allocations of the login, signup and verify hot paths, driven through the test client with locmem mail.
+
+    python -m benchmarks.hotpaths [--number 200] [--json results.json] [--compare previous.json]
+
+Runs against a fresh test database of the configured settings (DJANGO_SETTINGS_MODULE, tests.settings by default),
+so the same command works with SQLite and PostgreSQL. Rate limits are disabled, every request uses its own E-mail.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import statistics
+import time
+import tracemalloc
+from itertools import count
+from typing import Callable
+from urllib.parse import unquote_plus
+
+from benchmarks import setup
+
+setup()
+
+from django.contrib.auth import get_user_model  # NOQA: E402
+from django.db import connection  # NOQA: E402
+from django.http import HttpRequest  # NOQA: E402
+from django.test import Client  # NOQA: E402
+from django.test.utils import CaptureQueriesContext, setup_test_environment  # NOQA: E402
+from django.urls import reverse  # NOQA: E402
+
+from magiclinks import ratelimit  # NOQA: E402
+from magiclinks.backends import MagicLinksBackend  # NOQA: E402
+from magiclinks.services import create_magiclink  # NOQA: E402
+
+Operation = Callable[[], object]
+# Every prepared batch of requests gets its own E-mails
+batches = count()
+
+
+def create_users(prefix: str, number: int) -> list[str]:
+    User = get_user_model()
+    batch = next(batches)
+    emails = ['{prefix}{batch}-{n}@example.com'.format(prefix=prefix, batch=batch, n=n) for n in range(number)]
+    User.objects.bulk_create([User(username=email, email=email) for email in emails])
+    return emails
+
+
+def issue_links(prefix: str, number: int) -> list[str]:
+    return [create_magiclink(email=email, domain='testserver', url_name='magiclinks:login_verify', next_url='', limit_seconds=0)
+            for email in create_users(prefix, number)]
+
+
+def expect(response, status: int):
+    assert response.status_code == status, response.status_code
+    return response
+
+
+def prepare_login(number: int) -> list[Operation]:
+    client = Client()
+    url = reverse('magiclinks:login')
+    return [lambda email=email: expect(client.post(url, {'email': email}), 302) for email in create_users('login', number)]
+
+
+def prepare_signup(number: int) -> list[Operation]:
+    client = Client()
+    url = reverse('magiclinks:signup')
+    batch = next(batches)
+    return [lambda n=n: expect(client.post(url, {'email': 'signup{batch}-{n}@example.com'.format(batch=batch, n=n)}), 302) for n in range(number)]
+
+
+def prepare_verify(number: int) -> list[Operation]:
+    # Verified clients are logged in, so each request needs its own one
+    return [lambda client=Client(), link=link: expect(client.get(link.split('testserver', 1)[1]), 302) for link in issue_links('verify', number)]
+
+
+def prepare_authenticate(number: int) -> list[Operation]:
+    backend = MagicLinksBackend()
+    tokens = [unquote_plus(link.split('token=', 1)[1]) for link in issue_links('auth', number)]
+    return [lambda token=token: backend.authenticate(HttpRequest(), token=token) for token in tokens]
+
+
+SCENARIOS: dict[str, Callable[[int], list[Operation]]] = {
+    'login': prepare_login,
+    'signup': prepare_signup,
+    'verify': prepare_verify,
+    'authenticate': prepare_authenticate,
+}
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def run(name: str, number: int, alloc_number: int) -> dict[str, float]:
+    prepare = SCENARIOS[name]
+    for operation in prepare(5):
+        operation()
+
+    timings = []
+    queries = []
+    for operation in prepare(number):
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            operation()
+            timings.append(time.perf_counter() - started)
+        queries.append(len(context.captured_queries))
+
+    allocations = []
+    operations = prepare(alloc_number)
+    tracemalloc.start()
+    for operation in operations:
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        operation()
+        _, peak = tracemalloc.get_traced_memory()
+        allocations.append(peak - before)
+    tracemalloc.stop()
+
+    return {
+        'ops': number,
+        'mean_ms': statistics.mean(timings) * 1e3,
+        'p50_ms': percentile(timings, 0.5) * 1e3,
+        'p95_ms': percentile(timings, 0.95) * 1e3,
+        'queries': statistics.mean(queries),
+        'peak_kib': statistics.mean(allocations) / 1024,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=200, help='Timed requests per scenario.')
+    parser.add_argument('--alloc-number', type=int, default=50, help='Requests per scenario traced for allocations.')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), action='append', help='Run only given scenarios.')
+    parser.add_argument('--json', help='Also write results to this file, e.g. to compare releases.')
+    parser.add_argument('--compare', help='Print changes against results written by --json earlier.')
+    args = parser.parse_args()
+
+    setup_test_environment()
+    ratelimit.RATELIMITS = {}
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        results = {}
+        print('{:<14}{:>6}{:>10}{:>10}{:>10}{:>10}{:>12}'.format('scenario', 'ops', 'mean ms', 'p50 ms', 'p95 ms', 'queries', 'peak KiB'))
+        for name in args.scenario or SCENARIOS:
+            results[name] = result = run(name, args.number, args.alloc_number)
+            print('{name:<14}{ops:>6}{mean_ms:>10.2f}{p50_ms:>10.2f}{p95_ms:>10.2f}{queries:>10.1f}{peak_kib:>12.1f}'.format(name=name, **result))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if args.json:
+        with open(args.json, 'w') as output:
+            json.dump({'database': connection.vendor, 'results': results}, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as previous_file:
+            previous = json.load(previous_file)['results']
+        for name, result in results.items():
+            if name not in previous:
+                continue
+            changes = ['{key} {change:+.0%}'.format(key=key, change=result[key] / previous[name][key] - 1)
+                       for key in ('p50_ms', 'p95_ms', 'queries', 'peak_kib') if previous[name][key]]
+            print('{name:<14}{changes}'.format(name=name, changes=', '.join(changes)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+"""
+Concurrent login and verify flows against a local SMTP sink: throughput, latency percentiles and error classes.
+
+    python -m benchmarks.load [--flows 2000] [--concurrency 32] [--users 500]
+    python -m benchmarks.load --url http://127.0.0.1:8000 --smtp-port 1025 [--flow signup]
+
+Every flow posts the login form, waits for the e-mail to reach the SMTP sink and follows the magic link. There are
+fewer users than flows, so the same E-mails race each other through the rate limit and the unique email constraint.
+
+By default the app runs in-process (test client per flow) on a fresh test database of the configured settings,
+with rate limits disabled. SQLite serializes writers, use PostgreSQL settings (DJANGO_SETTINGS_MODULE) for
+realistic numbers. With --url requests go over HTTP to a running server, which must send e-mail to the sink started
+on --smtp-port and know users load<n>@example.com (run once with --flow signup to create them).
+"""
+from __future__ import annotations
+
+import argparse
+import email
+import http.cookiejar
+import queue
+import re
+import statistics
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from benchmarks import setup
+
+setup()
+
+from django.contrib.auth import get_user_model  # NOQA: E402
+from django.db import close_old_connections, connection  # NOQA: E402
+from django.test import Client  # NOQA: E402
+from django.test.utils import override_settings, setup_test_environment  # NOQA: E402
+
+from magiclinks import ratelimit  # NOQA: E402
+from tests.smtp import SMTPSink  # NOQA: E402
+
+LINK_RE = re.compile(r'https?://[^/\s]+(/\S*token=\S+)')
+THROTTLED = 'Too many magic login requests'
+
+
+class Mailbox:
+    """Magic links delivered to the sink, by recipient."""
+
+    def __init__(self) -> None:
+        self._links: defaultdict[str, queue.Queue[str]] = defaultdict(queue.Queue)
+        self._lock = threading.Lock()
+
+    def deliver(self, raw: str) -> None:
+        message = email.message_from_string(raw)
+        for part in message.walk():
+            if part.get_content_type() == 'text/plain':
+                match = LINK_RE.search(part.get_payload(decode=True).decode())
+                if match:
+                    self.inbox(message['To']).put(match.group(1))
+                return
+
+    def inbox(self, recipient: str) -> queue.Queue[str]:
+        with self._lock:
+            return self._links[recipient.lower()]
+
+
+class Response:
+    def __init__(self, status: int, body: str) -> None:
+        self.status = status
+        self.body = body
+
+
+class InProcessSession:
+    def __init__(self) -> None:
+        self.client = Client()
+
+    def get(self, path: str) -> Response:
+        response = self.client.get(path)
+        return Response(response.status_code, response.content.decode())
+
+    def post(self, path: str, data: dict[str, str]) -> Response:
+        response = self.client.post(path, data)
+        return Response(response.status_code, response.content.decode())
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpSession:
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url
+        self.cookies = http.cookiejar.CookieJar()
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(self.cookies), NoRedirect)
+
+    def get(self, path: str) -> Response:
+        return self._open(urllib.request.Request(self.base_url + path))
+
+    def post(self, path: str, data: dict[str, str]) -> Response:
+        # Get CSRF cookie and token first, like a browser showing the form
+        self.get(path)
+        token = next((cookie.value for cookie in self.cookies if cookie.name == 'csrftoken'), '')
+        body = urllib.parse.urlencode(dict(data, csrfmiddlewaretoken=token)).encode()
+        return self._open(urllib.request.Request(self.base_url + path, data=body, headers={'Referer': self.base_url + path}))
+
+    def _open(self, request: urllib.request.Request) -> Response:
+        try:
+            with self.opener.open(request, timeout=30) as response:
+                return Response(response.status, response.read().decode())
+        except urllib.error.HTTPError as e:
+            return Response(e.code, e.read().decode())
+
+
+class LoadTest:
+    def __init__(self, *, flow: str, users: int, base_url: Optional[str], mail_timeout: float) -> None:
+        self.flow = flow
+        self.users = users
+        self.base_url = base_url
+        self.mail_timeout = mail_timeout
+        self.mailbox = Mailbox()
+        self.latencies: defaultdict[str, list[float]] = defaultdict(list)
+        self.outcomes: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def session(self):
+        return HttpSession(self.base_url) if self.base_url else InProcessSession()
+
+    def run_flow(self, number: int) -> None:
+        recipient = 'load{n}@example.com'.format(n=number % self.users)
+        try:
+            outcome = self.login_and_verify(recipient)
+        except Exception as e:
+            # e.g. IntegrityError: UNIQUE constraint failed, OperationalError: database table is locked
+            outcome = 'exception:{name}: {message}'.format(name=type(e).__name__, message=str(e)[:60])
+        finally:
+            if not self.base_url:
+                close_old_connections()
+        with self._lock:
+            self.outcomes[outcome] += 1
+
+    def login_and_verify(self, recipient: str) -> str:
+        session = self.session()
+        path = '/accounts/{flow}/'.format(flow=self.flow)
+        response = self.timed('login', session.post, path, {'email': recipient})
+        if response.status != 302:
+            if THROTTLED in response.body:
+                return 'throttled'
+            return '{flow}:{status}'.format(flow=self.flow, status=response.status)
+
+        try:
+            link = self.mailbox.inbox(recipient).get(timeout=self.mail_timeout)
+        except queue.Empty:
+            return 'mail_timeout'
+
+        response = self.timed('verify', session.get, link)
+        if response.status != 302:
+            return 'verify:{status}'.format(status=response.status)
+        # Failed verification redirects back to the login page
+        return 'ok' if session.get('/accounts/login/').status == 302 else 'verify_failed'
+
+    def timed(self, name: str, func, *args) -> Response:
+        started = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.latencies[name].append(elapsed)
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def report(test: LoadTest, flows: int, elapsed: float) -> None:
+    print('{flows} flows in {elapsed:.2f}s: {rate:.1f} flows/s, {ok} logged in'.format(
+        flows=flows, elapsed=elapsed, rate=flows / elapsed, ok=test.outcomes['ok']))
+    for name, values in sorted(test.latencies.items()):
+        print('{name:<8} n={n:<6} mean={mean:7.1f}ms p50={p50:7.1f}ms p99={p99:7.1f}ms'.format(
+            name=name, n=len(values), mean=statistics.mean(values) * 1e3, p50=percentile(values, 0.5) * 1e3, p99=percentile(values, 0.99) * 1e3))
+    for outcome, number in test.outcomes.most_common():
+        print('{outcome:<80} {number}'.format(outcome=outcome, number=number))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--flows', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--users', type=int, default=500, help='Distinct E-mails, fewer than --flows makes flows race.')
+    parser.add_argument('--flow', choices=['login', 'signup'], default='login')
+    parser.add_argument('--url', help='Base URL of a running server instead of the in-process app.')
+    parser.add_argument('--smtp-port', type=int, default=0, help='Port of the SMTP sink, the server must send e-mail there.')
+    parser.add_argument('--mail-timeout', type=float, default=10.0)
+    parser.add_argument('--ratelimit', action='store_true', help='Keep MAGICLINKS_RATELIMITS of the in-process app.')
+    args = parser.parse_args()
+
+    test = LoadTest(flow=args.flow, users=args.users, base_url=args.url, mail_timeout=args.mail_timeout)
+    sink = SMTPSink(port=args.smtp_port, on_message=test.mailbox.deliver).start()
+    print('SMTP sink on {host}:{port}'.format(host=sink.host, port=sink.port))
+
+    old_name = None
+    if not args.url:
+        setup_test_environment()
+        if not args.ratelimit:
+            ratelimit.RATELIMITS = {}
+        old_name = connection.creation.create_test_db(verbosity=0)
+        if args.flow == 'login':
+            User = get_user_model()
+            User.objects.bulk_create([User(username='load{n}@example.com'.format(n=n), email='load{n}@example.com'.format(n=n))
+                                      for n in range(args.users)])
+    try:
+        with override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST=sink.host, EMAIL_PORT=sink.port):
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                list(executor.map(test.run_flow, range(args.flows)))
+            elapsed = time.perf_counter() - started
+    finally:
+        sink.stop()
+        if old_name is not None:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    report(test, args.flows, elapsed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Per-message cost of rendering the magic link e-mail, before and after the compiled template cache.
+
+    python -m benchmarks.render [--number 2000]
+"""
+from __future__ import annotations
+
+import argparse
+import timeit
+
+from benchmarks import setup
+
+setup()
+
+from django.conf import settings  # NOQA: E402
+from django.contrib.auth import get_user_model  # NOQA: E402
+from django.core.mail import EmailMultiAlternatives  # NOQA: E402
+from django.template.loader import render_to_string  # NOQA: E402
+
+from magiclinks.mail import render_magiclink_email  # NOQA: E402
+
+EMAIL = 'test@example.com'
+MAGICLINK = 'https://127.0.0.1:8000/accounts/login/verify/?token=abc'
+SUBJECT = 'Your login magic link'
+TEMPLATES = ('magiclinks/login_email.txt', 'magiclinks/login_email.html')
+
+
+def render_legacy(user) -> EmailMultiAlternatives:
+    """Previous implementation: template lookup and context on every call, message built the way send_mail does it."""
+    context = {
+        'subject': SUBJECT,
+        'user': user,
+        'magiclink': MAGICLINK,
+        'style': {
+            'logo_url': '',
+            'background_color': '#ffffff',
+            'main_text_color': '#000000',
+            'button_background_color': '#0078be',
+            'button_text_color': '#ffffff',
+        },
+    }
+    plain = render_to_string(TEMPLATES[0], context)
+    html = render_to_string(TEMPLATES[1], context)
+    message = EmailMultiAlternatives(SUBJECT, plain, settings.DEFAULT_FROM_EMAIL, [EMAIL])
+    message.attach_alternative(html, 'text/html')
+    return message
+
+
+def render_cached(user) -> EmailMultiAlternatives:
+    return render_magiclink_email(email=EMAIL, user=user, magiclink=MAGICLINK, subject=SUBJECT, email_templates=TEMPLATES)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    user = get_user_model()(username=EMAIL, email=EMAIL)
+    results = {}
+    for name, func in (('before', render_legacy), ('after', render_cached)):
+        func(user)
+        best = min(timeit.repeat(lambda: func(user), number=args.number, repeat=args.repeat))
+        results[name] = best / args.number * 1e6
+        print('{name:>6}: {usec:8.1f} us/message'.format(name=name, usec=results[name]))
+    print('speedup: {ratio:.2f}x'.format(ratio=results['before'] / results['after']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Magic link verification under asyncio: django.contrib.auth.aauthenticate() (sync backend in a worker thread)
+against magiclinks.backends.aauthenticate() (native MagicLinksBackend.aauthenticate()).
+
+    python -m benchmarks.verify [--number 500] [--storage model|cache] [--concurrency 1]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import time
+from urllib.parse import unquote_plus
+
+from benchmarks import setup
+
+setup()
+
+from asgiref.sync import async_to_sync  # NOQA: E402
+from django.contrib import auth  # NOQA: E402
+from django.contrib.auth import get_user_model  # NOQA: E402
+from django.db import connection  # NOQA: E402
+from django.test.utils import override_settings, setup_test_environment  # NOQA: E402
+
+from magiclinks import backends, storage  # NOQA: E402
+from magiclinks.services import create_magiclink  # NOQA: E402
+
+STORAGES = {'model': 'magiclinks.storage.ModelStorage', 'cache': 'magiclinks.storage.CacheStorage'}
+# Default locmem cache culls at 300 entries, which would evict unused links
+CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'OPTIONS': {'MAX_ENTRIES': 1_000_000}}}
+
+
+def issue_tokens(prefix: str, number: int) -> list[str]:
+    User = get_user_model()
+    emails = ['{prefix}{n}@example.com'.format(prefix=prefix, n=n) for n in range(number)]
+    User.objects.bulk_create([User(username=email, email=email) for email in emails])
+    return [unquote_plus(create_magiclink(email=email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='',
+                                          limit_seconds=0).split('=')[1]) for email in emails]
+
+
+async def verify_all(aauthenticate, tokens: list[str], concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def verify(token: str) -> None:
+        async with semaphore:
+            assert await aauthenticate(None, token=token) is not None
+
+    started = time.perf_counter()
+    await asyncio.gather(*(verify(token) for token in tokens))
+    return time.perf_counter() - started
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=500)
+    parser.add_argument('--storage', choices=sorted(STORAGES), default='model')
+    parser.add_argument('--concurrency', type=int, default=1)
+    args = parser.parse_args()
+
+    setup_test_environment()
+    old_name = connection.creation.create_test_db(verbosity=0)
+    try:
+        with override_settings(CACHES=CACHES):
+            storage.STORAGE = STORAGES[args.storage]
+            storage.get_storage.cache_clear()
+            results = {}
+            for name, func in (('before', auth.aauthenticate), ('after', backends.aauthenticate)):
+                tokens = issue_tokens(name, args.number)
+                elapsed = async_to_sync(verify_all)(func, tokens, args.concurrency)
+                results[name] = elapsed / args.number * 1e6
+                print('{name:>6}: {usec:8.1f} us/verify'.format(name=name, usec=results[name]))
+            print('speedup: {ratio:.2f}x'.format(ratio=results['before'] / results['after']))
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,3 +6,8 @@ from django.apps import AppConfig
 class MagicLinksConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'magiclinks'
+
+    def ready(self) -> None:
+        from . import checks  # NOQA: F401
+        from .sites import connect_signals
+        connect_signals()
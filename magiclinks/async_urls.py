@@ -0,0 +1,21 @@
+from __future__ import annotations
+
+from django.urls import path
+
+from .async_views import AsyncLoginVerifyView, AsyncLoginView, AsyncSignupView
+from .settings import METRICS_VIEW
+from .views import LoginSentView, LogoutView, MetricsView
+
+# Async versions of magiclinks.urls, they need Django 5.0 or newer (alogin, request.auser)
+app_name = "magiclinks"
+
+urlpatterns = [
+    path('login/', AsyncLoginView.as_view(), name='login'),
+    path('login/sent/', LoginSentView.as_view(), name='login_sent'),
+    path('signup/', AsyncSignupView.as_view(), name='signup'),
+    path('login/verify/', AsyncLoginVerifyView.as_view(), name='login_verify'),
+    path('logout/', LogoutView.as_view(), name='logout'),
+]
+
+if METRICS_VIEW:
+    urlpatterns.append(path('metrics/', MetricsView.as_view(), name='metrics'))
@@ -0,0 +1,151 @@
+from __future__ import annotations
+
+import logging
+from typing import Awaitable, Callable, Protocol, cast
+from urllib.parse import unquote_plus
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import messages
+from django.contrib.auth import alogin, get_user_model
+from django.contrib.auth.views import redirect_to_login
+from django.http import HttpRequest, HttpResponse, HttpResponseBase, HttpResponseRedirect
+from django.views import View
+from django.views.decorators.cache import never_cache
+from django.views.decorators.csrf import csrf_protect
+from django.views.decorators.debug import sensitive_post_parameters
+
+from .backends import aauthenticate, get_magiclink_data
+from .exceptions import MagicLinkError
+from .metrics import timed
+from .services import acreate_magiclink, asend_magiclink, create_user
+from .settings import EMAIL_DISPATCH, SIGNUP_LOGIN_REDIRECT_URL
+from .sites import aget_site_domain
+from .utils import get_url_path
+from .views import IssueMagicLinkMixin, LoginVerifyView, LoginView, SignupView
+
+User = get_user_model()
+logger = logging.getLogger(__name__)
+
+
+class ViewFunction(Protocol):
+    def __call__(self, request: HttpRequest, *args: object, **kwargs: object) -> HttpResponseBase: ...
+
+
+class AsyncViewMixin(View):
+    """
+    Serve the view natively under ASGI. Requires Django 5.0+.
+    Parent views decorate dispatch with sync-only user_passes_test, so anonymous check is done here
+    and the remaining decorators, which support async views, are applied in as_view().
+
+    Django awaits what handlers and dispatch() of async views return, the type stubs only describe sync views.
+    """
+    view_decorators: tuple[Callable[[ViewFunction], ViewFunction], ...] = (never_cache, csrf_protect, sensitive_post_parameters())
+
+    @classmethod
+    def as_view(cls, **initkwargs: object) -> ViewFunction:
+        view: ViewFunction = super().as_view(**initkwargs)
+        for decorator in reversed(cls.view_decorators):
+            view = decorator(view)
+        return view
+
+    def dispatch(self, request: HttpRequest, *args: object, **kwargs: object) -> HttpResponseBase:
+        return cast(HttpResponseBase, self.adispatch(request, *args, **kwargs))
+
+    async def adispatch(self, request: HttpRequest, *args: object, **kwargs: object) -> HttpResponseBase:
+        user = await request.auser()
+        if user.is_authenticated:
+            return redirect_to_login(request.get_full_path(), '/')
+        return await cast(Awaitable[HttpResponseBase], View.dispatch(self, request, *args, **kwargs))
+
+
+class AsyncIssueMagicLinkMixin(IssueMagicLinkMixin):
+    """Async version of IssueMagicLinkMixin."""
+
+    async def aissue_magiclink(self, request, *, email: str, next_url: str, user=None) -> None:
+        if EMAIL_DISPATCH == 'outbox':
+            # Transactions are sync-only, the outbox e-mail must be stored in the same transaction as the magiclink
+            await sync_to_async(self.issue_magiclink)(request, email=email, next_url=next_url, user=user)
+            return
+
+        magiclink = await acreate_magiclink(email=email, domain=await aget_site_domain(request), url_name=self.login_verify_url_name, next_url=next_url,
+                                            limit_seconds=self.limit_seconds)
+        await asend_magiclink(email=email, magiclink=magiclink, subject=self.subject, email_templates=self.email_templates, user=user)
+
+
+class AsyncLoginView(AsyncViewMixin, AsyncIssueMagicLinkMixin, LoginView):
+    async def get(self, request: HttpRequest, *args: object, **kwargs: object) -> HttpResponse:  # type: ignore[override]
+        return super().get(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+        form = self.form(request.POST, request=request)
+        # Form validation looks the user up with the sync ORM
+        with timed('form_validation'):
+            valid = await sync_to_async(form.is_valid)()
+        if not valid:
+            context['login_form'] = form
+            return self.render_to_response(context)
+
+        email = form.cleaned_data['email']
+        next_url = self.get_next_url(request, settings.LOGIN_REDIRECT_URL)
+
+        try:
+            await self.aissue_magiclink(request, email=email, next_url=next_url, user=form.cleaned_data.get('user'))
+        except MagicLinkError as e:
+            form.add_error('email', str(e))
+            context['login_form'] = form
+            return self.render_to_response(context)
+
+        return self.get_success_response(request)
+
+
+class AsyncSignupView(AsyncViewMixin, AsyncIssueMagicLinkMixin, SignupView):
+    async def get(self, request: HttpRequest, *args: object, **kwargs: object) -> HttpResponse:  # type: ignore[override]
+        return super().get(request, *args, **kwargs)
+
+    async def post(self, request, *args, **kwargs):
+        context = self.get_context_data(**kwargs)
+
+        form = self.form(request.POST, request=request)
+        with timed('form_validation'):
+            valid = await sync_to_async(form.is_valid)()
+        if not valid:
+            context['signup_form'] = form
+            return self.render_to_response(context)
+
+        email = form.cleaned_data['email']
+
+        user = await sync_to_async(create_user)(email=email)
+
+        next_url = self.get_next_url(request, SIGNUP_LOGIN_REDIRECT_URL)
+        await self.aissue_magiclink(request, email=email, next_url=next_url, user=user if isinstance(user, User) else None)
+
+        return self.get_success_response(request)
+
+
+class AsyncLoginVerifyView(AsyncViewMixin, LoginVerifyView):
+    """
+    Link is consumed and the user is looked up with the async ORM.
+    Only writing the session in alogin() still runs in a worker thread.
+    """
+    view_decorators = (never_cache,)
+
+    async def get(self, request, *args, **kwargs):
+        signed_token: str = request.GET.get('token', '')
+        if not signed_token:
+            messages.error(request, self.error_message, fail_silently=True)
+            return HttpResponseRedirect(get_url_path(settings.LOGIN_URL))
+
+        signed_token = unquote_plus(signed_token)
+        user = await aauthenticate(request, token=signed_token, expiry_seconds=self.expiry_seconds)
+        if not user:
+            messages.error(request, self.error_message, fail_silently=True)
+            return HttpResponseRedirect(get_url_path(settings.LOGIN_URL))
+
+        await alogin(request, user)
+        logger.info(f'Login successful for {user}')
+
+        next_url = get_magiclink_data(user)['next']
+
+        return HttpResponseRedirect(next_url)
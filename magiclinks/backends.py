@@ -1,45 +1,167 @@
 from __future__ import annotations
 
+import inspect
 import logging
+import re
 from typing import Optional
 
-from django.contrib.auth import get_user_model
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth import get_user_model, load_backend
 from django.contrib.auth.backends import ModelBackend
+from django.contrib.auth.base_user import AbstractBaseUser
+from django.contrib.auth.signals import user_login_failed
 from django.core import signing
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
 from django.http import HttpRequest
+from django.views.debug import SafeExceptionReporterFilter
+from django.views.decorators.debug import sensitive_variables
 
-from .models import MagicLink
-from .services import delete_magiclink
-from .settings import REGISTRATION_SALT
+from .metrics import increment, timed
+from .services import aconsume_magiclink, aconsume_token, consume_magiclink, consume_token
+from .settings import EXPIRY_SECONDS, REGISTRATION_SALT
 
 User = get_user_model()
 log = logging.getLogger(__name__)
+# Masks sensitive credentials like the token before they are passed to user_login_failed receivers
+_reporter_filter = SafeExceptionReporterFilter()
+
+# Opaque tokens are secrets.token_urlsafe(16): 22 URL-safe base64 characters. Anything else must be a signed token
+OPAQUE_TOKEN = re.compile(r'[A-Za-z0-9_-]{22}')
+
+
+def decode_token(token: str, *, expiry_seconds: int) -> Optional[dict[str, str]]:
+    """Return data of signed token, or None if it is invalid or expired. Opaque tokens are stored server side, so there is nothing to decode."""
+    try:
+        with timed('decode_token'):
+            return signing.loads(token, salt=REGISTRATION_SALT, max_age=expiry_seconds)
+    except signing.SignatureExpired:
+        increment('verify_failed', reason='expired')
+        return None
+    except signing.BadSignature:
+        increment('verify_failed', reason='bad_signature')
+        return None
+
+
+def set_magiclink_data(user: AbstractBaseUser, data: dict[str, str]) -> None:
+    """Keep data of the consumed token on authenticated user, so views do not need to verify it again."""
+    setattr(user, 'magiclink_data', data)
+
+
+def get_magiclink_data(user: AbstractBaseUser) -> dict[str, str]:
+    """Return data of the token user was authenticated with by MagicLinksBackend."""
+    data: dict[str, str] = getattr(user, 'magiclink_data')
+    return data
 
 
 class MagicLinksBackend(ModelBackend):
     def authenticate(self, request: Optional[HttpRequest], username: Optional[str] = None, password: Optional[str] = None, token: str = '',
-                     expiry_seconds: int = 900, **kwargs):
+                     expiry_seconds: int = EXPIRY_SECONDS, **kwargs):
         if not token:
             return
 
-        try:
-            token_data: dict[str, str] = signing.loads(token, salt=REGISTRATION_SALT, max_age=expiry_seconds)
-        except signing.SignatureExpired:
-            return
-        except signing.BadSignature:
-            return
-        else:
-            pk: str = token_data['pk']
-            email: str = token_data['email']
+        token_data: Optional[dict[str, str]] = None
+        # Only tokens shaped like opaque ones are looked up in storage, junk fails the signature check without a query
+        opaque = OPAQUE_TOKEN.fullmatch(token) is not None
+        if not opaque:
+            token_data = decode_token(token, expiry_seconds=expiry_seconds)
+            if token_data is None:
+                return
+
+        with transaction.atomic():
+            with timed('consume'):
+                if token_data is None:
+                    token_data = consume_token(token=token, max_age=expiry_seconds)
+                elif not consume_magiclink(pk=token_data['pk']):
+                    token_data = None
+            if token_data is None:
+                # Opaque tokens which are unknown, expired or already used look the same
+                increment('verify_failed', reason='not_found' if opaque else 'already_used')
+                return
+            increment('consumed')
+
+            try:
+                with timed('fetch_user'):
+                    user = User._default_manager.get(email=token_data['email'])
+            except User.DoesNotExist:
+                increment('verify_failed', reason='unknown_user')
+                return
 
-        if not MagicLink.objects.filter(pk=pk).exists():
+        if not self.user_can_authenticate(user):
+            increment('verify_failed', reason='inactive_user')
+            return None
+
+        set_magiclink_data(user, token_data)
+        return user
+
+    async def aauthenticate(self, request: Optional[HttpRequest], username: Optional[str] = None, password: Optional[str] = None, token: str = '',
+                            expiry_seconds: int = EXPIRY_SECONDS, **kwargs):
+        """
+        Async version of authenticate(). Consuming the link is a single statement,
+        so it runs outside of a transaction (they are not available in async code).
+        """
+        if not token:
             return
 
-        delete_magiclink(pk=pk)
+        token_data: Optional[dict[str, str]] = None
+        opaque = OPAQUE_TOKEN.fullmatch(token) is not None
+        if not opaque:
+            token_data = decode_token(token, expiry_seconds=expiry_seconds)
+            if token_data is None:
+                return
+
+        with timed('consume'):
+            if token_data is None:
+                token_data = await aconsume_token(token=token, max_age=expiry_seconds)
+            elif not await aconsume_magiclink(pk=token_data['pk']):
+                token_data = None
+        if token_data is None:
+            increment('verify_failed', reason='not_found' if opaque else 'already_used')
+            return
+        increment('consumed')
 
         try:
-            user = User._default_manager.get(email=email)
+            with timed('fetch_user'):
+                user = await User._default_manager.aget(email=token_data['email'])
         except User.DoesNotExist:
+            increment('verify_failed', reason='unknown_user')
             return
 
-        return user if self.user_can_authenticate(user) else None
+        if not self.user_can_authenticate(user):
+            increment('verify_failed', reason='inactive_user')
+            return None
+
+        set_magiclink_data(user, token_data)
+        return user
+
+
+@sensitive_variables('credentials')
+async def aauthenticate(request: Optional[HttpRequest] = None, **credentials):
+    """
+    Like django.contrib.auth.aauthenticate(), but backends which implement aauthenticate() are awaited directly
+    instead of running authenticate() of every backend in a worker thread. Needs Django 5.0+.
+    """
+    for backend_path in settings.AUTHENTICATION_BACKENDS:
+        backend = load_backend(backend_path)
+        try:
+            inspect.signature(backend.authenticate).bind(request, **credentials)
+        except TypeError:
+            # This backend doesn't accept these credentials as arguments
+            continue
+        try:
+            if inspect.iscoroutinefunction(getattr(backend, 'aauthenticate', None)):
+                user = await backend.aauthenticate(request, **credentials)
+            else:
+                user = await sync_to_async(backend.authenticate)(request, **credentials)
+        except PermissionDenied:
+            break
+        if user is None:
+            continue
+        user.backend = backend_path
+        return user
+
+    # The credentials supplied are invalid to all backends, fire signal
+    cleansed = {key: _reporter_filter.cleanse_setting(key, value) for key, value in credentials.items()}
+    await user_login_failed.asend(sender=__name__, credentials=cleansed, request=request)
+    return None
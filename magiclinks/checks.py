@@ -0,0 +1,30 @@
+from __future__ import annotations
+
+from django.core.checks import Error, register
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .metrics import CacheMetricsSink
+from .settings import CREATE_USER_CALLABLE, CREATE_USERS_CALLABLE, METRICS_SINK, METRICS_VIEW
+from .utils import load_callable
+
+
+@register()
+def check_create_user_callables(app_configs, **kwargs) -> list[Error]:
+    errors = []
+    for setting, path in (('MAGICLINKS_CREATE_USER_CALLABLE', CREATE_USER_CALLABLE), ('MAGICLINKS_CREATE_USERS_CALLABLE', CREATE_USERS_CALLABLE)):
+        if not path:
+            continue
+        try:
+            load_callable(path)
+        except ImproperlyConfigured as e:
+            errors.append(Error(str(e), hint='Set {setting} to "module:function".'.format(setting=setting), id='magiclinks.E001'))
+    return errors
+
+
+@register()
+def check_metrics_sink(app_configs, **kwargs) -> list[Error]:
+    if not METRICS_VIEW or issubclass(import_string(METRICS_SINK), CacheMetricsSink):
+        return []
+    return [Error('MAGICLINKS_METRICS_VIEW needs a sink keeping counters.',
+                  hint='Set MAGICLINKS_METRICS_SINK to "magiclinks.metrics.CacheMetricsSink" or its subclass.', id='magiclinks.E002')]
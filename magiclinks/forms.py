@@ -1,21 +1,46 @@
 from __future__ import annotations
 
+from typing import Optional
+
 from django import forms
 from django.contrib.auth import get_user_model
+from django.http import HttpRequest
 from django_registration.validators import HTML5EmailValidator, validate_confusables_email
 
+from .metrics import timed
+from .ratelimit import is_ratelimited
+
 User = get_user_model()
 
 
-class LoginForm(forms.Form):
+class RateLimitedForm(forms.Form):
+    """Reject requests over MAGICLINKS_RATELIMITS quotas before the user lookup."""
+
+    def __init__(self, *args, request: Optional[HttpRequest] = None, **kwargs) -> None:
+        self.request = request
+        super().__init__(*args, **kwargs)
+
+    def check_ratelimit(self, email: str) -> None:
+        if self.request is None:
+            return
+        with timed('ratelimit'):
+            ratelimited = is_ratelimited(self.request, email=email)
+        if ratelimited:
+            raise forms.ValidationError('Too many magic login requests')
+
+
+class LoginForm(RateLimitedForm):
     email = forms.EmailField(widget=forms.EmailInput(attrs={'autofocus': 'autofocus', 'placeholder': 'Enter your email'}))
 
     def clean_email(self) -> str:
         email = self.cleaned_data['email'].lower()
-        HTML5EmailValidator()(email)
-        validate_confusables_email(email)
+        with timed('validate_email'):
+            HTML5EmailValidator()(email)
+            validate_confusables_email(email)
+        self.check_ratelimit(email)
         try:
-            user = User.objects.get(email=email)
+            with timed('user_lookup'):
+                user = User.objects.get(email=email)
         except User.DoesNotExist:
             error = 'We could not find a user with that email address'
             raise forms.ValidationError(error)
@@ -23,18 +48,23 @@ class LoginForm(forms.Form):
             if not user.is_active:
                 raise forms.ValidationError('This user has been deactivated')
 
+        # Keep the user, so sending the magiclink does not query it again
+        self.cleaned_data['user'] = user
         return email
 
 
-class SignupForm(forms.Form):
+class SignupForm(RateLimitedForm):
     email = forms.EmailField(widget=forms.EmailInput(attrs={'autofocus': 'autofocus', 'placeholder': 'Enter your email'}))
 
     def clean_email(self) -> str:
         email = self.cleaned_data['email'].lower()
-        HTML5EmailValidator()(email)
-        validate_confusables_email(email)
+        with timed('validate_email'):
+            HTML5EmailValidator()(email)
+            validate_confusables_email(email)
+        self.check_ratelimit(email)
         try:
-            user = User.objects.get(email=email)
+            with timed('user_lookup'):
+                user = User.objects.get(email=email)
         except User.DoesNotExist:
             return email
         else:
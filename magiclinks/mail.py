@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import asyncio
+import atexit
+import logging
+import queue
+import smtplib
+import threading
+import time
+from collections import Counter
+from contextlib import nullcontext
+from functools import lru_cache
+from types import ModuleType
+from typing import TYPE_CHECKING, Callable, Generic, Iterator, Optional, Sequence, TypeVar
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AbstractBaseUser
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMessage, EmailMultiAlternatives, get_connection
+from django.core.mail.backends.base import BaseEmailBackend
+from django.dispatch import receiver
+from django.template.loader import get_template
+from django.test.signals import setting_changed
+
+from .metrics import timed
+from .settings import EMAIL_BATCH_LATENCY, EMAIL_BATCH_SIZE, EMAIL_POOL_IDLE_TIMEOUT, EMAIL_POOL_SIZE, EMAIL_QUEUE_OVERFLOW, EMAIL_QUEUE_SIZE, EMAIL_WORKERS
+from .tracing import get_tracer, propagate
+
+aiosmtplib: Optional[ModuleType]
+try:
+    import aiosmtplib
+except ImportError:  # pragma: no cover
+    aiosmtplib = None
+
+if TYPE_CHECKING:
+    from aiosmtplib import SMTP
+    from django.template.backends.base import _EngineTemplate
+
+logger = logging.getLogger(__name__)
+
+Job = Callable[[], object]
+Item = TypeVar('Item')
+# Message queued for coalescing with the trace context of its request and the time it was queued (ns)
+Queued = tuple[EmailMessage, object, int]
+
+# Static part of the e-mail context, built once per process
+EMAIL_STYLE: dict[str, str] = {
+    'logo_url': '',
+    'background_color': '#ffffff',
+    'main_text_color': '#000000',
+    'button_background_color': '#0078be',
+    'button_text_color': '#ffffff',
+}
+
+
+@lru_cache(maxsize=None)
+def get_email_templates(email_templates: tuple[str, str]) -> tuple[_EngineTemplate, _EngineTemplate]:
+    """Load and compile plain text and HTML templates once per process, with whichever template engine finds them."""
+    return get_template(email_templates[0]), get_template(email_templates[1])
+
+
+@receiver(setting_changed)
+def clear_email_templates(*, setting: str, **kwargs) -> None:
+    if setting == 'TEMPLATES':
+        get_email_templates.cache_clear()
+    elif setting.startswith('EMAIL_'):
+        if _pool is not None:
+            _pool.close_all()
+        if _async_pool is not None:
+            _async_pool.close_all()
+
+
+def render_magiclink_email(*, email: str, user: AbstractBaseUser, magiclink: str, subject: str,
+                           email_templates: tuple[str, str]) -> EmailMultiAlternatives:
+    """Render both parts of the magiclink e-mail with one context and build the multipart message."""
+    plain_template, html_template = get_email_templates(email_templates)
+    context = {
+        'subject': subject,
+        'user': user,
+        'magiclink': magiclink,
+        'style': EMAIL_STYLE,
+    }
+    message = EmailMultiAlternatives(subject=subject, body=plain_template.render(context), from_email=settings.DEFAULT_FROM_EMAIL, to=[email])
+    message.attach_alternative(html_template.render(context), 'text/html')
+    return message
+
+
+async def asend_message(message: EmailMessage) -> None:
+    """
+    Send message without blocking the event loop. SMTP is spoken natively over pooled connections when aiosmtplib is installed,
+    other e-mail backends run in a worker thread.
+    """
+    if aiosmtplib is None or settings.EMAIL_BACKEND != 'django.core.mail.backends.smtp.EmailBackend':
+        await sync_to_async(get_connection_pool().send)([message])
+        return
+    await get_async_connection_pool().send(message)
+
+
+class ConnectionPool:
+    """
+    Keep up to `size` open mail connections and reuse them instead of connecting (and negotiating TLS) for every e-mail.
+
+    Connections idle for more than `idle_timeout` seconds are closed, ones idle for more than `check_after` seconds
+    are checked with NOOP before reuse. If the server has dropped the connection, the message being sent is retried once over a new one.
+    """
+
+    def __init__(self, *, size: int = 2, idle_timeout: float = 30, check_after: float = 1) -> None:
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._idle: list[tuple[BaseEmailBackend, float]] = []
+        self._lock = threading.Lock()
+
+    def send(self, messages: Sequence[EmailMessage]) -> int:
+        """Send messages over a pooled connection. Return the number of sent messages."""
+        with timed(name='send_seconds', span='smtp_send'):
+            return sum(1 for _ in self.send_each(messages))
+
+    def send_each(self, messages: Sequence[EmailMessage]) -> Iterator[EmailMessage]:
+        """
+        Send messages over a pooled connection one by one and yield every delivered one. When sending fails, the messages
+        yielded before the error have been delivered, so callers can tell them apart from the rest of the batch.
+        """
+        connection = self._checkout()
+        try:
+            for message in messages:
+                try:
+                    sent = connection.send_messages([message])
+                except smtplib.SMTPServerDisconnected:
+                    logger.info('Mail connection was closed by the server, reconnecting')
+                    self._close(connection)
+                    connection = self._connect()
+                    sent = connection.send_messages([message])
+                if sent:
+                    yield message
+        except BaseException:
+            # Including GeneratorExit of an abandoned iteration, the connection may be in the middle of a message
+            self._close(connection)
+            raise
+        self._checkin(connection)
+
+    def close_all(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    def _checkout(self) -> BaseEmailBackend:
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                connection, last_used = self._idle.pop()
+            idle = time.monotonic() - last_used
+            if idle > self.idle_timeout or (idle > self.check_after and not self._is_alive(connection)):
+                self._close(connection)
+                continue
+            return connection
+        return self._connect()
+
+    def _checkin(self, connection: BaseEmailBackend) -> None:
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((connection, time.monotonic()))
+                return
+        self._close(connection)
+
+    @staticmethod
+    def _connect() -> BaseEmailBackend:
+        connection = get_connection(fail_silently=False)
+        connection.open()
+        return connection
+
+    @staticmethod
+    def _is_alive(connection: BaseEmailBackend) -> bool:
+        # Only SMTP backend keeps a server connection
+        if not hasattr(connection, 'connection'):
+            return True
+        try:
+            return connection.connection is not None and connection.connection.noop()[0] == 250
+        except (smtplib.SMTPException, OSError):
+            return False
+
+    @staticmethod
+    def _close(connection: BaseEmailBackend) -> None:
+        try:
+            connection.close()
+        except (smtplib.SMTPException, OSError):
+            pass
+
+
+class AsyncConnectionPool:
+    """
+    Async counterpart of ConnectionPool keeping up to `size` open aiosmtplib connections. Needs aiosmtplib.
+
+    Connections belong to the event loop which opened them. Idle ones are closed when the loop cancels its remaining tasks
+    before closing, like asyncio.run() does, and when the pool is first used from another loop.
+    """
+
+    def __init__(self, *, size: int = 2, idle_timeout: float = 30, check_after: float = 1) -> None:
+        if aiosmtplib is None:
+            raise ImproperlyConfigured('AsyncConnectionPool needs aiosmtplib installed.')
+        self.aiosmtplib: ModuleType = aiosmtplib
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.check_after = check_after
+        self._idle: list[tuple[SMTP, float]] = []
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._closer: Optional[asyncio.Task[None]] = None
+
+    async def send(self, message: EmailMessage) -> None:
+        with timed(name='send_seconds', span='smtp_send'):
+            connection = await self._checkout()
+            try:
+                try:
+                    await self._send(connection, message)
+                except self.aiosmtplib.SMTPServerDisconnected:
+                    logger.info('Mail connection was closed by the server, reconnecting')
+                    self._close(connection)
+                    connection = await self._connect()
+                    await self._send(connection, message)
+            except BaseException:
+                self._close(connection)
+                raise
+            self._checkin(connection)
+
+    def close_all(self) -> None:
+        idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            self._close(connection)
+
+    async def _checkout(self) -> SMTP:
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # Left by a loop which was closed without cancelling its tasks, they cannot be used from this one
+            self.close_all()
+            self._loop = loop
+            self._closer = loop.create_task(self._close_on_cancel(loop))
+        while self._idle:
+            connection, last_used = self._idle.pop()
+            idle = time.monotonic() - last_used
+            if idle > self.idle_timeout or (idle > self.check_after and not await self._is_alive(connection)):
+                self._close(connection)
+                continue
+            return connection
+        return await self._connect()
+
+    async def _close_on_cancel(self, loop: asyncio.AbstractEventLoop) -> None:
+        try:
+            await loop.create_future()
+        finally:
+            if self._loop is loop:
+                self.close_all()
+
+    def _checkin(self, connection: SMTP) -> None:
+        if len(self._idle) < self.size:
+            self._idle.append((connection, time.monotonic()))
+        else:
+            self._close(connection)
+
+    async def _connect(self) -> SMTP:
+        connection: SMTP = self.aiosmtplib.SMTP(hostname=settings.EMAIL_HOST, port=settings.EMAIL_PORT, username=settings.EMAIL_HOST_USER or None,
+                                                password=settings.EMAIL_HOST_PASSWORD or None, use_tls=settings.EMAIL_USE_SSL,
+                                                start_tls=settings.EMAIL_USE_TLS, timeout=settings.EMAIL_TIMEOUT)
+        await connection.connect()
+        return connection
+
+    @staticmethod
+    async def _send(connection: SMTP, message: EmailMessage) -> None:
+        await connection.send_message(message.message(), sender=message.from_email, recipients=message.recipients())
+
+    async def _is_alive(self, connection: SMTP) -> bool:
+        try:
+            return connection.is_connected and (await connection.noop()).code == 250
+        except (self.aiosmtplib.SMTPException, OSError):
+            return False
+
+    def _close(self, connection: SMTP) -> None:
+        try:
+            connection.close()
+        except (self.aiosmtplib.SMTPException, OSError, RuntimeError):
+            pass
+
+
+class QueueWorker(Generic[Item]):
+    """
+    Bounded queue of items served by a small pool of worker threads.
+
+    `overflow` decides what happens when the queue is full: 'inline' processes the item in the caller thread,
+    'block' waits for a free slot and 'drop' discards it.
+    """
+
+    def __init__(self, *, queue_size: int = 1000, workers: int = 2, overflow: str = 'inline') -> None:
+        self.overflow = overflow
+        self.workers = workers
+        self._queue: queue.Queue[Optional[Item]] = queue.Queue(maxsize=queue_size)
+        self._threads: list[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self) -> None:
+        with self._lock:
+            if self._threads:
+                return
+            for number in range(self.workers):
+                thread = threading.Thread(target=self._work, name='magiclinks-mail-{number}'.format(number=number), daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def flush(self) -> None:
+        """Wait until every queued item has been processed."""
+        self._queue.join()
+
+    def shutdown(self, timeout: Optional[float] = None) -> None:
+        """Process queued items and stop the workers."""
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join(timeout)
+
+    def _put(self, item: Item) -> bool:
+        """Queue item. Return False if it was dropped."""
+        self.start()
+        try:
+            self._queue.put(item, block=self.overflow == 'block')
+        except queue.Full:
+            if self.overflow == 'drop':
+                logger.warning('Magiclink e-mail queue is full, message dropped')
+                return False
+            logger.warning('Magiclink e-mail queue is full, sending inline')
+            self._run(item)
+        return True
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._run(item)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, item: Item) -> None:
+        raise NotImplementedError
+
+
+class BackgroundSender(QueueWorker[Job]):
+    """Deliver e-mails by running queued jobs in worker threads."""
+
+    def submit(self, job: Job) -> bool:
+        """Queue job for delivery. Return False if it was dropped."""
+        # Sending continues the trace of the request
+        return self._put(propagate(job))
+
+    def _run(self, job: Job) -> None:
+        try:
+            job()
+        except Exception:
+            logger.exception('Failed to send magiclink e-mail')
+
+
+class CoalescingSender(QueueWorker[Queued]):
+    """
+    Background sender for bursts of e-mails: queued messages are collected for up to `max_latency` seconds
+    or until `max_batch` of them are waiting and sent with one send_messages() call over a pooled connection.
+
+    `batch_sizes` counts sent batches by their size.
+    """
+
+    def __init__(self, *, max_batch: int = 100, max_latency: float = 0.05, queue_size: int = 1000, workers: int = 1,
+                 overflow: str = 'inline') -> None:
+        super().__init__(queue_size=queue_size, workers=workers, overflow=overflow)
+        self.max_batch = max_batch
+        self.max_latency = max_latency
+        self.batch_sizes: Counter[int] = Counter()
+
+    def stats(self) -> dict[str, object]:
+        with self._lock:
+            batch_sizes = dict(sorted(self.batch_sizes.items()))
+        return {
+            'batches': sum(batch_sizes.values()),
+            'messages': sum(size * count for size, count in batch_sizes.items()),
+            'batch_sizes': batch_sizes,
+        }
+
+    def _work(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.max_batch:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+
+            try:
+                self._send(batch)
+            finally:
+                for _ in range(len(batch) + stop):
+                    self._queue.task_done()
+            if stop:
+                return
+
+    def submit_message(self, message: EmailMessage) -> bool:
+        """Queue message for delivery in the next batch. Return False if it was dropped."""
+        tracer = get_tracer()
+        if not tracer.enabled:
+            return self._put((message, None, 0))
+        return self._put((message, tracer.capture(), time.time_ns()))
+
+    def _run(self, item: Queued) -> None:
+        self._send([item])
+
+    def _send(self, batch: list[Queued]) -> None:
+        with self._lock:
+            self.batch_sizes[len(batch)] += 1
+        messages = [message for message, _, _ in batch]
+        try:
+            with self._trace(batch):
+                get_connection_pool().send(messages)
+        except Exception:
+            logger.exception('Failed to send batch of %d magiclink e-mails', len(messages))
+
+    @staticmethod
+    def _trace(batch: list[Queued]):
+        """Record queue wait in the trace of every message, return span of the batch send linked to all of them."""
+        tracer = get_tracer()
+        if not tracer.enabled:
+            return nullcontext()
+        now = time.time_ns()
+        for _, context, queued in batch:
+            with tracer.attach(context):
+                tracer.record('magiclinks.email_queued', start_time=queued, end_time=now, batch_size=len(batch))
+        return tracer.span('magiclinks.send_batch', links=[context for _, context, _ in batch], batch_size=len(batch))
+
+
+_sender: Optional[BackgroundSender] = None
+_sender_lock = threading.Lock()
+
+
+def get_background_sender() -> BackgroundSender:
+    """Return process-wide background sender. It is flushed on interpreter shutdown."""
+    global _sender
+    if _sender is None:
+        with _sender_lock:
+            if _sender is None:
+                _sender = BackgroundSender(queue_size=EMAIL_QUEUE_SIZE, workers=EMAIL_WORKERS, overflow=EMAIL_QUEUE_OVERFLOW)
+                atexit.register(_sender.shutdown)
+    return _sender
+
+
+_coalescing_sender: Optional[CoalescingSender] = None
+
+
+def get_coalescing_sender() -> CoalescingSender:
+    """Return process-wide coalescing sender. It is flushed on interpreter shutdown."""
+    global _coalescing_sender
+    if _coalescing_sender is None:
+        with _sender_lock:
+            if _coalescing_sender is None:
+                _coalescing_sender = CoalescingSender(max_batch=EMAIL_BATCH_SIZE, max_latency=EMAIL_BATCH_LATENCY, queue_size=EMAIL_QUEUE_SIZE,
+                                                      overflow=EMAIL_QUEUE_OVERFLOW)
+                atexit.register(_coalescing_sender.shutdown)
+    return _coalescing_sender
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool() -> ConnectionPool:
+    """Return process-wide mail connection pool. It is closed on interpreter shutdown and when EMAIL_* settings change."""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(size=EMAIL_POOL_SIZE, idle_timeout=EMAIL_POOL_IDLE_TIMEOUT)
+                atexit.register(_pool.close_all)
+    return _pool
+
+
+_async_pool: Optional[AsyncConnectionPool] = None
+
+
+def get_async_connection_pool() -> AsyncConnectionPool:
+    """Return process-wide async mail connection pool. It is closed when EMAIL_* settings change."""
+    global _async_pool
+    if _async_pool is None:
+        _async_pool = AsyncConnectionPool(size=EMAIL_POOL_SIZE, idle_timeout=EMAIL_POOL_IDLE_TIMEOUT)
+    return _async_pool
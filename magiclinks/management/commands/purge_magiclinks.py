@@ -0,0 +1,29 @@
+from __future__ import annotations
+
+import time
+
+from django.core.management.base import BaseCommand
+
+from magiclinks.services import purge_magiclinks
+from magiclinks.settings import EXPIRY_SECONDS
+
+
+class Command(BaseCommand):
+    help = 'Delete expired magic links from the database in small primary key batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--expiry-seconds', type=int, default=EXPIRY_SECONDS, help='Delete magic links older than this.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of rows deleted by one statement.')
+        parser.add_argument('--loop', action='store_true', help='Keep purging instead of exiting after one pass.')
+        parser.add_argument('--sleep', type=float, default=60.0, help='Seconds to wait between passes in --loop mode.')
+
+    def handle(self, *args, **options):
+        while True:
+            started = time.monotonic()
+            deleted = purge_magiclinks(expiry_seconds=options['expiry_seconds'], batch_size=options['batch_size'])
+            elapsed = time.monotonic() - started
+            rate = deleted / elapsed if elapsed else 0
+            self.stdout.write('Deleted {deleted} magic links in {elapsed:.2f}s ({rate:.0f} rows/s)'.format(deleted=deleted, elapsed=elapsed, rate=rate))
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
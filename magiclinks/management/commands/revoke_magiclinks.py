@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+import time
+from datetime import datetime
+
+from django.contrib.auth import get_user_model
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.dateparse import parse_datetime
+from django.utils.timezone import is_naive, make_aware
+
+from magiclinks.services import revoke_magiclinks
+from magiclinks.utils import read_emails
+
+
+class Command(BaseCommand):
+    help = 'Delete outstanding magic links matching all given criteria in set-based batches.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', help='File with one E-mail per line, "-" reads standard input.')
+        parser.add_argument('--inactive-users', action='store_true', help='Revoke magic links of inactive users.')
+        parser.add_argument('--domain', help='Revoke magic links sent to E-mails in this domain.')
+        parser.add_argument('--created-after', type=self.parse_moment, help='Revoke magic links created at or after this ISO datetime.')
+        parser.add_argument('--created-before', type=self.parse_moment, help='Revoke magic links created before this ISO datetime.')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of rows deleted by one statement.')
+
+    def handle(self, *args, **options):
+        users = get_user_model()._default_manager.filter(is_active=False) if options['inactive_users'] else None
+        emails = read_emails(options['file']) if options['file'] else None
+
+        started = time.monotonic()
+        try:
+            revoked = revoke_magiclinks(emails=emails, users=users, domain=options['domain'], created_after=options['created_after'],
+                                        created_before=options['created_before'], batch_size=options['batch_size'])
+        except (ValueError, ImproperlyConfigured) as e:
+            raise CommandError(str(e))
+        elapsed = time.monotonic() - started
+        self.stdout.write('Revoked {revoked} magic links in {elapsed:.2f}s'.format(revoked=revoked, elapsed=elapsed))
+
+    @staticmethod
+    def parse_moment(value: str) -> datetime:
+        moment = parse_datetime(value)
+        if moment is None:
+            raise ValueError(value)
+        return make_aware(moment) if is_naive(moment) else moment
@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import logging
+import time
+
+from django.core.management.base import BaseCommand
+
+from magiclinks.services import send_outbox_emails
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Send magic link e-mails stored in the outbox. Several workers may run at the same time.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help='Number of e-mails sent over one mail connection.')
+        parser.add_argument('--lease-seconds', type=int, default=60, help='How long claimed e-mails are reserved for this worker.')
+        parser.add_argument('--max-attempts', type=int, default=5, help='Give up on e-mails after this many attempts.')
+        parser.add_argument('--loop', action='store_true', help='Keep polling the outbox instead of exiting when it is empty.')
+        parser.add_argument('--sleep', type=float, default=1.0, help='Seconds to wait between polls of an empty outbox.')
+
+    def handle(self, *args, **options):
+        total = 0
+        while True:
+            try:
+                sent = send_outbox_emails(batch_size=options['batch_size'], lease_seconds=options['lease_seconds'], max_attempts=options['max_attempts'])
+            except Exception:
+                if not options['loop']:
+                    raise
+                logger.exception('Failed to send outbox e-mails')
+                sent = 0
+            total += sent
+            if sent:
+                continue
+            if not options['loop']:
+                break
+            time.sleep(options['sleep'])
+
+        self.stdout.write('Sent {total} e-mails'.format(total=total))
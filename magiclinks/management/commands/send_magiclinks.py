@@ -0,0 +1,46 @@
+from __future__ import annotations
+
+import time
+
+from django.apps import apps
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+
+from magiclinks.services import bulk_send_magiclinks
+from magiclinks.utils import read_emails
+
+
+class Command(BaseCommand):
+    help = 'Send magic links (e.g. invitations) to many users. E-mails are streamed and processed in chunks.'
+
+    def add_arguments(self, parser):
+        source = parser.add_mutually_exclusive_group(required=True)
+        source.add_argument('--file', help='File with one E-mail per line, "-" reads standard input.')
+        source.add_argument('--active-users', action='store_true', help='Send to every active user.')
+        parser.add_argument('--domain', help='Domain of the magic links. Defaults to the current Site when django.contrib.sites is installed.')
+        parser.add_argument('--url-name', default='magiclinks:login_verify', help='URL name of the verify view.')
+        parser.add_argument('--next-url', default='', help='Where users are redirected after login.')
+        parser.add_argument('--subject', default='Your login magic link', help='E-mail subject.')
+        parser.add_argument('--create-users', action='store_true', help='Create users for unknown E-mails read from --file.')
+        parser.add_argument('--chunk-size', type=int, default=1000, help='Number of magic links created and sent at once.')
+
+    def handle(self, *args, **options):
+        domain: str = options['domain'] or self.get_site_domain()
+        if options['active_users']:
+            emails = get_user_model()._default_manager.filter(is_active=True).values_list('email', flat=True).iterator(chunk_size=options['chunk_size'])
+        else:
+            emails = read_emails(options['file'])
+
+        started = time.monotonic()
+        sent = bulk_send_magiclinks(emails=emails, domain=domain, url_name=options['url_name'], next_url=options['next_url'], subject=options['subject'],
+                                    chunk_size=options['chunk_size'], create_missing_users=options['create_users'])
+        elapsed = time.monotonic() - started
+        rate = sent / elapsed if elapsed else 0
+        self.stdout.write('Sent {sent} magic links in {elapsed:.2f}s ({rate:.0f} links/s)'.format(sent=sent, elapsed=elapsed, rate=rate))
+
+    @staticmethod
+    def get_site_domain() -> str:
+        if not apps.is_installed('django.contrib.sites'):
+            raise CommandError('--domain is required when django.contrib.sites is not installed.')
+        from django.contrib.sites.models import Site
+        return str(Site.objects.get_current().domain)
@@ -0,0 +1,18 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand, CommandError
+
+from magiclinks.metrics import CacheMetricsSink, get_metrics
+from magiclinks.models import MagicLink
+
+
+class Command(BaseCommand):
+    help = 'Set the outstanding magic links gauge from the table, e.g. after enabling the metrics sink or losing the cache. Counts all rows once.'
+
+    def handle(self, *args, **options):
+        sink = get_metrics()
+        if not isinstance(sink, CacheMetricsSink):
+            raise CommandError('MAGICLINKS_METRICS_SINK does not keep counters.')
+        count = MagicLink.objects.count()
+        sink.set_outstanding(count)
+        self.stdout.write('Outstanding magic links: {count}'.format(count=count))
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import time
+from contextlib import AbstractContextManager, nullcontext
+from functools import lru_cache
+from typing import Optional
+
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+from .settings import CACHE, METRICS_SINK
+from .tracing import get_tracer
+
+# Counters exposed by the metrics view: help text, label name and label values
+COUNTERS: dict[str, tuple[str, str, tuple[str, ...]]] = {
+    'issued': ('Magic links issued.', '', ('',)),
+    'consumed': ('Magic links consumed by verification.', '', ('',)),
+    'verify_failed': ('Failed verifications by reason.', 'reason',
+                      ('expired', 'bad_signature', 'already_used', 'not_found', 'unknown_user', 'inactive_user')),
+    'throttled': ('Throttled requests by rate limit scope.', 'scope', ('global', 'ip', 'email', 'link')),
+}
+# Stored rows counted by ModelStorage and the purge, their difference is the number of outstanding magiclinks
+ROW_COUNTERS: tuple[str, str] = ('links_created', 'links_removed')
+
+
+class MetricsSink:
+    """
+    Receives magiclink metrics. This default one discards them, subclass it and set MAGICLINKS_METRICS_SINK to record them.
+
+    Counters: issued, consumed, throttled (scope), verify_failed (reason: expired, bad_signature, already_used,
+    not_found for opaque tokens, unknown_user, inactive_user), links_created and links_removed (stored rows).
+    Histograms in seconds: stage_seconds (stage), send_seconds.
+    """
+    enabled: bool = False
+
+    def increment(self, name: str, value: int = 1, **labels: str) -> None:
+        pass
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        pass
+
+
+class CacheMetricsSink(MetricsSink):
+    """
+    Keep counters in the MAGICLINKS_CACHE cache, shared by every process using it, for the metrics view.
+    Timings are discarded. Counters never expire, so the cache should not evict keys (e.g. Redis without an eviction policy).
+    """
+    enabled = True
+    key_prefix: str = 'magiclinks:metrics'
+
+    def __init__(self, alias: str = CACHE) -> None:
+        self.cache = caches[alias]
+
+    def key(self, name: str, label: str = '') -> str:
+        return '{prefix}:{name}:{label}'.format(prefix=self.key_prefix, name=name, label=label)
+
+    def increment(self, name: str, value: int = 1, **labels: str) -> None:
+        key = self.key(name, *labels.values())
+        try:
+            self.cache.incr(key, value)
+        except ValueError:
+            # First increment, unless a concurrent one has just added the key
+            if not self.cache.add(key, value, timeout=None):
+                self.cache.incr(key, value)
+
+    def collect(self) -> dict[tuple[str, str], int]:
+        """Return values of all exposed counters and row counters by (name, label value), in a single cache read."""
+        series = [(name, label) for name, (_, _, labels) in COUNTERS.items() for label in labels] + [(name, '') for name in ROW_COUNTERS]
+        values = self.cache.get_many([self.key(name, label) for name, label in series])
+        return {(name, label): int(values.get(self.key(name, label), 0)) for name, label in series}
+
+    def set_outstanding(self, count: int) -> None:
+        """Start counting outstanding magiclinks from count, e.g. rows stored before the sink was enabled."""
+        self.cache.set_many({self.key('links_created'): count, self.key('links_removed'): 0}, timeout=None)
+
+
+class Timer(AbstractContextManager['Timer']):
+    """Observe duration of the block when the sink is enabled, within span when given."""
+
+    def __init__(self, sink: MetricsSink, name: str, labels: dict[str, str], span: Optional[AbstractContextManager[object]] = None) -> None:
+        self.sink = sink
+        self.name = name
+        self.labels = labels
+        self.span = span
+        self.started = 0.0
+
+    def __enter__(self) -> Timer:
+        if self.span is not None:
+            self.span.__enter__()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        if self.sink.enabled:
+            self.sink.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        if self.span is not None:
+            self.span.__exit__(*exc_info)
+
+
+_disabled = nullcontext()
+
+
+@lru_cache(maxsize=None)
+def get_metrics() -> MetricsSink:
+    """Return sink configured with MAGICLINKS_METRICS_SINK."""
+    sink: MetricsSink = import_string(METRICS_SINK)()
+    return sink
+
+
+def increment(name: str, value: int = 1, **labels: str) -> None:
+    sink = get_metrics()
+    if sink.enabled:
+        sink.increment(name, value, **labels)
+
+
+def timed(stage: Optional[str] = None, *, name: str = 'stage_seconds', span: Optional[str] = None) -> AbstractContextManager[object]:
+    """
+    Observe duration of the block as name (with stage label when given) and trace it as span magiclinks.<span or stage>.
+    Costs two attribute checks when metrics and tracing are disabled.
+    """
+    sink = get_metrics()
+    tracer = get_tracer()
+    span_name = span or stage
+    traced = tracer.enabled and span_name
+    if not sink.enabled and not traced:
+        return _disabled
+    return Timer(sink, name, {'stage': stage} if stage else {}, tracer.span('magiclinks.{name}'.format(name=span_name)) if traced else None)
+
+
+def render_prometheus(values: dict[tuple[str, str], int], *, outstanding: bool = True) -> str:
+    """Format counters collected by CacheMetricsSink in the Prometheus text exposition format."""
+    lines = []
+    for name, (help_text, label_name, labels) in COUNTERS.items():
+        metric = 'magiclinks_{name}_total'.format(name=name)
+        lines += ['# HELP {metric} {help}'.format(metric=metric, help=help_text), '# TYPE {metric} counter'.format(metric=metric)]
+        for label in labels:
+            selector = '{{{name}="{value}"}}'.format(name=label_name, value=label) if label_name else ''
+            lines.append('{metric}{selector} {value}'.format(metric=metric, selector=selector, value=values[name, label]))
+    if outstanding:
+        lines += ['# HELP magiclinks_outstanding Stored magic links which are not consumed, replaced or deleted yet.',
+                  '# TYPE magiclinks_outstanding gauge',
+                  'magiclinks_outstanding {value}'.format(value=max(values['links_created', ''] - values['links_removed', ''], 0))]
+    return '\n'.join(lines) + '\n'
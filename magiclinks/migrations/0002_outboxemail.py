@@ -0,0 +1,31 @@
+# Generated by Django 5.0.14 on 2026-10-18 14:01
+from __future__ import annotations
+
+from django.db import migrations, models
+
+import magiclinks.utils
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('magiclinks', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEmail',
+            fields=[
+                ('id', models.UUIDField(blank=True, default=magiclinks.utils.generate_timeflake, editable=False, primary_key=True, serialize=False, verbose_name='ID')),
+                ('email', models.EmailField(max_length=254, verbose_name='email address')),
+                ('from_email', models.CharField(max_length=254, verbose_name='from email')),
+                ('subject', models.CharField(max_length=255, verbose_name='subject')),
+                ('message', models.TextField(verbose_name='message')),
+                ('html_message', models.TextField(blank=True, verbose_name='HTML message')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('lock_id', models.UUIDField(blank=True, db_index=True, null=True, verbose_name='lock ID')),
+                ('locked_until', models.DateTimeField(blank=True, db_index=True, null=True, verbose_name='locked until')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='date created')),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.14 on 2026-10-18 14:03
+from __future__ import annotations
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('magiclinks', '0002_outboxemail'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='magiclink',
+            index=models.Index(fields=['email', 'date_created'], name='magiclinks_email_created_idx'),
+        ),
+    ]
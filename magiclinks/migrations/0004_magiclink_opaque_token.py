@@ -0,0 +1,24 @@
+# Generated by Django 5.0.14 on 2026-10-18 14:07
+from __future__ import annotations
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('magiclinks', '0003_magiclink_email_created_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='magiclink',
+            name='next_url',
+            field=models.TextField(blank=True, default='', verbose_name='next URL'),
+        ),
+        migrations.AddField(
+            model_name='magiclink',
+            name='token_hash',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True, verbose_name='token hash'),
+        ),
+    ]
@@ -10,6 +10,28 @@ class MagicLink(models.Model):  # type: ignore
     id = models.UUIDField(verbose_name='ID', primary_key=True, blank=True, default=generate_timeflake, editable=False)
     email = models.EmailField(verbose_name=_('email address'), unique=True)
     date_created = models.DateTimeField(_('date created'), auto_now_add=True, db_index=True)
+    # Opaque tokens only: the token is sent by e-mail, its hash and the redirect URL stay on the server
+    token_hash = models.CharField(_('token hash'), max_length=64, null=True, blank=True, unique=True, editable=False)
+    next_url = models.TextField(_('next URL'), blank=True, default='')
+
+    class Meta:
+        indexes = [models.Index(fields=['email', 'date_created'], name='magiclinks_email_created_idx')]
+
+    def __str__(self) -> str:
+        return '{pk} - {email}'.format(pk=str(self.pk), email=self.email)
+
+
+class OutboxEmail(models.Model):
+    id = models.UUIDField(verbose_name='ID', primary_key=True, blank=True, default=generate_timeflake, editable=False)
+    email = models.EmailField(verbose_name=_('email address'))
+    from_email = models.CharField(_('from email'), max_length=254)
+    subject = models.CharField(_('subject'), max_length=255)
+    message = models.TextField(_('message'))
+    html_message = models.TextField(_('HTML message'), blank=True)
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    lock_id = models.UUIDField(_('lock ID'), null=True, blank=True, db_index=True)
+    locked_until = models.DateTimeField(_('locked until'), null=True, blank=True, db_index=True)
+    date_created = models.DateTimeField(_('date created'), auto_now_add=True)
 
     def __str__(self) -> str:
         return '{pk} - {email}'.format(pk=str(self.pk), email=self.email)
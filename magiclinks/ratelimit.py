@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import logging
+import time
+from typing import Optional
+
+from django.core.cache import caches
+from django.http import HttpRequest
+
+from .metrics import increment
+from .settings import CACHE, RATELIMIT_IP_META, RATELIMITS
+from .utils import hash_token
+
+logger = logging.getLogger(__name__)
+
+
+class SlidingWindowRateLimiter:
+    """
+    Approximate sliding window counter kept in Django cache.
+    The previous fixed window is weighted by how much of it still overlaps with the sliding window.
+    """
+    key_prefix: str = 'magiclinks:ratelimit'
+
+    def __init__(self, alias: str = CACHE) -> None:
+        self.cache = caches[alias]
+
+    def hit(self, key: str, *, limit: int, period: int) -> bool:
+        """Count request for key. Return True if it is within limit requests per period seconds."""
+        now = time.time()
+        window = int(now // period)
+        current_key = '{prefix}:{key}:{period}:{window}'.format(prefix=self.key_prefix, key=key, period=period, window=window)
+        previous_key = '{prefix}:{key}:{period}:{window}'.format(prefix=self.key_prefix, key=key, period=period, window=window - 1)
+
+        self.cache.add(current_key, 0, timeout=period * 2)
+        try:
+            current: int = self.cache.incr(current_key)
+        except ValueError:
+            # Key has expired between add() and incr()
+            self.cache.set(current_key, 1, timeout=period * 2)
+            current = 1
+        previous: int = self.cache.get(previous_key, 0)
+
+        overlap = 1 - (now - window * period) / period
+        return previous * overlap + current <= limit
+
+
+_limiter: Optional[SlidingWindowRateLimiter] = None
+
+
+def get_client_ip(request: HttpRequest) -> str:
+    """
+    Return the client IP from MAGICLINKS_RATELIMIT_IP_META. Proxies append the address they see to lists like X-Forwarded-For,
+    so the last entry is used, earlier ones come from the client and can be forged.
+    """
+    return str(request.META.get(RATELIMIT_IP_META, '')).split(',')[-1].strip()
+
+
+def is_ratelimited(request: Optional[HttpRequest], *, email: str) -> bool:
+    """Check global, per client IP and per E-mail quotas from MAGICLINKS_RATELIMITS. Uses cache only."""
+    global _limiter
+    if _limiter is None:
+        _limiter = SlidingWindowRateLimiter()
+
+    # E-mail is hashed to keep keys short, memcached limits them to 250 bytes
+    keys = {'global': 'global', 'email': 'email:{email}'.format(email=hash_token(email))}
+    if request is not None:
+        keys['ip'] = 'ip:{ip}'.format(ip=get_client_ip(request))
+
+    for scope in ('global', 'ip', 'email'):
+        quota = RATELIMITS.get(scope)
+        if not quota or scope not in keys:
+            continue
+        limit, period = quota
+        if not _limiter.hit(keys[scope], limit=limit, period=period):
+            logger.info('Magiclink request throttled by %s quota', scope)
+            increment('throttled', scope=scope)
+            return True
+    return False
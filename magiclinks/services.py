@@ -1,24 +1,32 @@
 from __future__ import annotations
 
 import logging
-from datetime import timedelta
-from typing import Optional, Union
-from urllib.parse import urlencode, urljoin
-from uuid import UUID
+import secrets
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from functools import partial
+from typing import Iterable, Optional, Sequence, Union
+from urllib.parse import urlencode
+from uuid import UUID, uuid4
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.auth.models import AbstractUser
 from django.core import signing
-from django.core.mail import send_mail
-from django.template.loader import render_to_string
-from django.urls import reverse
+from django.core.exceptions import ImproperlyConfigured
+from django.core.mail import EmailMultiAlternatives
+from django.db import connection, transaction
+from django.db.models import F, Q, QuerySet
+from django.db.models.functions import Lower
 from django.utils import timezone
 
 from magiclinks.exceptions import MagicLinkError
-from magiclinks.models import MagicLink
-from magiclinks.settings import REGISTRATION_SALT
-from magiclinks.utils import get_url_path
+from magiclinks.mail import asend_message, get_background_sender, get_coalescing_sender, get_connection_pool, render_magiclink_email
+from magiclinks.metrics import increment, timed
+from magiclinks.models import MagicLink, OutboxEmail
+from magiclinks.settings import CREATE_USER_CALLABLE, CREATE_USERS_CALLABLE, EMAIL_DISPATCH, REGISTRATION_SALT, TOKEN_FORMAT
+from magiclinks.storage import ModelStorage, count_rows, get_storage
+from magiclinks.utils import chunked, get_url_path, get_verify_url, hash_token, load_callable, timeflake_floor
 
 logger = logging.getLogger(__name__)
 User = get_user_model()
@@ -32,54 +40,322 @@ def create_magiclink(*, email: str, domain: str, url_name: str, next_url: str, l
     if not next_url:
         next_url = get_url_path(settings.LOGIN_REDIRECT_URL)
 
-    # Check limit
-    limit = timezone.now() - timedelta(seconds=limit_seconds)  # NOQA: E501
-    if MagicLink.objects.filter(email=email, date_created__gte=limit).exists():
-        raise MagicLinkError('Too many magic login requests')
+    # Replace token for given E-mail unless it was created within the limit
+    try:
+        with timed('create_link'):
+            if TOKEN_FORMAT == 'opaque':
+                token = secrets.token_urlsafe(16)
+                get_storage().create(email=email, limit_seconds=limit_seconds, token_hash=hash_token(token), next_url=next_url)
+            else:
+                pk = get_storage().create(email=email, limit_seconds=limit_seconds)
+    except MagicLinkError:
+        increment('throttled', scope='link')
+        raise
+    if TOKEN_FORMAT != 'opaque':
+        with timed('sign_token'):
+            token = _sign_token(pk=pk, email=email, next_url=next_url)
 
-    # Delete token for given E-mail if token exists
-    delete_magiclink(email=email)
+    increment('issued')
+    return _build_magiclink(domain=domain, url_name=url_name, token=token)
 
-    # Register created token in the database
-    magiclink = MagicLink(email=email)
-    magiclink.save()
 
-    # Sign token
-    signed_token: str = signing.dumps(obj={'pk': str(magiclink.pk), 'email': email, 'next': next_url}, salt=REGISTRATION_SALT)
+async def acreate_magiclink(*, email: str, domain: str, url_name: str, next_url: str, limit_seconds: int) -> str:
+    """Async version of create_magiclink."""
+    logger.info('Creating magiclink')
+    email = email.lower()
+    if not next_url:
+        next_url = get_url_path(settings.LOGIN_REDIRECT_URL)
+
+    try:
+        with timed('create_link'):
+            if TOKEN_FORMAT == 'opaque':
+                token = secrets.token_urlsafe(16)
+                await get_storage().acreate(email=email, limit_seconds=limit_seconds, token_hash=hash_token(token), next_url=next_url)
+            else:
+                pk = await get_storage().acreate(email=email, limit_seconds=limit_seconds)
+    except MagicLinkError:
+        increment('throttled', scope='link')
+        raise
+    if TOKEN_FORMAT != 'opaque':
+        with timed('sign_token'):
+            token = _sign_token(pk=pk, email=email, next_url=next_url)
+
+    increment('issued')
+    return _build_magiclink(domain=domain, url_name=url_name, token=token)
+
+
+def create_user(*, email: str) -> object:
+    """Create user with MAGICLINKS_CREATE_USER_CALLABLE."""
+    return load_callable(CREATE_USER_CALLABLE)(email=email)
 
-    return urljoin('https://{domain}'.format(domain=domain),
-                   '{url_path}?{query}'.format(url_path=reverse(url_name), query=urlencode({'token': signed_token})))
+
+def create_users(*, emails: Sequence[str]) -> None:
+    """Create users with MAGICLINKS_CREATE_USERS_CALLABLE, or one by one when it is not set."""
+    if CREATE_USERS_CALLABLE:
+        load_callable(CREATE_USERS_CALLABLE)(emails=emails)
+        return
+    for email in emails:
+        create_user(email=email)
+
+
+def bulk_create_magiclinks(*, emails: Sequence[str], domain: str, url_name: str, next_url: str = '') -> dict[str, str]:
+    """
+    Create magiclinks for many E-mails at once, replacing old ones regardless of their age (there is no rate limit).
+    Return magiclink by lowercased E-mail.
+    """
+    logger.info('Creating %d magiclinks', len(emails))
+    emails = list(dict.fromkeys(email.lower() for email in emails))
+    if not next_url:
+        next_url = get_url_path(settings.LOGIN_REDIRECT_URL)
+
+    if TOKEN_FORMAT == 'opaque':
+        tokens = [secrets.token_urlsafe(16) for _ in emails]
+        get_storage().create_many(emails=emails, token_hashes=[hash_token(token) for token in tokens], next_url=next_url)
+    else:
+        pks = get_storage().create_many(emails=emails)
+        # Same format as signing.dumps(), without building a signer for every token
+        signer = signing.TimestampSigner(salt=REGISTRATION_SALT)
+        tokens = [signer.sign_object({'pk': pk, 'email': email, 'next': next_url}) for pk, email in zip(pks, emails)]
+
+    increment('issued', len(emails))
+    url = get_verify_url(domain=domain, url_name=url_name)
+    return {email: '{url}?{query}'.format(url=url, query=urlencode({'token': token})) for email, token in zip(emails, tokens)}
+
+
+def bulk_send_magiclinks(*, emails: Iterable[str], domain: str, url_name: str = 'magiclinks:login_verify', next_url: str = '',
+                         subject: str = 'Your login magic link',
+                         email_templates: tuple[str, str] = ('magiclinks/login_email.txt', 'magiclinks/login_email.html'),
+                         chunk_size: int = 1000, create_missing_users: bool = False) -> int:
+    """
+    Create and send magiclinks to active users with given E-mails, e.g. invitations. E-mails are processed chunk by chunk,
+    so memory use does not depend on the input size. Return the number of sent (or stored in the outbox) e-mails.
+    With create_missing_users users are created for unknown E-mails first.
+    """
+    total = 0
+    for chunk in chunked(emails, chunk_size):
+        # User E-mails are stored lowercased, like the forms clean them
+        chunk = list(dict.fromkeys(email.lower() for email in chunk))
+        if create_missing_users:
+            existing = {email.lower() for email in User.objects.filter(email__in=chunk).values_list('email', flat=True)}
+            missing = [email for email in chunk if email not in existing]
+            if missing:
+                create_users(emails=missing)
+        users = list(User.objects.filter(email__in=chunk, is_active=True))
+        if not users:
+            continue
+
+        # Outbox e-mails are stored in the same transaction as the magiclinks
+        with transaction.atomic() if EMAIL_DISPATCH == 'outbox' else nullcontext():
+            magiclinks = bulk_create_magiclinks(emails=[user.email for user in users], domain=domain, url_name=url_name, next_url=next_url)
+            messages = [render_magiclink_email(email=user.email, user=user, magiclink=magiclinks[user.email.lower()], subject=subject,
+                                               email_templates=email_templates) for user in users]
+            if EMAIL_DISPATCH == 'outbox':
+                OutboxEmail.objects.bulk_create([OutboxEmail(**_outbox_fields(message)) for message in messages])
+            else:
+                get_connection_pool().send(messages)
+        total += len(messages)
+        logger.info('Sent %d magiclinks', total)
+    return total
+
+
+def _sign_token(*, pk: str, email: str, next_url: str) -> str:
+    return signing.dumps(obj={'pk': pk, 'email': email, 'next': next_url}, salt=REGISTRATION_SALT)
+
+
+def _build_magiclink(*, domain: str, url_name: str, token: str) -> str:
+    return '{url}?{query}'.format(url=get_verify_url(domain=domain, url_name=url_name), query=urlencode({'token': token}))
 
 
 def delete_magiclink(*, pk: Optional[Union[str, UUID]] = None, email: Optional[str] = None) -> None:
     """Delete magiclink."""
     logger.info('Deleting magiclink')
-    if pk:
-        MagicLink.objects.filter(pk=pk).delete()
-    else:
-        MagicLink.objects.filter(email=email).delete()
+    get_storage().delete(pk=pk, email=email)
+
+
+def consume_magiclink(*, pk: Union[str, UUID]) -> bool:
+    """Delete magiclink in a single statement. Return True only for the caller which actually removed it."""
+    logger.info('Consuming magiclink')
+    return get_storage().consume(pk=pk)
+
+
+def consume_token(*, token: str, max_age: int) -> Optional[dict[str, str]]:
+    """Consume magiclink for opaque token. Return its data (pk, email and next) only for the caller which actually removed it."""
+    logger.info('Consuming magiclink token')
+    return get_storage().consume_token(token_hash=hash_token(token), max_age=max_age)
+
+
+async def aconsume_magiclink(*, pk: Union[str, UUID]) -> bool:
+    """Async version of consume_magiclink."""
+    logger.info('Consuming magiclink')
+    return await get_storage().aconsume(pk=pk)
+
+
+async def aconsume_token(*, token: str, max_age: int) -> Optional[dict[str, str]]:
+    """Async version of consume_token."""
+    logger.info('Consuming magiclink token')
+    return await get_storage().aconsume_token(token_hash=hash_token(token), max_age=max_age)
+
+
+def purge_magiclinks(*, expiry_seconds: int, batch_size: int = 1000) -> int:
+    """Delete expired magiclinks in primary key batches. Return the number of deleted magiclinks."""
+    logger.info('Purging expired magiclinks')
+    cutoff = timeflake_floor(timezone.now() - timedelta(seconds=expiry_seconds))
+    return _delete_in_batches(MagicLink.objects.filter(pk__lt=cutoff), batch_size=batch_size)
+
+
+def revoke_magiclinks(*, emails: Optional[Iterable[str]] = None, users: Optional[QuerySet[AbstractUser]] = None, domain: Optional[str] = None,
+                      created_after: Optional[datetime] = None, created_before: Optional[datetime] = None, batch_size: int = 1000) -> int:
+    """
+    Delete outstanding magiclinks matching all given criteria: E-mails, E-mails of users in queryset, E-mail domain
+    and creation time range. Rows are deleted with set-based statements in batches. Return the number of deleted magiclinks.
+    Storages other than ModelStorage can only revoke by E-mails, other criteria raise ImproperlyConfigured.
+    """
+    if emails is None and users is None and not domain and created_after is None and created_before is None:
+        raise ValueError('At least one revocation criterion is required.')
+
+    logger.info('Revoking magiclinks')
+    storage = get_storage()
+    if not isinstance(storage, ModelStorage):
+        if emails is None or users is not None or domain or created_after is not None or created_before is not None:
+            raise ImproperlyConfigured('{storage} can revoke magiclinks by E-mails only.'.format(storage=type(storage).__name__))
+        return sum(storage.revoke(emails=[email.lower() for email in chunk]) for chunk in chunked(emails, batch_size))
+
+    queryset = MagicLink.objects.all()
+    if users is not None:
+        queryset = queryset.filter(email__in=users.annotate(lower_email=Lower('email')).values('lower_email'))
+    if domain:
+        queryset = queryset.filter(email__endswith='@{domain}'.format(domain=domain.lower()))
+    if created_after is not None:
+        queryset = queryset.filter(pk__gte=timeflake_floor(created_after))
+    if created_before is not None:
+        queryset = queryset.filter(pk__lt=timeflake_floor(created_before))
+
+    if emails is None:
+        return _delete_in_batches(queryset, batch_size=batch_size)
+    return sum(_delete_in_batches(queryset.filter(email__in=[email.lower() for email in chunk]), batch_size=batch_size)
+               for chunk in chunked(emails, batch_size))
+
+
+def _delete_in_batches(queryset: QuerySet[MagicLink], *, batch_size: int) -> int:
+    """Delete queryset by chunks of primary keys, so no statement holds locks for long."""
+    total = 0
+    while True:
+        if connection.vendor == 'mysql':
+            # MySQL does not support LIMIT in IN subqueries
+            batch = MagicLink.objects.filter(pk__in=list(queryset.order_by('pk').values_list('pk', flat=True)[:batch_size]))
+        else:
+            batch = MagicLink.objects.filter(pk__in=queryset.order_by('pk').values('pk')[:batch_size])
+        deleted, _ = batch.delete()
+        if not deleted:
+            return total
+        count_rows(removed=deleted)
+        total += deleted
 
 
 def send_magiclink(*, email: str, magiclink: str, subject: str,
-                   email_templates: tuple[str, str] = ('magiclinks/login_email.txt', 'magiclinks/login_email.html')) -> None:
-    """Send magiclink to E-mail."""
+                   email_templates: tuple[str, str] = ('magiclinks/login_email.txt', 'magiclinks/login_email.html'),
+                   user: Optional[AbstractUser] = None) -> None:
+    """Send magiclink to E-mail. Pass already loaded user to skip the lookup."""
     logger.info('Sending magiclink')
-    user: Optional[AbstractUser] = User.objects.filter(email=email, is_active=True).first()
-    if not user:
+    if user is None:
+        user = User.objects.filter(email=email, is_active=True).first()
+    if not user or not user.is_active:
         return
 
-    context = {
-        'subject': subject,
-        'user': user,
-        'magiclink': magiclink,
-        'style': {
-            'logo_url': '',
-            'background_color': '#ffffff',
-            'main_text_color': '#000000',
-            'button_background_color': '#0078be',
-            'button_text_color': '#ffffff',
-        },
+    with timed('render_email'):
+        message = render_magiclink_email(email=email, user=user, magiclink=magiclink, subject=subject, email_templates=email_templates)
+    if EMAIL_DISPATCH == 'outbox':
+        OutboxEmail.objects.create(**_outbox_fields(message))
+    elif EMAIL_DISPATCH == 'background':
+        get_background_sender().submit(partial(get_connection_pool().send, [message]))
+    elif EMAIL_DISPATCH == 'coalesce':
+        get_coalescing_sender().submit_message(message)
+    else:
+        get_connection_pool().send([message])
+
+
+async def asend_magiclink(*, email: str, magiclink: str, subject: str,
+                          email_templates: tuple[str, str] = ('magiclinks/login_email.txt', 'magiclinks/login_email.html'),
+                          user: Optional[AbstractUser] = None) -> None:
+    """Async version of send_magiclink."""
+    logger.info('Sending magiclink')
+    if user is None:
+        user = await User.objects.filter(email=email, is_active=True).afirst()
+    if not user or not user.is_active:
+        return
+
+    with timed('render_email'):
+        message = render_magiclink_email(email=email, user=user, magiclink=magiclink, subject=subject, email_templates=email_templates)
+    if EMAIL_DISPATCH == 'outbox':
+        await OutboxEmail.objects.acreate(**_outbox_fields(message))
+    elif EMAIL_DISPATCH == 'background':
+        get_background_sender().submit(partial(get_connection_pool().send, [message]))
+    elif EMAIL_DISPATCH == 'coalesce':
+        get_coalescing_sender().submit_message(message)
+    else:
+        await asend_message(message)
+
+
+def _outbox_fields(message: EmailMultiAlternatives) -> dict[str, str]:
+    return {
+        'email': message.to[0],
+        'from_email': str(message.from_email),
+        'subject': str(message.subject),
+        'message': str(message.body),
+        'html_message': str(message.alternatives[0][0]) if message.alternatives else '',
     }
-    plain = render_to_string(email_templates[0], context)
-    html = render_to_string(email_templates[1], context)
-    send_mail(subject=subject, message=plain, recipient_list=[email], from_email=settings.DEFAULT_FROM_EMAIL, html_message=html)
+
+
+def claim_outbox_emails(*, batch_size: int, lease_seconds: int, max_attempts: int) -> list[OutboxEmail]:
+    """Lease a batch of pending outbox e-mails to the current worker."""
+    now = timezone.now()
+    available = Q(locked_until__isnull=True) | Q(locked_until__lt=now)
+    lock_id = uuid4()
+    with transaction.atomic():
+        pks = list(OutboxEmail.objects.select_for_update(skip_locked=True).filter(available, attempts__lt=max_attempts)
+                   .order_by('pk').values_list('pk', flat=True)[:batch_size])
+        # Conditions are checked again, so rows leased by a concurrent worker in the meantime are skipped
+        OutboxEmail.objects.filter(available, pk__in=pks).update(lock_id=lock_id, locked_until=now + timedelta(seconds=lease_seconds),
+                                                                 attempts=F('attempts') + 1)
+    return list(OutboxEmail.objects.filter(lock_id=lock_id).order_by('pk'))
+
+
+def discard_outbox_emails(*, max_attempts: int, batch_size: int) -> int:
+    """Log and delete outbox e-mails which failed max_attempts times and are not leased anymore. Return their number."""
+    available = Q(locked_until__isnull=True) | Q(locked_until__lt=timezone.now())
+    exhausted = list(OutboxEmail.objects.filter(available, attempts__gte=max_attempts).order_by('pk').values_list('pk', flat=True)[:batch_size])
+    if not exhausted:
+        return 0
+    # Recipients are personal data, so only pks of the discarded e-mails are logged
+    logger.error('Giving up on %d outbox e-mails after %d attempts: %s', len(exhausted), max_attempts, ', '.join(str(pk) for pk in exhausted))
+    OutboxEmail.objects.filter(pk__in=exhausted).delete()
+    return len(exhausted)
+
+
+def send_outbox_emails(*, batch_size: int = 100, lease_seconds: int = 60, max_attempts: int = 5) -> int:
+    """
+    Send one batch of outbox e-mails over a pooled mail connection. Return the number of sent e-mails.
+    Delivered e-mails are deleted even if the batch fails later, e-mails out of attempts are discarded first.
+    """
+    discard_outbox_emails(max_attempts=max_attempts, batch_size=batch_size)
+    outbox = claim_outbox_emails(batch_size=batch_size, lease_seconds=lease_seconds, max_attempts=max_attempts)
+    if not outbox:
+        return 0
+
+    logger.info('Sending %d outbox e-mails', len(outbox))
+    messages = []
+    for item in outbox:
+        message = EmailMultiAlternatives(subject=item.subject, body=item.message, from_email=item.from_email, to=[item.email])
+        if item.html_message:
+            message.attach_alternative(item.html_message, 'text/html')
+        messages.append(message)
+    pks = {id(message): item.pk for message, item in zip(messages, outbox)}
+    delivered = []
+    try:
+        with timed(name='send_seconds', span='smtp_send'):
+            for sent in get_connection_pool().send_each(messages):
+                delivered.append(pks[id(sent)])
+    finally:
+        # Failed and unsent e-mails stay leased and are retried once the lease expires
+        OutboxEmail.objects.filter(pk__in=delivered).delete()
+    return len(delivered)
@@ -11,6 +11,72 @@ SIGNUP_LOGIN_REDIRECT_URL: str = getattr(settings, 'MAGICLINKS_SIGNUP_LOGIN_REDI
 
 REGISTRATION_SALT: str = getattr(settings, 'MAGICLINKS_REGISTRATION_SALT', 'magiclinks')
 
+# How long magiclinks stay valid
+EXPIRY_SECONDS: int = getattr(settings, 'MAGICLINKS_EXPIRY_SECONDS', 900)
+
+# 'signed' puts the signed magiclink data into the URL, 'opaque' sends a short random token and keeps the data on the server
+TOKEN_FORMAT: str = getattr(settings, 'MAGICLINKS_TOKEN_FORMAT', 'signed')
+if TOKEN_FORMAT not in ('signed', 'opaque'):
+    raise ImproperlyConfigured('MAGICLINKS_TOKEN_FORMAT must be one of: signed, opaque.')
+
+# Where outstanding magiclinks are kept: 'magiclinks.storage.ModelStorage' or 'magiclinks.storage.CacheStorage'
+STORAGE: str = getattr(settings, 'MAGICLINKS_STORAGE', 'magiclinks.storage.ModelStorage')
+
+# Cache alias used by the cache-backed parts of magiclinks
+CACHE: str = getattr(settings, 'MAGICLINKS_CACHE', 'default')
+
+# Requests allowed per scope as (limit, period in seconds), checked in the cache before any database access.
+# Scopes are 'email', 'ip' and 'global', a missing scope is not limited. Nothing is limited by default.
+# The 'ip' scope needs MAGICLINKS_RATELIMIT_IP_META behind a reverse proxy, otherwise all clients share the proxy address.
+RATELIMITS: dict[str, tuple[int, int]] = getattr(settings, 'MAGICLINKS_RATELIMITS', {})
+if set(RATELIMITS) - {'email', 'ip', 'global'}:
+    raise ImproperlyConfigured('MAGICLINKS_RATELIMITS scopes must be: email, ip, global.')
+
+# request.META key holding the client IP address, e.g. 'HTTP_X_REAL_IP' behind a reverse proxy
+RATELIMIT_IP_META: str = getattr(settings, 'MAGICLINKS_RATELIMIT_IP_META', 'REMOTE_ADDR')
+
+# Replace magiclinks with a single INSERT ... ON CONFLICT statement on PostgreSQL and SQLite
+UPSERT: bool = getattr(settings, 'MAGICLINKS_UPSERT', True)
+
 CREATE_USER_CALLABLE: str = getattr(settings, 'MAGICLINKS_CREATE_USER_CALLABLE', '')
 if not CREATE_USER_CALLABLE:
     raise ImproperlyConfigured('Please, set MAGICLINKS_CREATE_USER_CALLABLE in your settings.py module.')
+
+# Optional 'module:function' creating users for a list of E-mails at once (emails=...), used by bulk issuance
+CREATE_USERS_CALLABLE: str = getattr(settings, 'MAGICLINKS_CREATE_USERS_CALLABLE', '')
+
+# 'sync' sends e-mail inside the request, 'background' hands it over to an in-process worker pool,
+# 'outbox' stores it in the database for the send_magiclink_outbox management command
+EMAIL_DISPATCH: str = getattr(settings, 'MAGICLINKS_EMAIL_DISPATCH', 'sync')
+if EMAIL_DISPATCH not in ('sync', 'background', 'coalesce', 'outbox'):
+    raise ImproperlyConfigured('MAGICLINKS_EMAIL_DISPATCH must be one of: sync, background, coalesce, outbox.')
+
+EMAIL_QUEUE_SIZE: int = getattr(settings, 'MAGICLINKS_EMAIL_QUEUE_SIZE', 1000)
+
+EMAIL_WORKERS: int = getattr(settings, 'MAGICLINKS_EMAIL_WORKERS', 2)
+
+# 'coalesce' dispatch sends queued e-mails with one send_messages() call once this many are collected...
+EMAIL_BATCH_SIZE: int = getattr(settings, 'MAGICLINKS_EMAIL_BATCH_SIZE', 100)
+
+# ...or this many seconds after the first of them was queued
+EMAIL_BATCH_LATENCY: float = getattr(settings, 'MAGICLINKS_EMAIL_BATCH_LATENCY', 0.05)
+
+# What to do when the queue is full: 'inline' sends in the request thread, 'block' waits for a free slot, 'drop' discards the message
+EMAIL_QUEUE_OVERFLOW: str = getattr(settings, 'MAGICLINKS_EMAIL_QUEUE_OVERFLOW', 'inline')
+if EMAIL_QUEUE_OVERFLOW not in ('inline', 'block', 'drop'):
+    raise ImproperlyConfigured('MAGICLINKS_EMAIL_QUEUE_OVERFLOW must be one of: inline, block, drop.')
+
+# Dotted path of the class receiving counters and timings, see magiclinks.metrics.MetricsSink. The default one discards them
+METRICS_SINK: str = getattr(settings, 'MAGICLINKS_METRICS_SINK', 'magiclinks.metrics.MetricsSink')
+
+# Dotted path of the class creating spans of the magiclink flow, e.g. 'magiclinks.tracing.OpenTelemetryTracer'. The default one does nothing
+TRACER: str = getattr(settings, 'MAGICLINKS_TRACER', 'magiclinks.tracing.Tracer')
+
+# Add metrics/ URL exposing counters of magiclinks.metrics.CacheMetricsSink in the Prometheus text format
+METRICS_VIEW: bool = getattr(settings, 'MAGICLINKS_METRICS_VIEW', False)
+
+# Number of idle mail connections kept open per process and reused for magiclink e-mails, 0 opens a new connection for every e-mail
+EMAIL_POOL_SIZE: int = getattr(settings, 'MAGICLINKS_EMAIL_POOL_SIZE', 2)
+
+# Idle connections older than this many seconds are closed instead of reused
+EMAIL_POOL_IDLE_TIMEOUT: float = getattr(settings, 'MAGICLINKS_EMAIL_POOL_IDLE_TIMEOUT', 30)
@@ -0,0 +1,58 @@
+from __future__ import annotations
+
+from asgiref.sync import sync_to_async
+from django.apps import apps
+from django.conf import settings
+from django.contrib.sites.shortcuts import get_current_site
+from django.db.models.signals import post_delete, post_save
+from django.http import HttpRequest
+
+# Domain of the current Site by SITE_ID, or by request host without SITE_ID, filled on first use in every process
+SITE_DOMAINS: dict[str, str] = {}
+# Hosts differing only in port resolve to the same Site, so the number of cached hosts is capped as well
+SITE_DOMAINS_SIZE: int = 1000
+
+
+def get_site_domain(request: HttpRequest) -> str:
+    """Return domain magiclinks are built for. Without django.contrib.sites it is the request host."""
+    if not apps.is_installed('django.contrib.sites'):
+        # Domain of RequestSite, nothing to cache
+        return request.get_host()
+    key = _site_key(request)
+    try:
+        return SITE_DOMAINS[key]
+    except KeyError:
+        pass
+    domain = str(get_current_site(request).domain)
+    if len(SITE_DOMAINS) < SITE_DOMAINS_SIZE:
+        SITE_DOMAINS[key] = domain
+    return domain
+
+
+async def aget_site_domain(request: HttpRequest) -> str:
+    """Async version of get_site_domain. Only the first lookup of a site may query the database."""
+    if not apps.is_installed('django.contrib.sites'):
+        return request.get_host()
+    try:
+        return SITE_DOMAINS[_site_key(request)]
+    except KeyError:
+        pass
+    return await sync_to_async(get_site_domain)(request)
+
+
+def _site_key(request: HttpRequest) -> str:
+    # Only hosts of existing Sites are cached, lookups of unknown hosts raise Site.DoesNotExist
+    site_id = getattr(settings, 'SITE_ID', None)
+    return 'id:{site_id}'.format(site_id=site_id) if site_id else 'host:{host}'.format(host=request.get_host())
+
+
+def clear_site_domains(**kwargs) -> None:
+    SITE_DOMAINS.clear()
+
+
+def connect_signals() -> None:
+    """Forget cached domains whenever a Site changes."""
+    if apps.is_installed('django.contrib.sites'):
+        from django.contrib.sites.models import Site
+        post_save.connect(clear_site_domains, sender=Site, dispatch_uid='magiclinks_clear_site_domains')
+        post_delete.connect(clear_site_domains, sender=Site, dispatch_uid='magiclinks_clear_site_domains_delete')
@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+from typing import TYPE_CHECKING, Optional, Sequence, Union, cast
+from uuid import UUID
+
+from asgiref.sync import sync_to_async
+from django.core.cache import caches
+from django.db import IntegrityError, connection, transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .exceptions import MagicLinkError
+from .metrics import get_metrics, increment
+from .models import MagicLink
+from .settings import CACHE, EXPIRY_SECONDS, STORAGE, UPSERT
+from .utils import generate_timeflake, hash_token
+
+if TYPE_CHECKING:
+    from django.db.backends.sqlite3.base import DatabaseWrapper as SQLiteDatabaseWrapper
+
+PK = Union[str, UUID]
+TokenData = dict[str, str]
+
+
+def _quoted_column(name: str) -> str:
+    """Return quoted column of MagicLink field, concrete fields always have one."""
+    column = next(field.column for field in MagicLink._meta.concrete_fields if field.name == name)
+    return connection.ops.quote_name(cast(str, column))
+
+
+class BaseStorage:
+    """Keeps outstanding magiclinks. Every E-mail has at most one magiclink."""
+
+    def create(self, *, email: str, limit_seconds: int, token_hash: Optional[str] = None, next_url: str = '') -> str:
+        """
+        Store new magiclink for E-mail replacing the old one. Return its pk. Raise MagicLinkError if the old one is too recent.
+        token_hash and next_url are stored for opaque tokens only.
+        """
+        raise NotImplementedError
+
+    def create_many(self, *, emails: Sequence[str], token_hashes: Optional[Sequence[str]] = None, next_url: str = '') -> list[str]:
+        """Store new magiclinks for distinct E-mails replacing old ones regardless of their age. Return their pks in the same order."""
+        return [self.create(email=email, limit_seconds=0, token_hash=token_hashes[number] if token_hashes else None, next_url=next_url)
+                for number, email in enumerate(emails)]
+
+    def delete(self, *, pk: Optional[PK] = None, email: Optional[str] = None) -> None:
+        raise NotImplementedError
+
+    def revoke(self, *, emails: Sequence[str]) -> int:
+        """Delete magiclinks of lowercased E-mails. Return the number of deleted magiclinks."""
+        raise NotImplementedError
+
+    def consume(self, *, pk: PK) -> bool:
+        """Delete magiclink. Return True only for the caller which actually removed it."""
+        raise NotImplementedError
+
+    def consume_token(self, *, token_hash: str, max_age: int) -> Optional[TokenData]:
+        """Delete magiclink created for opaque token within max_age seconds. Return its data only for the caller which actually removed it."""
+        raise NotImplementedError
+
+    async def acreate(self, *, email: str, limit_seconds: int, token_hash: Optional[str] = None, next_url: str = '') -> str:
+        pk: str = await sync_to_async(self.create)(email=email, limit_seconds=limit_seconds, token_hash=token_hash, next_url=next_url)
+        return pk
+
+    async def adelete(self, *, pk: Optional[PK] = None, email: Optional[str] = None) -> None:
+        await sync_to_async(self.delete)(pk=pk, email=email)
+
+    async def aconsume(self, *, pk: PK) -> bool:
+        consumed: bool = await sync_to_async(self.consume)(pk=pk)
+        return consumed
+
+    async def aconsume_token(self, *, token_hash: str, max_age: int) -> Optional[TokenData]:
+        data: Optional[TokenData] = await sync_to_async(self.consume_token)(token_hash=token_hash, max_age=max_age)
+        return data
+
+
+def count_rows(*, created: int = 0, removed: int = 0) -> None:
+    """Count stored and deleted MagicLink rows, so the number of outstanding magiclinks is known without COUNT(*)."""
+    if created:
+        increment('links_created', created)
+    if removed:
+        increment('links_removed', removed)
+
+
+class ModelStorage(BaseStorage):
+    """Store magiclinks in the database using MagicLink model."""
+
+    def create(self, *, email: str, limit_seconds: int, token_hash: Optional[str] = None, next_url: str = '') -> str:
+        now = timezone.now()
+        magiclink = MagicLink(email=email, date_created=now, token_hash=token_hash, next_url=next_url)
+        limit = now - timedelta(seconds=limit_seconds)
+        if UPSERT and self._supports_upsert():
+            replaced = self._upsert(magiclink=magiclink, limit=limit)
+        else:
+            replaced = self._replace(magiclink=magiclink, limit=limit)
+        count_rows(created=1, removed=replaced)
+        return str(magiclink.pk)
+
+    def create_many(self, *, emails: Sequence[str], token_hashes: Optional[Sequence[str]] = None, next_url: str = '') -> list[str]:
+        now = timezone.now()
+        magiclinks = [MagicLink(email=email, date_created=now, token_hash=token_hashes[number] if token_hashes else None, next_url=next_url)
+                      for number, email in enumerate(emails)]
+        # One DELETE and one INSERT for the whole chunk
+        with transaction.atomic():
+            deleted, _ = MagicLink.objects.filter(email__in=emails).delete()
+            MagicLink.objects.bulk_create(magiclinks)
+        count_rows(created=len(magiclinks), removed=deleted)
+        return [str(magiclink.pk) for magiclink in magiclinks]
+
+    def delete(self, *, pk: Optional[PK] = None, email: Optional[str] = None) -> None:
+        if pk:
+            deleted, _ = MagicLink.objects.filter(pk=pk).delete()
+        else:
+            deleted, _ = MagicLink.objects.filter(email=email).delete()
+        count_rows(removed=deleted)
+
+    def consume(self, *, pk: PK) -> bool:
+        deleted, _ = MagicLink.objects.filter(pk=pk).delete()
+        count_rows(removed=deleted)
+        return deleted > 0
+
+    def consume_token(self, *, token_hash: str, max_age: int) -> Optional[TokenData]:
+        limit = timezone.now() - timedelta(seconds=max_age)
+        if self._supports_delete_returning():
+            data = self._delete_returning(token_hash=token_hash, limit=limit)
+            count_rows(removed=int(data is not None))
+            return data
+
+        row = MagicLink.objects.filter(token_hash=token_hash, date_created__gte=limit).values_list('pk', 'email', 'next_url').first()
+        if row is None or not self.consume(pk=row[0]):
+            return None
+        return {'pk': str(row[0]), 'email': row[1], 'next': row[2]}
+
+    async def acreate(self, *, email: str, limit_seconds: int, token_hash: Optional[str] = None, next_url: str = '') -> str:
+        now = timezone.now()
+        magiclink = MagicLink(email=email, date_created=now, token_hash=token_hash, next_url=next_url)
+        limit = now - timedelta(seconds=limit_seconds)
+        if UPSERT and self._supports_upsert():
+            # Raw SQL has no async API, but the upsert is a single statement
+            replaced: int = await sync_to_async(self._upsert)(magiclink=magiclink, limit=limit)
+        else:
+            if await MagicLink.objects.filter(email=email, date_created__gte=limit).aexists():
+                raise MagicLinkError('Too many magic login requests')
+            replaced, _ = await MagicLink.objects.filter(email=email).adelete()
+            try:
+                await magiclink.asave(force_insert=True)
+            except IntegrityError:
+                count_rows(removed=replaced)
+                raise MagicLinkError('Too many magic login requests')
+        count_rows(created=1, removed=replaced)
+        return str(magiclink.pk)
+
+    async def adelete(self, *, pk: Optional[PK] = None, email: Optional[str] = None) -> None:
+        if pk:
+            deleted, _ = await MagicLink.objects.filter(pk=pk).adelete()
+        else:
+            deleted, _ = await MagicLink.objects.filter(email=email).adelete()
+        count_rows(removed=deleted)
+
+    async def aconsume(self, *, pk: PK) -> bool:
+        deleted, _ = await MagicLink.objects.filter(pk=pk).adelete()
+        count_rows(removed=deleted)
+        return deleted > 0
+
+    async def aconsume_token(self, *, token_hash: str, max_age: int) -> Optional[TokenData]:
+        limit = timezone.now() - timedelta(seconds=max_age)
+        if self._supports_delete_returning():
+            data: Optional[TokenData] = await sync_to_async(self._delete_returning)(token_hash=token_hash, limit=limit)
+            count_rows(removed=int(data is not None))
+            return data
+
+        row = await MagicLink.objects.filter(token_hash=token_hash, date_created__gte=limit).values_list('pk', 'email', 'next_url').afirst()
+        if row is None or not await self.aconsume(pk=row[0]):
+            return None
+        return {'pk': str(row[0]), 'email': row[1], 'next': row[2]}
+
+    @staticmethod
+    def _supports_upsert() -> bool:
+        if connection.vendor == 'postgresql':
+            return True
+        if connection.vendor != 'sqlite':
+            return False
+        version = cast('SQLiteDatabaseWrapper', connection).Database.sqlite_version_info
+        # Before RETURNING, SQLite cannot tell whether the upsert replaced a row, which counted metrics need
+        return version >= (3, 35, 0) or (version >= (3, 24, 0) and not get_metrics().enabled)
+
+    @staticmethod
+    def _supports_delete_returning() -> bool:
+        if connection.vendor == 'postgresql':
+            return True
+        return connection.vendor == 'sqlite' and cast('SQLiteDatabaseWrapper', connection).Database.sqlite_version_info >= (3, 35, 0)
+
+    @staticmethod
+    def _upsert(*, magiclink: MagicLink, limit: datetime) -> int:
+        """Insert magiclink or replace the existing one created before limit, in a single statement. Return the number of replaced rows."""
+        qn = connection.ops.quote_name
+        opts = MagicLink._meta
+        table = qn(opts.db_table)
+        fields = [opts.pk, opts.get_field('email'), opts.get_field('date_created'), opts.get_field('token_hash'), opts.get_field('next_url')]
+        columns = [_quoted_column(field.name) for field in fields]
+        values = ['%s'] * len(fields)
+        updates = ['{column} = excluded.{column}'.format(column=column) for field, column in zip(fields, columns) if field.name != 'email']
+        returning = ''
+        if connection.vendor == 'postgresql':
+            # xmax of a freshly inserted row is zero
+            returning = ' RETURNING (xmax = 0)'
+        elif cast('SQLiteDatabaseWrapper', connection).Database.sqlite_version_info >= (3, 35, 0):
+            # An insert gets a rowid above every stored one in absolute value and a replacement negates it, so the sign tells them apart
+            columns.insert(0, 'rowid')
+            values.insert(0, '(SELECT MAX(COALESCE(MAX(rowid), 0), -COALESCE(MIN(rowid), 0)) + 1 FROM {table})'.format(table=table))
+            updates.append('rowid = -excluded.rowid')
+            returning = ' RETURNING (rowid > 0)'
+        sql = ('INSERT INTO {table} ({columns}) VALUES ({values}) '
+               'ON CONFLICT ({email}) DO UPDATE SET {updates} '
+               'WHERE {table}.{date_created} < %s{returning}').format(table=table, columns=', '.join(columns), values=', '.join(values),
+                                                                      email=_quoted_column('email'), updates=', '.join(updates),
+                                                                      date_created=_quoted_column('date_created'), returning=returning)
+        params = [field.get_db_prep_save(getattr(magiclink, field.attname), connection) for field in fields]
+        params.append(fields[2].get_db_prep_value(limit, connection))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if not returning:
+                if not cursor.rowcount:
+                    raise MagicLinkError('Too many magic login requests')
+                return 0
+            row = cursor.fetchone()
+        if row is None:
+            raise MagicLinkError('Too many magic login requests')
+        return int(not row[0])
+
+    @staticmethod
+    def _delete_returning(*, token_hash: str, limit: datetime) -> Optional[TokenData]:
+        """Delete magiclink for token and read its data in a single statement."""
+        qn = connection.ops.quote_name
+        opts = MagicLink._meta
+        sql = 'DELETE FROM {table} WHERE {token_hash} = %s AND {date_created} >= %s RETURNING {id}, {email}, {next_url}'.format(
+            table=qn(opts.db_table), token_hash=_quoted_column('token_hash'), date_created=_quoted_column('date_created'),
+            id=_quoted_column(opts.pk.name), email=_quoted_column('email'), next_url=_quoted_column('next_url'))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [token_hash, opts.get_field('date_created').get_db_prep_value(limit, connection)])
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        pk = row[0] if isinstance(row[0], UUID) else UUID(row[0])
+        return {'pk': str(pk), 'email': row[1], 'next': row[2]}
+
+    def _replace(self, *, magiclink: MagicLink, limit: datetime) -> int:
+        """Check limit, delete old magiclink and insert the new one for databases without upsert support. Return the number of replaced rows."""
+        try:
+            with transaction.atomic():
+                if MagicLink.objects.filter(email=magiclink.email, date_created__gte=limit).exists():
+                    raise MagicLinkError('Too many magic login requests')
+                replaced, _ = MagicLink.objects.filter(email=magiclink.email).delete()
+                magiclink.save(force_insert=True)
+        except IntegrityError:
+            # Concurrent request for the same E-mail has just created its magiclink
+            raise MagicLinkError('Too many magic login requests')
+        return replaced
+
+
+class CacheStorage(BaseStorage):
+    """
+    Store magiclinks in Django cache, so they never touch the database.
+    Entries expire after MAGICLINKS_EXPIRY_SECONDS, cache delete makes every magiclink single-use.
+    """
+    key_prefix: str = 'magiclinks'
+
+    def __init__(self, alias: str = CACHE, timeout: int = EXPIRY_SECONDS) -> None:
+        self.cache = caches[alias]
+        self.timeout = timeout
+
+    def _pk_key(self, pk: PK) -> str:
+        return '{prefix}:pk:{pk}'.format(prefix=self.key_prefix, pk=str(pk))
+
+    def _token_key(self, token_hash: str) -> str:
+        return '{prefix}:token:{token_hash}'.format(prefix=self.key_prefix, token_hash=token_hash)
+
+    # E-mails are hashed to keep keys short, memcached limits them to 250 bytes
+    def _email_key(self, email: str) -> str:
+        return '{prefix}:email:{email}'.format(prefix=self.key_prefix, email=hash_token(email))
+
+    def _limit_key(self, email: str) -> str:
+        return '{prefix}:limit:{email}'.format(prefix=self.key_prefix, email=hash_token(email))
+
+    def create(self, *, email: str, limit_seconds: int, token_hash: Optional[str] = None, next_url: str = '') -> str:
+        if limit_seconds > 0 and not self.cache.add(self._limit_key(email), 1, timeout=limit_seconds):
+            raise MagicLinkError('Too many magic login requests')
+
+        # E-mail entry points to the key of its current magiclink
+        old_key: Optional[str] = self.cache.get(self._email_key(email))
+        if old_key:
+            self.cache.delete(old_key)
+
+        pk = str(generate_timeflake())
+        key = self._token_key(token_hash) if token_hash else self._pk_key(pk)
+        data = {'pk': pk, 'email': email, 'next': next_url, 'created': str(time.time())}
+        self.cache.set_many({key: data, self._email_key(email): key}, timeout=self.timeout)
+        return pk
+
+    def delete(self, *, pk: Optional[PK] = None, email: Optional[str] = None) -> None:
+        if pk:
+            self.cache.delete(self._pk_key(pk))
+        elif email:
+            old_key: Optional[str] = self.cache.get(self._email_key(email))
+            keys = [self._email_key(email)]
+            if old_key:
+                keys.append(old_key)
+            self.cache.delete_many(keys)
+
+    def revoke(self, *, emails: Sequence[str]) -> int:
+        email_keys = [self._email_key(email) for email in emails]
+        # E-mail entries point to the keys of current magiclinks
+        keys: list[str] = list(self.cache.get_many(email_keys).values())
+        self.cache.delete_many(email_keys + keys)
+        return len(keys)
+
+    def consume(self, *, pk: PK) -> bool:
+        return self._pop(self._pk_key(pk)) is not None
+
+    def consume_token(self, *, token_hash: str, max_age: int) -> Optional[TokenData]:
+        data = self._pop(self._token_key(token_hash))
+        if data is None or time.time() - float(data.pop('created')) > max_age:
+            return None
+        return data
+
+    async def acreate(self, *, email: str, limit_seconds: int, token_hash: Optional[str] = None, next_url: str = '') -> str:
+        if limit_seconds > 0 and not await self.cache.aadd(self._limit_key(email), 1, timeout=limit_seconds):
+            raise MagicLinkError('Too many magic login requests')
+
+        old_key: Optional[str] = await self.cache.aget(self._email_key(email))
+        if old_key:
+            await self.cache.adelete(old_key)
+
+        pk = str(generate_timeflake())
+        key = self._token_key(token_hash) if token_hash else self._pk_key(pk)
+        data = {'pk': pk, 'email': email, 'next': next_url, 'created': str(time.time())}
+        await self.cache.aset_many({key: data, self._email_key(email): key}, timeout=self.timeout)
+        return pk
+
+    async def adelete(self, *, pk: Optional[PK] = None, email: Optional[str] = None) -> None:
+        if pk:
+            await self.cache.adelete(self._pk_key(pk))
+        elif email:
+            old_key: Optional[str] = await self.cache.aget(self._email_key(email))
+            keys = [self._email_key(email)]
+            if old_key:
+                keys.append(old_key)
+            await self.cache.adelete_many(keys)
+
+    async def aconsume(self, *, pk: PK) -> bool:
+        return await self._apop(self._pk_key(pk)) is not None
+
+    async def aconsume_token(self, *, token_hash: str, max_age: int) -> Optional[TokenData]:
+        data = await self._apop(self._token_key(token_hash))
+        if data is None or time.time() - float(data.pop('created')) > max_age:
+            return None
+        return data
+
+    def _pop(self, key: str) -> Optional[TokenData]:
+        data: Optional[TokenData] = self.cache.get(key)
+        # Some backends (e.g. locmem) report expired keys as deleted, so check the key is still alive first
+        if data is None or not self.cache.delete(key):
+            return None
+        return data
+
+    async def _apop(self, key: str) -> Optional[TokenData]:
+        data: Optional[TokenData] = await self.cache.aget(key)
+        if data is None or not await self.cache.adelete(key):
+            return None
+        return data
+
+
+@lru_cache(maxsize=None)
+def get_storage() -> BaseStorage:
+    """Return storage configured with MAGICLINKS_STORAGE."""
+    storage: BaseStorage = import_string(STORAGE)()
+    return storage
@@ -0,0 +1,107 @@
+from __future__ import annotations
+
+import time
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from functools import lru_cache
+from types import ModuleType
+from typing import TYPE_CHECKING, Callable, Iterator, Optional, Sequence, TypeVar, cast
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+from .settings import TRACER
+
+otel_context: Optional[ModuleType]
+trace: Optional[ModuleType]
+try:
+    from opentelemetry import context as otel_context
+    from opentelemetry import trace
+except ImportError:  # pragma: no cover
+    otel_context = trace = None
+
+if TYPE_CHECKING:
+    from opentelemetry.context import Context
+    from opentelemetry.util.types import Attributes
+
+T = TypeVar('T')
+
+
+class Tracer:
+    """
+    Creates spans of the magiclink flow. This default one does nothing, set MAGICLINKS_TRACER to record them.
+
+    Contexts returned by capture() are opaque, they are passed back to attach() and to links of span(), possibly in another thread.
+    """
+    enabled: bool = False
+
+    def span(self, name: str, *, links: Sequence[object] = (), **attributes: object) -> AbstractContextManager[object]:
+        """Child span of the current one, covering the block."""
+        return nullcontext()
+
+    def capture(self) -> object:
+        """Return the current trace context."""
+        return None
+
+    def attach(self, context: object) -> AbstractContextManager[object]:
+        """Make captured context the current one within the block."""
+        return nullcontext()
+
+    def record(self, name: str, *, start_time: int, end_time: int, **attributes: object) -> None:
+        """Record finished child span of the current one. Times are in nanoseconds since the epoch."""
+
+
+class OpenTelemetryTracer(Tracer):
+    """Tracer creating OpenTelemetry spans with the globally configured tracer provider. Needs opentelemetry-api."""
+    enabled = True
+
+    def __init__(self, name: str = 'magiclinks') -> None:
+        if trace is None or otel_context is None:
+            raise ImproperlyConfigured('OpenTelemetryTracer needs opentelemetry-api installed.')
+        self.trace: ModuleType = trace
+        self.context: ModuleType = otel_context
+        self.tracer = trace.get_tracer(name)
+
+    def span(self, name: str, *, links: Sequence[object] = (), **attributes: object) -> AbstractContextManager[object]:
+        # Contexts are opaque to callers, they were captured by this tracer
+        span_links = [self.trace.Link(self.trace.get_current_span(cast('Context', context)).get_span_context()) for context in links]
+        return self.tracer.start_as_current_span(name, links=span_links, attributes=cast('Attributes', attributes))
+
+    def capture(self) -> object:
+        return self.context.get_current()
+
+    @contextmanager
+    def attach(self, context: object) -> Iterator[None]:
+        token = self.context.attach(cast('Context', context))
+        try:
+            yield
+        finally:
+            self.context.detach(token)
+
+    def record(self, name: str, *, start_time: int, end_time: int, **attributes: object) -> None:
+        self.tracer.start_span(name, start_time=start_time, attributes=cast('Attributes', attributes)).end(end_time=end_time)
+
+
+@lru_cache(maxsize=None)
+def get_tracer() -> Tracer:
+    """Return tracer configured with MAGICLINKS_TRACER."""
+    tracer: Tracer = import_string(TRACER)()
+    return tracer
+
+
+def propagate(job: Callable[[], T], *, name: str = 'magiclinks.email_queued') -> Callable[[], T]:
+    """
+    Wrap job queued for a worker thread, so it continues the current trace.
+    The time it waits in the queue is recorded as span `name`.
+    """
+    tracer = get_tracer()
+    if not tracer.enabled:
+        return job
+    context = tracer.capture()
+    queued = time.time_ns()
+
+    def traced() -> T:
+        with tracer.attach(context):
+            tracer.record(name, start_time=queued, end_time=time.time_ns())
+            return job()
+
+    return traced
@@ -2,7 +2,8 @@ from __future__ import annotations
 
 from django.urls import path
 
-from .views import LoginSentView, LoginVerifyView, LoginView, LogoutView, SignupView
+from .settings import METRICS_VIEW
+from .views import LoginSentView, LoginVerifyView, LoginView, LogoutView, MetricsView, SignupView
 
 app_name = "magiclinks"
 
@@ -13,3 +14,6 @@ urlpatterns = [
     path('login/verify/', LoginVerifyView.as_view(), name='login_verify'),
     path('logout/', LogoutView.as_view(), name='logout'),
 ]
+
+if METRICS_VIEW:
+    urlpatterns.append(path('metrics/', MetricsView.as_view(), name='metrics'))
@@ -1,10 +1,24 @@
 from __future__ import annotations
 
+import hashlib
+import sys
+from datetime import datetime
+from functools import lru_cache
+from importlib import import_module
+from itertools import islice
+from typing import Iterable, Iterator, Optional, Protocol, TypeVar
+from urllib.parse import urljoin
 from uuid import UUID
 
 import timeflake
-from django.urls import reverse
+from django.core.exceptions import ImproperlyConfigured
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.urls import get_script_prefix, get_urlconf, reverse
 from django.urls.exceptions import NoReverseMatch
+from django.utils.translation import get_language
+
+T = TypeVar('T')
 
 
 def generate_timeflake() -> UUID:
@@ -12,12 +26,86 @@ def generate_timeflake() -> UUID:
     return timeflake.random().uuid
 
 
+def timeflake_floor(moment: datetime) -> UUID:
+    """Return the smallest timeflake UUID generated at given moment. Timeflakes are ordered by time, so it bounds PK ranges."""
+    return timeflake.from_values(int(moment.timestamp() * 1000), 0).uuid
+
+
+def hash_token(token: str) -> str:
+    """Return hash under which an opaque token is stored."""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
 def get_url_path(url: str) -> str:
     """
     url can either be a url name or a url path. First try and reverse a URL,
-    if this does not exist then assume it's a url path
+    if this does not exist then assume it's a url path. Results are cached per urlconf, script prefix and language
+    (i18n_patterns URLs are prefixed with it).
     """
+    return _resolve_url_path(url, get_urlconf(), get_script_prefix(), get_language())
+
+
+@lru_cache(maxsize=256)
+def _resolve_url_path(url: str, urlconf: Optional[str], script_prefix: str, language: Optional[str]) -> str:
     try:
-        return reverse(url)
+        return reverse(url, urlconf=urlconf)
     except NoReverseMatch:
         return url
+
+
+def get_verify_url(*, domain: str, url_name: str) -> str:
+    """Return absolute URL of the verify view on domain, without query. Results are cached like get_url_path."""
+    return _build_verify_url(domain, url_name, get_urlconf(), get_script_prefix(), get_language())
+
+
+@lru_cache(maxsize=256)
+def _build_verify_url(domain: str, url_name: str, urlconf: Optional[str], script_prefix: str, language: Optional[str]) -> str:
+    return urljoin('https://{domain}'.format(domain=domain), reverse(url_name, urlconf=urlconf))
+
+
+@receiver(setting_changed)
+def clear_url_paths(*, setting: str, **kwargs) -> None:
+    if setting in ('ROOT_URLCONF', 'FORCE_SCRIPT_NAME'):
+        _resolve_url_path.cache_clear()
+        _build_verify_url.cache_clear()
+
+
+class UserCreator(Protocol):
+    """Callable creating users, MAGICLINKS_CREATE_USER(S)_CALLABLE are called with keyword arguments only."""
+
+    def __call__(self, **kwargs: object) -> object: ...
+
+
+@lru_cache(maxsize=None)
+def load_callable(path: str) -> UserCreator:
+    """Import callable given as 'module:function' once per process. Raise ImproperlyConfigured if it does not exist."""
+    module_name, separator, callable_name = path.partition(':')
+    if not separator:
+        raise ImproperlyConfigured('{path} is not in "module:function" format.'.format(path=path))
+    try:
+        func = getattr(import_module(module_name), callable_name)
+    except (ImportError, AttributeError) as e:
+        raise ImproperlyConfigured('Cannot import {path}: {error}'.format(path=path, error=e))
+    if not callable(func):
+        raise ImproperlyConfigured('{path} is not callable.'.format(path=path))
+    return func
+
+
+def chunked(iterable: Iterable[T], size: int) -> Iterator[list[T]]:
+    """Split iterable into lists of at most size items without loading it into memory."""
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
+
+
+def read_emails(path: str) -> Iterator[str]:
+    """Yield non-empty lines of file at path ("-" reads standard input) one at a time."""
+    lines = sys.stdin if path == '-' else open(path)
+    try:
+        for line in lines:
+            email = line.strip()
+            if email:
+                yield email
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
@@ -1,16 +1,15 @@
 from __future__ import annotations
 
 import logging
-from importlib import import_module
+from contextlib import nullcontext
 from urllib.parse import unquote_plus
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import authenticate, get_user_model, login, logout
 from django.contrib.auth.decorators import user_passes_test
-from django.contrib.sites.shortcuts import get_current_site
-from django.core import signing
-from django.http import HttpResponse, HttpResponseRedirect
+from django.db import transaction
+from django.http import Http404, HttpRequest, HttpResponse, HttpResponseRedirect
 from django.utils.decorators import method_decorator
 from django.utils.http import url_has_allowed_host_and_scheme
 from django.views import View
@@ -19,18 +18,54 @@ from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.debug import sensitive_post_parameters
 from django.views.generic import TemplateView
 
+from .backends import get_magiclink_data
 from .exceptions import MagicLinkError
 from .forms import LoginForm, SignupForm
-from .services import create_magiclink, send_magiclink
-from .settings import CREATE_USER_CALLABLE, LOGIN_SENT_REDIRECT_URL, REGISTRATION_SALT, SIGNUP_LOGIN_REDIRECT_URL
+from .metrics import CacheMetricsSink, get_metrics, render_prometheus, timed
+from .services import create_magiclink, create_user, send_magiclink
+from .settings import EMAIL_DISPATCH, EXPIRY_SECONDS, LOGIN_SENT_REDIRECT_URL, SIGNUP_LOGIN_REDIRECT_URL
+from .sites import get_site_domain
+from .storage import ModelStorage, get_storage
 from .utils import get_url_path
 
 User = get_user_model()
 logger = logging.getLogger(__name__)
 
 
+class IssueMagicLinkMixin:
+    """Create magiclink and send it by e-mail. Shared by login and signup views."""
+    login_verify_url_name: str
+    limit_seconds: int
+    subject: str
+    email_templates: tuple[str, str]
+    next_page: str
+
+    def issue_magiclink(self, request, *, email: str, next_url: str, user=None) -> None:
+        # Outbox e-mail is stored in the same transaction as the magiclink
+        with transaction.atomic() if EMAIL_DISPATCH == 'outbox' else nullcontext():
+            magiclink = create_magiclink(email=email, domain=get_site_domain(request), url_name=self.login_verify_url_name,
+                                         next_url=next_url, limit_seconds=self.limit_seconds)
+            send_magiclink(email=email, magiclink=magiclink, subject=self.subject, email_templates=self.email_templates, user=user)
+
+    def get_next_url(self, request, default: str) -> str:
+        redirect_to: str = request.POST.get('next', request.GET.get('next', ''))
+        url_is_safe: bool = url_has_allowed_host_and_scheme(url=redirect_to, allowed_hosts={request.get_host()}, require_https=True)
+        return redirect_to if url_is_safe else get_url_path(default)
+
+    def get_success_response(self, request) -> HttpResponse:
+        success_url: str = get_url_path(self.next_page)
+
+        if request.META.get("HTTP_HX_REQUEST") != 'true':
+            return HttpResponseRedirect(success_url)
+
+        # htmx request
+        response: HttpResponse = HttpResponse()
+        response.headers['HX-Redirect'] = success_url
+        return response
+
+
 @method_decorator((user_passes_test(lambda u: not u.is_authenticated, login_url='/'), sensitive_post_parameters(), csrf_protect, never_cache), name='dispatch')
-class LoginView(TemplateView):
+class LoginView(IssueMagicLinkMixin, TemplateView):
     form = LoginForm
     limit_seconds: int = 3
     subject: str = 'Your login magic link'
@@ -39,43 +74,31 @@ class LoginView(TemplateView):
     email_templates: tuple[str, str] = ('magiclinks/login_email.txt', 'magiclinks/login_email.html')
     next_page: str = LOGIN_SENT_REDIRECT_URL
 
-    def get(self, request, *args, **kwargs):
+    def get(self, request: HttpRequest, *args: object, **kwargs: object) -> HttpResponse:
         context = self.get_context_data(**kwargs)
         context['login_form'] = self.form()
         return self.render_to_response(context)
 
     def post(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
-        form = self.form(request.POST)
-        if not form.is_valid():
+        form = self.form(request.POST, request=request)
+        with timed('form_validation'):
+            valid = form.is_valid()
+        if not valid:
             context['login_form'] = form
             return self.render_to_response(context)
 
         email = form.cleaned_data['email']
-
-        redirect_to: str = request.POST.get('next', request.GET.get('next', ''))
-        url_is_safe: bool = url_has_allowed_host_and_scheme(url=redirect_to, allowed_hosts={request.get_host()}, require_https=True)
-        next_url: str = redirect_to if url_is_safe else get_url_path(settings.LOGIN_REDIRECT_URL)
+        next_url = self.get_next_url(request, settings.LOGIN_REDIRECT_URL)
 
         try:
-            magiclink = create_magiclink(email=email, domain=str(get_current_site(request).domain), url_name=self.login_verify_url_name, next_url=next_url,
-                                         limit_seconds=self.limit_seconds)
+            self.issue_magiclink(request, email=email, next_url=next_url, user=form.cleaned_data.get('user'))
         except MagicLinkError as e:
             form.add_error('email', str(e))
             context['login_form'] = form
             return self.render_to_response(context)
 
-        send_magiclink(email=email, magiclink=magiclink, subject=self.subject, email_templates=self.email_templates)
-
-        success_url: str = get_url_path(self.next_page)
-
-        if request.META.get("HTTP_HX_REQUEST") != 'true':
-            return HttpResponseRedirect(success_url)
-
-        # htmx request
-        response: HttpResponse = HttpResponse()
-        response.headers['HX-Redirect'] = success_url
-        return response
+        return self.get_success_response(request)
 
 
 class LoginSentView(TemplateView):
@@ -84,7 +107,7 @@ class LoginSentView(TemplateView):
 
 @method_decorator((user_passes_test(lambda u: not u.is_authenticated, login_url='/'), never_cache), name='dispatch')
 class LoginVerifyView(View):
-    expiry_seconds: int = 900
+    expiry_seconds: int = EXPIRY_SECONDS
     error_message: str = 'Token is invalid or expired. Please, try again.'
 
     def get(self, request, *args, **kwargs):
@@ -102,13 +125,13 @@ class LoginVerifyView(View):
         login(request, user)
         logger.info(f'Login successful for {user}')
 
-        next_url: str = signing.loads(signed_token, salt=REGISTRATION_SALT)['next']
+        next_url = get_magiclink_data(user)['next']
 
         return HttpResponseRedirect(next_url)
 
 
 @method_decorator((user_passes_test(lambda u: not u.is_authenticated, login_url='/'), sensitive_post_parameters(), csrf_protect, never_cache), name='dispatch')
-class SignupView(TemplateView):
+class SignupView(IssueMagicLinkMixin, TemplateView):
     form = SignupForm
     limit_seconds: int = 3
     subject: str = 'Your login magic link'
@@ -117,7 +140,7 @@ class SignupView(TemplateView):
     email_templates: tuple[str, str] = ('magiclinks/login_email.txt', 'magiclinks/login_email.html')
     next_page: str = LOGIN_SENT_REDIRECT_URL
 
-    def get(self, request, *args, **kwargs):
+    def get(self, request: HttpRequest, *args: object, **kwargs: object) -> HttpResponse:
         context = self.get_context_data(**kwargs)
         context['signup_form'] = self.form()
         return self.render_to_response(context)
@@ -125,33 +148,21 @@ class SignupView(TemplateView):
     def post(self, request, *args, **kwargs):
         context = self.get_context_data(**kwargs)
 
-        form = self.form(request.POST)
-        if not form.is_valid():
+        form = self.form(request.POST, request=request)
+        with timed('form_validation'):
+            valid = form.is_valid()
+        if not valid:
             context['signup_form'] = form
             return self.render_to_response(context)
 
         email = form.cleaned_data['email']
 
-        module_name, callable_name = CREATE_USER_CALLABLE.split(':')
-        getattr(import_module(module_name), callable_name)(email=email)
-
-        redirect_to: str = request.POST.get('next', request.GET.get('next', ''))
-        url_is_safe: bool = url_has_allowed_host_and_scheme(url=redirect_to, allowed_hosts={request.get_host()}, require_https=True)
-        next_url: str = redirect_to if url_is_safe else get_url_path(SIGNUP_LOGIN_REDIRECT_URL)
-
-        magiclink = create_magiclink(email=email, domain=str(get_current_site(request).domain), url_name=self.login_verify_url_name, next_url=next_url,
-                                     limit_seconds=self.limit_seconds)
-        send_magiclink(email=email, magiclink=magiclink, subject=self.subject, email_templates=self.email_templates)
-
-        success_url: str = get_url_path(self.next_page)
+        user = create_user(email=email)
 
-        if request.META.get("HTTP_HX_REQUEST") != 'true':
-            return HttpResponseRedirect(success_url)
+        next_url = self.get_next_url(request, SIGNUP_LOGIN_REDIRECT_URL)
+        self.issue_magiclink(request, email=email, next_url=next_url, user=user if isinstance(user, User) else None)
 
-        # htmx request
-        response: HttpResponse = HttpResponse()
-        response.headers['HX-Redirect'] = success_url
-        return response
+        return self.get_success_response(request)
 
 
 class LogoutView(View):
@@ -175,3 +186,18 @@ class LogoutView(View):
         response: HttpResponse = HttpResponse()
         response.headers['HX-Redirect'] = next_url
         return response
+
+
+@method_decorator(never_cache, name='dispatch')
+class MetricsView(View):
+    """
+    Expose counters kept by magiclinks.metrics.CacheMetricsSink in the Prometheus text format.
+    Outstanding magiclinks are reported for ModelStorage only, cache entries expire without being counted.
+    """
+    content_type: str = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def get(self, request, *args, **kwargs):
+        sink = get_metrics()
+        if not isinstance(sink, CacheMetricsSink):
+            raise Http404('MAGICLINKS_METRICS_SINK does not keep counters')
+        return HttpResponse(render_prometheus(sink.collect(), outstanding=isinstance(get_storage(), ModelStorage)), content_type=self.content_type)
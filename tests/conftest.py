@@ -0,0 +1,12 @@
+from __future__ import annotations
+
+import pytest
+from django.core.cache import cache
+
+
+@pytest.fixture(autouse=True)
+def clear_cache():
+    # Rate limit counters and cache storage must not leak between tests
+    cache.clear()
+    yield
+    cache.clear()
@@ -4,6 +4,9 @@ import pytest
 from django.contrib.auth import get_user_model
 
 from magiclinks.services import create_magiclink
+from magiclinks.storage import CacheStorage
+
+from .smtp import SMTPSink
 
 User = get_user_model()
 
@@ -20,3 +23,20 @@ def magic_link(user):
         return create_magiclink(email=user.email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=3)
 
     return _create
+
+
+@pytest.fixture()
+def smtp_sink(settings):
+    sink = SMTPSink().start()
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend'
+    settings.EMAIL_HOST = sink.host
+    settings.EMAIL_PORT = sink.port
+    yield sink
+    sink.stop()
+
+
+@pytest.fixture()
+def cache_storage(mocker):
+    storage = CacheStorage()
+    mocker.patch('magiclinks.services.get_storage', return_value=storage)
+    return storage
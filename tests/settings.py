@@ -5,7 +5,7 @@ import os
 SECRET_KEY = 'magiclinks-test'
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
-ALLOWED_HOSTS = '*'
+ALLOWED_HOSTS = ['*']
 
 DATABASES = {
     'default': {
@@ -21,6 +21,7 @@ INSTALLED_APPS = [
     'django.contrib.auth',
     'django.contrib.contenttypes',
     'django.contrib.sessions',
+    'django.contrib.sites',
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'tests',
@@ -73,3 +74,4 @@ MAGICLINKS_LOGIN_SENT_REDIRECT_URL = 'magiclinks:login_sent'
 MAGICLINKS_SIGNUP_LOGIN_REDIRECT_URL = 'no_login'
 MAGICLINKS_REGISTRATION_SALT = 'magiclinks'
 MAGICLINKS_CREATE_USER_CALLABLE = 'tests.settings:create_user'
+SITE_ID = 1
@@ -0,0 +1,108 @@
+from __future__ import annotations
+
+import socket
+import socketserver
+import threading
+import time
+from typing import Callable, Optional
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Speak just enough SMTP for smtplib to deliver messages."""
+
+    def handle(self):
+        sink: SMTPSink = self.server.sink  # type: ignore
+        with sink.lock:
+            sink.connections += 1
+            sink.sockets.append(self.connection)
+        try:
+            self.converse(sink)
+        finally:
+            with sink.lock:
+                if self.connection in sink.sockets:
+                    sink.sockets.remove(self.connection)
+
+    def converse(self, sink: SMTPSink) -> None:
+        self.reply('220 localhost SMTP sink')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('ascii', 'replace').strip().split(' ', 1)[0].upper()
+            if command == 'EHLO':
+                self.reply('250-localhost\r\n250 8BITMIME')
+            elif command in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                self.reply('250 OK')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = []
+                for data_line in self.rfile:
+                    if data_line in (b'.\r\n', b'.\n'):
+                        break
+                    data.append(data_line)
+                if sink.delay:
+                    time.sleep(sink.delay)
+                message = b''.join(data).decode('utf-8', 'replace')
+                with sink.lock:
+                    sink.messages.append(message)
+                if sink.on_message:
+                    sink.on_message(message)
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+    def reply(self, text: str) -> None:
+        self.wfile.write(text.encode('ascii') + b'\r\n')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class SMTPSink:
+    """Local SMTP stand-in which records delivered messages and opened connections."""
+
+    def __init__(self, *, delay: float = 0, port: int = 0, on_message: Optional[Callable[[str], None]] = None) -> None:
+        self.delay = delay
+        self.on_message = on_message
+        self.messages: list[str] = []
+        self.connections = 0
+        self.sockets: list[socket.socket] = []
+        self.lock = threading.Lock()
+        self.server = SMTPServer(('127.0.0.1', port), SMTPHandler)
+        self.server.sink = self  # type: ignore
+        self.host, self.port = self.server.server_address
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05}, daemon=True)
+
+    def start(self) -> SMTPSink:
+        self.thread.start()
+        return self
+
+    def drop_connections(self) -> None:
+        """Close open client connections server side, like a server dropping idle clients."""
+        with self.lock:
+            sockets, self.sockets = self.sockets, []
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                # Closed by its handler in the meantime
+                pass
+
+    def wait_disconnected(self, timeout: float = 5) -> bool:
+        """Wait until every client has closed its connection. Return False on timeout."""
+        deadline = time.monotonic() + timeout
+        while self.sockets:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
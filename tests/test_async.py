@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+from urllib.parse import unquote_plus
+
+import django
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.signals import user_login_failed
+from django.core import mail, signing
+from django.http import HttpRequest
+from django.urls import reverse
+
+from magiclinks.backends import MagicLinksBackend, aauthenticate
+from magiclinks.exceptions import MagicLinkError
+from magiclinks.models import MagicLink, OutboxEmail
+from magiclinks.services import acreate_magiclink, asend_magiclink
+from magiclinks.settings import REGISTRATION_SALT
+
+from .fixtures import cache_storage, magic_link, smtp_sink, user  # NOQA: F401
+
+pytestmark = pytest.mark.skipif(django.VERSION < (5, 0), reason='Async views need Django 5.0')
+
+
+def acreate(email: str = 'test@example.com', next_url: str = '') -> str:
+    return async_to_sync(acreate_magiclink)(email=email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url=next_url,
+                                            limit_seconds=3)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('upsert', [True, False])
+def test_acreate_magiclink(mocker, upsert):
+    mocker.patch('magiclinks.storage.UPSERT', upsert)
+    url = acreate(email='Test@example.com', next_url='/test/')
+    token = unquote_plus(url.split('=')[1])
+    data = signing.loads(token, salt=REGISTRATION_SALT)
+    assert data['next'] == '/test/'
+    assert MagicLink.objects.get(pk=data['pk']).email == 'test@example.com'
+    with pytest.raises(MagicLinkError):
+        acreate()
+
+
+def test_acreate_magiclink_cache_storage(cache_storage):  # NOQA: F811
+    url = acreate()
+    token = unquote_plus(url.split('=')[1])
+    assert async_to_sync(cache_storage.aconsume)(pk=signing.loads(token, salt=REGISTRATION_SALT)['pk']) is True
+    with pytest.raises(MagicLinkError):
+        acreate()
+
+
+@pytest.mark.django_db
+def test_asend_magiclink_smtp(user, smtp_sink):  # NOQA: F811
+    async_to_sync(asend_magiclink)(email=user.email, magiclink='https://127.0.0.1:8000/?token=abc', subject='Your login magic link')
+    assert len(smtp_sink.messages) == 1
+    assert 'token=abc' in smtp_sink.messages[0]
+
+
+@pytest.mark.django_db
+def test_asend_magiclink_locmem(user):  # NOQA: F811
+    async_to_sync(asend_magiclink)(email=user.email, magiclink='https://127.0.0.1:8000/?token=abc', subject='Your login magic link')
+    assert len(mail.outbox) == 1
+
+
+@pytest.mark.django_db
+def test_asend_magiclink_outbox(mocker, user):  # NOQA: F811
+    mocker.patch('magiclinks.services.EMAIL_DISPATCH', 'outbox')
+    async_to_sync(asend_magiclink)(email=user.email, magiclink='https://127.0.0.1:8000/?token=abc', subject='Your login magic link')
+    assert OutboxEmail.objects.get().email == user.email
+
+
+@pytest.mark.django_db
+def test_async_login_end_to_end(client, user):  # NOQA: F811
+    response = client.post(reverse('magiclinks_async:login'), {'email': user.email})
+    assert response.status_code == 302
+    assert response.url == reverse('magiclinks:login_sent')
+    assert response['Cache-Control'] == 'max-age=0, no-cache, no-store, must-revalidate, private'
+
+    verify_url = mail.outbox[0].body.split('\n')[2]
+    response = client.get(verify_url)
+    assert response.url == reverse('needs_login')
+
+    response = client.get(reverse('magiclinks_async:login'))
+    assert response.status_code == 302
+
+
+@pytest.mark.django_db
+def test_async_login_errors(client, user):  # NOQA: F811
+    url = reverse('magiclinks_async:login')
+    assert client.get(url).status_code == 200
+    response = client.post(url, {'email': 'fake@example.com'})
+    assert response.context_data['login_form'].errors['email'] == ['We could not find a user with that email address']
+
+    client.post(url, {'email': user.email})
+    response = client.post(url, {'email': user.email})
+    assert response.context_data['login_form'].errors['email'] == ['Too many magic login requests']
+
+
+@pytest.mark.django_db
+def test_async_login_outbox(mocker, client, user):  # NOQA: F811
+    mocker.patch('magiclinks.async_views.EMAIL_DISPATCH', 'outbox')
+    mocker.patch('magiclinks.views.EMAIL_DISPATCH', 'outbox')
+    mocker.patch('magiclinks.services.EMAIL_DISPATCH', 'outbox')
+    response = client.post(reverse('magiclinks_async:login'), {'email': user.email})
+    assert response.status_code == 302
+    assert OutboxEmail.objects.get().email == user.email
+
+
+@pytest.mark.django_db
+def test_async_login_csrf(user):  # NOQA: F811
+    from django.test import Client
+    client = Client(enforce_csrf_checks=True)
+    response = client.post(reverse('magiclinks_async:login'), {'email': user.email})
+    assert response.status_code == 403
+
+
+@pytest.mark.django_db
+def test_async_signup(client):
+    response = client.post(reverse('magiclinks_async:signup'), {'email': 'new@example.com'})
+    assert response.status_code == 302
+    assert MagicLink.objects.get().email == 'new@example.com'
+    assert mail.outbox[0].to == ['new@example.com']
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aauthenticate_backend(user, magic_link):  # NOQA: F811
+    request = HttpRequest()
+    token = unquote_plus(magic_link(request).split('=')[1])
+    authenticated = async_to_sync(MagicLinksBackend().aauthenticate)(request, token=token)
+    assert authenticated == user
+    assert authenticated.magiclink_data['email'] == user.email
+    assert not MagicLink.objects.exists()
+    assert async_to_sync(MagicLinksBackend().aauthenticate)(request, token=token) is None
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize('token', ['', 'fake', 'fake:token'])
+def test_aauthenticate_backend_invalid(user, token):  # NOQA: F811
+    assert async_to_sync(MagicLinksBackend().aauthenticate)(HttpRequest(), token=token) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aauthenticate_backend_opaque(mocker, user):  # NOQA: F811
+    mocker.patch('magiclinks.services.TOKEN_FORMAT', 'opaque')
+    token = unquote_plus(acreate(email=user.email).split('=')[1])
+    assert async_to_sync(MagicLinksBackend().aauthenticate)(HttpRequest(), token=token, expiry_seconds=60) == user
+    assert async_to_sync(MagicLinksBackend().aauthenticate)(HttpRequest(), token=token, expiry_seconds=60) is None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aauthenticate_skips_sync_path(mocker, user, magic_link):  # NOQA: F811
+    authenticate = mocker.spy(MagicLinksBackend, 'authenticate')
+    token = unquote_plus(magic_link(HttpRequest()).split('=')[1])
+    authenticated = async_to_sync(aauthenticate)(HttpRequest(), token=token)
+    assert authenticated == user
+    assert authenticated.backend == 'magiclinks.backends.MagicLinksBackend'
+    assert authenticate.call_count == 0
+
+
+@pytest.mark.django_db(transaction=True)
+def test_aauthenticate_login_failed_signal(user):  # NOQA: F811
+    received = []
+
+    def receiver(sender, credentials, request, **kwargs):
+        received.append((credentials, request))
+
+    request = HttpRequest()
+    user_login_failed.connect(receiver)
+    try:
+        assert async_to_sync(aauthenticate)(request, token='fake:token') is None
+    finally:
+        user_login_failed.disconnect(receiver)
+    assert received == [({'token': '********************'}, request)]
+
+
+@pytest.mark.django_db(transaction=True)
+def test_async_login_verify(client, user, magic_link):  # NOQA: F811
+    token = magic_link(HttpRequest()).split('=')[1]
+    response = client.get('{url}?token={token}'.format(url=reverse('magiclinks_async:login_verify'), token=token))
+    assert response.status_code == 302
+    assert response.url == reverse('needs_login')
+    assert client.session[SESSION_KEY] == str(user.pk)
+
+    client.logout()
+    response = client.get('{url}?token={token}'.format(url=reverse('magiclinks_async:login_verify'), token=token))
+    assert response.url == reverse('magiclinks:login')
+    assert client.get(reverse('magiclinks_async:login_verify')).url == reverse('magiclinks:login')
@@ -64,3 +64,20 @@ def test_auth_backend_invalid(user, magic_link):  # NOQA: F811
     User.objects.all().delete()
     user = MagicLinksBackend().authenticate(request=request, token=token)
     assert user is None
+
+
+@pytest.mark.django_db
+def test_auth_backend_single_use(user, magic_link):  # NOQA: F811
+    request = HttpRequest()
+    token = unquote_plus(magic_link(request).split('=')[1])
+    assert MagicLinksBackend().authenticate(request=request, token=token)
+    assert MagicLinksBackend().authenticate(request=request, token=token) is None
+
+
+@pytest.mark.django_db
+def test_auth_backend_num_queries(django_assert_num_queries, user, magic_link):  # NOQA: F811
+    request = HttpRequest()
+    token = unquote_plus(magic_link(request).split('=')[1])
+    # SAVEPOINT, DELETE, SELECT user, RELEASE SAVEPOINT
+    with django_assert_num_queries(4):
+        assert MagicLinksBackend().authenticate(request=request, token=token)
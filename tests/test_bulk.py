@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+from io import StringIO
+from urllib.parse import unquote_plus
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import CommandError, call_command
+from django.http import HttpRequest
+from django.test import modify_settings
+from django.utils.dateparse import parse_datetime
+
+from magiclinks.backends import MagicLinksBackend
+from magiclinks.models import MagicLink, OutboxEmail
+from magiclinks.services import bulk_create_magiclinks, bulk_send_magiclinks, create_magiclink, revoke_magiclinks
+from magiclinks.utils import chunked
+
+from .fixtures import cache_storage  # NOQA: F401
+
+User = get_user_model()
+
+
+def create_users(count: int, *, is_active: bool = True) -> list[str]:
+    prefix = 'user' if is_active else 'inactive'
+    emails = ['{prefix}{number}@example.com'.format(prefix=prefix, number=number) for number in range(count)]
+    User.objects.bulk_create([User(username=email, email=email, is_active=is_active) for email in emails])
+    return emails
+
+
+def test_chunked():
+    assert list(chunked(iter(range(5)), 2)) == [[0, 1], [2, 3], [4]]
+    assert list(chunked([], 2)) == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('token_format', ['signed', 'opaque'])
+def test_bulk_create_magiclinks(mocker, token_format):
+    mocker.patch('magiclinks.services.TOKEN_FORMAT', token_format)
+    emails = create_users(3)
+    create_magiclink(email=emails[0], domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=300)
+
+    magiclinks = bulk_create_magiclinks(emails=emails + [emails[1].upper()], domain='127.0.0.1:8000', url_name='magiclinks:login_verify')
+    assert sorted(magiclinks) == emails
+    assert MagicLink.objects.count() == 3
+
+    for email, magiclink in magiclinks.items():
+        assert magiclink.startswith('https://127.0.0.1:8000/accounts/login/verify/?token=')
+        user = MagicLinksBackend().authenticate(HttpRequest(), token=unquote_plus(magiclink.split('=')[1]))
+        assert user.email == email
+        assert user.magiclink_data['next'] == '/needs-login/'
+
+
+@pytest.mark.django_db
+def test_bulk_send_magiclinks(django_assert_num_queries):
+    emails = create_users(5) + create_users(1, is_active=False)
+
+    # Users, savepoint, delete, insert, release per chunk; the last chunk has no users
+    with django_assert_num_queries(5 + 5 + 1):
+        sent = bulk_send_magiclinks(emails=iter([emails[0].upper()] + emails[1:] + ['unknown@example.com']), domain='127.0.0.1:8000', chunk_size=3)
+    assert sent == 5
+    assert sorted(message.to[0] for message in mail.outbox) == emails[:5]
+    assert MagicLink.objects.count() == 5
+    assert all('token=' in message.body for message in mail.outbox)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('bulk', [True, False])
+def test_bulk_send_magiclinks_create_users(mocker, bulk):
+    create_users(1)
+    mocker.patch('magiclinks.services.CREATE_USER_CALLABLE', 'tests.test_bulk:create_user')
+    if bulk:
+        mocker.patch('magiclinks.services.CREATE_USERS_CALLABLE', 'tests.test_bulk:bulk_create_users')
+    CALLS[:] = []
+    emails = ['User0@Example.com', 'new0@example.com', 'new1@example.com', 'New1@example.com']
+    assert bulk_send_magiclinks(emails=emails, domain='127.0.0.1:8000', create_missing_users=True) == 3
+    assert sorted(User.objects.values_list('email', flat=True)) == ['new0@example.com', 'new1@example.com', 'user0@example.com']
+    assert CALLS == ([['new0@example.com', 'new1@example.com']] if bulk else ['new0@example.com', 'new1@example.com'])
+
+
+CALLS: list[object] = []
+
+
+def create_user(*, email: str):
+    CALLS.append(email)
+    return User.objects.create_user(username=email, email=email)
+
+
+def bulk_create_users(*, emails: list[str]) -> None:
+    CALLS.append(emails)
+    User.objects.bulk_create([User(username=email, email=email) for email in emails])
+
+
+@pytest.mark.django_db
+def test_bulk_send_magiclinks_outbox(mocker):
+    mocker.patch('magiclinks.services.EMAIL_DISPATCH', 'outbox')
+    emails = create_users(3)
+    assert bulk_send_magiclinks(emails=emails, domain='127.0.0.1:8000', chunk_size=2) == 3
+    assert sorted(OutboxEmail.objects.values_list('email', flat=True)) == emails
+    assert mail.outbox == []
+
+
+@pytest.mark.django_db
+def test_send_magiclinks_command_file(tmp_path):
+    emails = create_users(3)
+    path = tmp_path / 'emails.txt'
+    path.write_text('\n'.join(emails + ['', 'unknown@example.com']))
+    out = StringIO()
+    call_command('send_magiclinks', '--file={path}'.format(path=path), '--domain=example.com', '--chunk-size=2', stdout=out)
+    assert out.getvalue().startswith('Sent 3 magic links')
+    assert len(mail.outbox) == 3
+    assert 'https://example.com/accounts/login/verify/?token=' in mail.outbox[0].body
+
+
+@pytest.mark.django_db
+def test_send_magiclinks_command_active_users():
+    create_users(2)
+    create_users(1, is_active=False)
+    out = StringIO()
+    call_command('send_magiclinks', '--active-users', '--domain=example.com', stdout=out)
+    assert out.getvalue().startswith('Sent 2 magic links')
+
+
+@modify_settings(INSTALLED_APPS={'remove': 'django.contrib.sites'})
+def test_send_magiclinks_command_requires_domain():
+    with pytest.raises(CommandError):
+        call_command('send_magiclinks', '--active-users')
+
+
+def create_magiclinks(freezer, moment: str, emails: list[str]) -> None:
+    freezer.move_to(moment)
+    MagicLink.objects.bulk_create([MagicLink(email=email) for email in emails])
+
+
+@pytest.mark.django_db
+def test_revoke_magiclinks_emails(django_assert_num_queries):
+    MagicLink.objects.bulk_create([MagicLink(email='user{number}@example.com'.format(number=number)) for number in range(5)])
+    # One DELETE per batch and the final empty one for each E-mail chunk
+    with django_assert_num_queries(4):
+        assert revoke_magiclinks(emails=iter(['USER0@example.com', 'user1@example.com', 'user2@example.com', 'x@example.com']), batch_size=2) == 3
+    assert sorted(MagicLink.objects.values_list('email', flat=True)) == ['user3@example.com', 'user4@example.com']
+
+
+@pytest.mark.django_db
+def test_revoke_magiclinks_criteria(freezer):
+    create_magiclinks(freezer, '2000-01-01T00:00:00', ['a@old.com', 'a@tenant.com'])
+    create_magiclinks(freezer, '2000-01-02T00:00:00', ['b@tenant.com', 'b@other.com', 'inactive0@example.com'])
+    create_users(1, is_active=False)
+
+    assert revoke_magiclinks(users=User.objects.filter(is_active=False)) == 1
+    assert revoke_magiclinks(domain='TENANT.com', created_after=parse_datetime('2000-01-01T12:00:00Z')) == 1
+    assert revoke_magiclinks(created_before=parse_datetime('2000-01-01T12:00:00Z'), batch_size=1) == 2
+    assert list(MagicLink.objects.values_list('email', flat=True)) == ['b@other.com']
+
+    with pytest.raises(ValueError):
+        revoke_magiclinks()
+
+
+@pytest.mark.django_db
+def test_revoke_magiclinks_command(tmp_path):
+    MagicLink.objects.bulk_create([MagicLink(email=email) for email in ('a@example.com', 'b@example.com', 'c@tenant.com')])
+    path = tmp_path / 'emails.txt'
+    path.write_text('a@example.com\nc@tenant.com\n')
+    out = StringIO()
+    call_command('revoke_magiclinks', '--file={path}'.format(path=path), '--domain=example.com', stdout=out)
+    assert out.getvalue().startswith('Revoked 1 magic links')
+
+    with pytest.raises(CommandError):
+        call_command('revoke_magiclinks')
+
+
+@pytest.mark.django_db
+def test_revoke_magiclinks_cache_storage(cache_storage):  # NOQA: F811
+    magiclinks = [create_magiclink(email=email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=0)
+                  for email in create_users(3)]
+    assert revoke_magiclinks(emails=['USER0@example.com', 'user1@example.com', 'x@example.com'], batch_size=2) == 2
+    tokens = [unquote_plus(magiclink.split('=')[1]) for magiclink in magiclinks]
+    assert [bool(MagicLinksBackend().authenticate(HttpRequest(), token=token)) for token in tokens] == [False, False, True]
+
+    with pytest.raises(ImproperlyConfigured):
+        revoke_magiclinks(domain='example.com')
+    with pytest.raises(CommandError):
+        call_command('revoke_magiclinks', '--inactive-users')
@@ -0,0 +1,24 @@
+from __future__ import annotations
+
+from magiclinks.checks import check_create_user_callables, check_metrics_sink
+
+
+def test_check_create_user_callables():
+    assert check_create_user_callables(None) == []
+
+
+def test_check_create_user_callables_errors(mocker):
+    mocker.patch('magiclinks.checks.CREATE_USER_CALLABLE', 'tests.settings.create_user')
+    mocker.patch('magiclinks.checks.CREATE_USERS_CALLABLE', 'tests.settings:create_users')
+    errors = check_create_user_callables(None)
+    assert [error.id for error in errors] == ['magiclinks.E001', 'magiclinks.E001']
+    assert errors[0].msg == 'tests.settings.create_user is not in "module:function" format.'
+    assert errors[1].hint == 'Set MAGICLINKS_CREATE_USERS_CALLABLE to "module:function".'
+
+
+def test_check_metrics_sink(mocker):
+    assert check_metrics_sink(None) == []
+    mocker.patch('magiclinks.checks.METRICS_VIEW', True)
+    assert [error.id for error in check_metrics_sink(None)] == ['magiclinks.E002']
+    mocker.patch('magiclinks.checks.METRICS_SINK', 'magiclinks.metrics.CacheMetricsSink')
+    assert check_metrics_sink(None) == []
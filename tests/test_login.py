@@ -6,6 +6,7 @@ from django.core import mail
 from django.http import HttpRequest
 from django.urls import reverse
 
+from magiclinks.forms import LoginForm
 from magiclinks.models import MagicLink
 
 from .fixtures import magic_link, user  # NOQA: F401
@@ -46,7 +47,6 @@ def test_login_page_get(client):
 
 @pytest.mark.django_db
 def test_login_post(mocker, client, user, settings):  # NOQA: F811
-    send_mail = mocker.patch('magiclinks.services.send_mail')
 
     url = reverse('magiclinks:login')
     data = {'email': user.email}
@@ -58,13 +58,12 @@ def test_login_post(mocker, client, user, settings):  # NOQA: F811
     magiclink = MagicLink.objects.get(email=user.email)
     assert magiclink
 
-    send_mail.assert_called_once_with(
-        subject='Your login magic link',
-        message=mocker.ANY,
-        recipient_list=[user.email],
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        html_message=mocker.ANY,
-    )
+    assert len(mail.outbox) == 1
+    message = mail.outbox[0]
+    assert message.subject == 'Your login magic link'
+    assert message.to == [user.email]
+    assert message.from_email == settings.DEFAULT_FROM_EMAIL
+    assert message.alternatives[0][1] == 'text/html'
 
 
 @pytest.mark.django_db
@@ -123,3 +122,20 @@ def test_login_not_active(settings, client, user):  # NOQA: F811
     assert response.status_code == 200
     error = ['This user has been deactivated']
     assert response.context_data['login_form'].errors['email'] == error
+
+
+@pytest.mark.django_db
+def test_login_post_num_queries(client, user, django_assert_num_queries):  # NOQA: F811
+    url = reverse('magiclinks:login')
+    # User lookup in the form and the magiclink upsert
+    with django_assert_num_queries(2):
+        response = client.post(url, {'email': user.email})
+    assert response.status_code == 302
+    assert len(mail.outbox) == 1
+
+
+@pytest.mark.django_db
+def test_login_form_exposes_user(user):  # NOQA: F811
+    form = LoginForm({'email': user.email.upper()})
+    assert form.is_valid()
+    assert form.cleaned_data['user'] == user
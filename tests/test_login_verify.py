@@ -1,11 +1,16 @@
 from __future__ import annotations
 
+from urllib.parse import unquote_plus
+
 import pytest
 from django.contrib.auth import get_user_model
+from django.core import signing
 from django.http import HttpRequest
 from django.urls import reverse
 
+from magiclinks.backends import MagicLinksBackend
 from magiclinks.services import create_magiclink
+from magiclinks.settings import REGISTRATION_SALT
 
 from .fixtures import magic_link, user  # NOQA: F401
 
@@ -47,3 +52,18 @@ def test_login_verify_failed(client, settings, magic_link):  # NOQA: F811
     messages = list(response.context['messages'])
     assert len(messages) == 1
     assert str(messages[0]) == 'Token is invalid or expired. Please, try again.'  # NOQA: E501
+
+
+@pytest.mark.django_db
+def test_login_verify_decodes_token_once(mocker, client, user, magic_link):  # NOQA: F811
+    loads = mocker.spy(signing, 'loads')
+    response = client.get(magic_link(HttpRequest()))
+    assert response.status_code == 302
+    assert loads.call_count == 1
+
+
+@pytest.mark.django_db
+def test_auth_backend_exposes_token_data(user, magic_link):  # NOQA: F811
+    token = unquote_plus(magic_link(HttpRequest()).split('=')[1])
+    authenticated = MagicLinksBackend().authenticate(request=HttpRequest(), token=token)
+    assert authenticated.magiclink_data == signing.loads(token, salt=REGISTRATION_SALT)
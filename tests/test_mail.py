@@ -0,0 +1,234 @@
+from __future__ import annotations
+
+import smtplib
+import threading
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.core import mail
+
+from magiclinks.mail import (
+    EMAIL_STYLE, AsyncConnectionPool, BackgroundSender, CoalescingSender, ConnectionPool, get_connection_pool, get_email_templates, render_magiclink_email
+)
+from magiclinks.services import send_magiclink
+
+from .fixtures import smtp_sink, user  # NOQA: F401
+
+
+def test_background_sender_flush():
+    sent = []
+    sender = BackgroundSender(queue_size=10, workers=2)
+    for number in range(5):
+        sender.submit(lambda number=number: sent.append(number))
+    sender.flush()
+    assert sorted(sent) == [0, 1, 2, 3, 4]
+    sender.shutdown()
+
+
+def test_background_sender_shutdown_delivers_queued():
+    sent = []
+    sender = BackgroundSender(queue_size=10, workers=1)
+    for number in range(3):
+        sender.submit(lambda number=number: sent.append(number))
+    sender.shutdown(timeout=5)
+    assert sent == [0, 1, 2]
+
+
+@pytest.mark.parametrize('overflow, expected', [('drop', ['queued']), ('inline', ['inline', 'queued'])])
+def test_background_sender_overflow(overflow, expected):
+    sent = []
+    release = threading.Event()
+    started = threading.Event()
+
+    def blocker():
+        started.set()
+        release.wait(5)
+
+    sender = BackgroundSender(queue_size=1, workers=1, overflow=overflow)
+    sender.submit(blocker)
+    started.wait(5)
+    sender.submit(lambda: sent.append('queued'))
+    sender.submit(lambda: sent.append('inline'))
+    release.set()
+    sender.shutdown(timeout=5)
+    assert sent == expected
+
+
+def test_background_sender_survives_errors():
+    sent = []
+    sender = BackgroundSender(queue_size=10, workers=1)
+    sender.submit(lambda: 1 / 0)
+    sender.submit(lambda: sent.append(1))
+    sender.shutdown(timeout=5)
+    assert sent == [1]
+
+
+@pytest.mark.django_db
+def test_send_magiclink_background(mocker, user, smtp_sink):  # NOQA: F811
+    sender = BackgroundSender(queue_size=10, workers=1)
+    mocker.patch('magiclinks.services.EMAIL_DISPATCH', 'background')
+    mocker.patch('magiclinks.services.get_background_sender', return_value=sender)
+
+    send_magiclink(email=user.email, magiclink='https://127.0.0.1:8000/accounts/login/verify/?token=abc', subject='Your login magic link')
+    sender.shutdown(timeout=5)
+
+    assert len(smtp_sink.messages) == 1
+    assert 'token=abc' in smtp_sink.messages[0]
+    assert mail.outbox == []
+
+
+@pytest.mark.django_db
+def test_send_magiclink_reuses_connection(user, smtp_sink):  # NOQA: F811
+    for _ in range(3):
+        send_magiclink(email=user.email, magiclink='https://127.0.0.1:8000/accounts/login/verify/?token=abc', subject='Your login magic link')
+    assert len(smtp_sink.messages) == 3
+    assert smtp_sink.connections == 1
+
+
+def test_connection_pool_size(smtp_sink):  # NOQA: F811
+    pool = ConnectionPool(size=0)
+    for _ in range(2):
+        assert pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])]) == 1
+    assert smtp_sink.connections == 2
+
+
+def test_connection_pool_idle_timeout(freezer, smtp_sink):  # NOQA: F811
+    pool = ConnectionPool(size=1, idle_timeout=30, check_after=60)
+    pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])])
+    freezer.tick(10)
+    pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])])
+    assert smtp_sink.connections == 1
+    freezer.tick(31)
+    pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])])
+    assert smtp_sink.connections == 2
+    pool.close_all()
+
+
+@pytest.mark.parametrize('check_after', [0, 60])
+def test_connection_pool_reconnects(smtp_sink, check_after):  # NOQA: F811
+    # check_after=0 detects the dropped connection with NOOP, 60 only when sending fails
+    pool = ConnectionPool(size=1, check_after=check_after)
+    pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])])
+    smtp_sink.drop_connections()
+    assert pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])]) == 1
+    assert len(smtp_sink.messages) == 2
+    assert smtp_sink.connections == 2
+    pool.close_all()
+
+
+def test_connection_pool_resends_only_current_message(mocker):
+    pool = ConnectionPool(size=1)
+    dropped, fresh = mocker.Mock(), mocker.Mock()
+    dropped.send_messages.side_effect = [1, smtplib.SMTPServerDisconnected]
+    fresh.send_messages.return_value = 1
+    mocker.patch.object(pool, '_checkout', return_value=dropped)
+    mocker.patch.object(pool, '_connect', return_value=fresh)
+    messages = [mail.EmailMessage('s', str(number), 'from@example.com', ['to@example.com']) for number in range(3)]
+    assert pool.send(messages) == 3
+    assert [call.args[0] for call in fresh.send_messages.call_args_list] == [[messages[1]], [messages[2]]]
+
+
+@pytest.mark.parametrize('check_after', [0, 60])
+def test_async_connection_pool(smtp_sink, check_after):  # NOQA: F811
+    pytest.importorskip('aiosmtplib')
+    pool = AsyncConnectionPool(size=1, check_after=check_after)
+
+    async def send(count):
+        for _ in range(count):
+            await pool.send(mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com']))
+
+    async def send_after_drop():
+        await send(1)
+        smtp_sink.drop_connections()
+        await send(1)
+
+    async_to_sync(send)(2)
+    assert smtp_sink.connections == 1
+    # Idle connection is closed with its event loop
+    assert smtp_sink.wait_disconnected()
+    async_to_sync(send_after_drop)()
+    assert len(smtp_sink.messages) == 4
+    assert smtp_sink.connections == 3
+    pool.close_all()
+
+
+def test_connection_pool_closed_on_settings_change(settings, smtp_sink):  # NOQA: F811
+    pool = get_connection_pool()
+    pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])])
+    settings.EMAIL_BACKEND = 'django.core.mail.backends.locmem.EmailBackend'
+    pool.send([mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com'])])
+    assert len(smtp_sink.messages) == 1
+    assert len(mail.outbox) == 1
+
+
+def test_coalescing_sender_batches(smtp_sink):  # NOQA: F811
+    sender = CoalescingSender(max_batch=4, max_latency=1)
+    for number in range(10):
+        sender.submit_message(mail.EmailMessage('s', str(number), 'from@example.com', ['to@example.com']))
+    sender.flush()
+    assert len(smtp_sink.messages) == 10
+    assert sender.stats() == {'batches': 3, 'messages': 10, 'batch_sizes': {2: 1, 4: 2}}
+    sender.shutdown(timeout=5)
+
+
+def test_coalescing_sender_max_latency(smtp_sink):  # NOQA: F811
+    sender = CoalescingSender(max_batch=100, max_latency=0.01)
+    sender.submit_message(mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com']))
+    sender.flush()
+    assert len(smtp_sink.messages) == 1
+    assert sender.stats()['batch_sizes'] == {1: 1}
+    sender.shutdown(timeout=5)
+
+
+def test_coalescing_sender_shutdown_delivers_queued(smtp_sink):  # NOQA: F811
+    sender = CoalescingSender(max_batch=100, max_latency=60)
+    for _ in range(3):
+        sender.submit_message(mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com']))
+    sender.shutdown(timeout=5)
+    assert len(smtp_sink.messages) == 3
+    assert sender.stats()['batches'] == 1
+
+
+def test_coalescing_sender_survives_errors(mocker):
+    pool = mocker.patch('magiclinks.mail.get_connection_pool').return_value
+    pool.send.side_effect = [ConnectionRefusedError, 1]
+    sender = CoalescingSender(max_batch=1, max_latency=0)
+    sender.submit_message(mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com']))
+    sender.submit_message(mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com']))
+    sender.shutdown(timeout=5)
+    assert pool.send.call_count == 2
+
+
+@pytest.mark.django_db
+def test_send_magiclink_coalesce(mocker, user, smtp_sink):  # NOQA: F811
+    sender = CoalescingSender(max_batch=10, max_latency=0.01)
+    mocker.patch('magiclinks.services.EMAIL_DISPATCH', 'coalesce')
+    mocker.patch('magiclinks.services.get_coalescing_sender', return_value=sender)
+
+    send_magiclink(email=user.email, magiclink='https://127.0.0.1:8000/accounts/login/verify/?token=abc', subject='Your login magic link')
+    sender.shutdown(timeout=5)
+
+    assert len(smtp_sink.messages) == 1
+    assert mail.outbox == []
+
+
+def test_get_email_templates_cached(settings):
+    templates = ('magiclinks/login_email.txt', 'magiclinks/login_email.html')
+    assert get_email_templates(templates) is get_email_templates(templates)
+    cached = get_email_templates(templates)
+    settings.TEMPLATES = settings.TEMPLATES + []
+    assert get_email_templates(templates) is not cached
+
+
+@pytest.mark.django_db
+def test_render_magiclink_email(settings, user):  # NOQA: F811
+    magiclink = 'https://127.0.0.1:8000/accounts/login/verify/?token=abc'
+    message = render_magiclink_email(email=user.email, user=user, magiclink=magiclink, subject='Your login magic link',
+                                     email_templates=('magiclinks/login_email.txt', 'magiclinks/login_email.html'))
+    assert message.to == [user.email]
+    assert message.from_email == settings.DEFAULT_FROM_EMAIL
+    assert magiclink in message.body
+    html, mimetype = message.alternatives[0]
+    assert mimetype == 'text/html'
+    assert magiclink in html
+    assert EMAIL_STYLE['button_background_color'] in html
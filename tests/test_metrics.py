@@ -0,0 +1,166 @@
+from __future__ import annotations
+
+from collections import Counter
+from contextlib import nullcontext
+from io import StringIO
+from urllib.parse import unquote_plus
+
+import pytest
+from django.contrib.auth import get_user_model
+from django.core import mail
+from django.core.management import call_command
+from django.http import Http404, HttpRequest
+from django.test import RequestFactory
+from django.urls import reverse
+
+from magiclinks import metrics
+from magiclinks.backends import MagicLinksBackend
+from magiclinks.models import MagicLink
+from magiclinks.services import create_magiclink, purge_magiclinks
+from magiclinks.settings import EXPIRY_SECONDS
+from magiclinks.views import MetricsView
+
+from .fixtures import magic_link, user  # NOQA: F401
+
+User = get_user_model()
+
+
+class RecordingSink(metrics.MetricsSink):
+    enabled = True
+
+    def __init__(self) -> None:
+        self.counters: Counter[tuple[str, tuple[tuple[str, str], ...]]] = Counter()
+        self.observed: list[tuple[str, dict[str, str]]] = []
+
+    def increment(self, name: str, value: int = 1, **labels: str) -> None:
+        self.counters[name, tuple(sorted(labels.items()))] += value
+
+    def observe(self, name: str, seconds: float, **labels: str) -> None:
+        assert seconds >= 0
+        self.observed.append((name, labels))
+
+    def stages(self) -> set[str]:
+        return {labels['stage'] for name, labels in self.observed if name == 'stage_seconds'}
+
+
+@pytest.fixture()
+def sink(mocker):
+    sink = RecordingSink()
+    mocker.patch('magiclinks.metrics.get_metrics', return_value=sink)
+    return sink
+
+
+def test_disabled_by_default():
+    assert type(metrics.get_metrics()) is metrics.MetricsSink
+    assert isinstance(metrics.timed('create_link'), nullcontext)
+
+
+@pytest.mark.django_db
+def test_login_metrics(client, sink, user):  # NOQA: F811
+    url = reverse('magiclinks:login')
+    assert client.post(url, {'email': user.email}).status_code == 302
+    assert sink.counters == {('issued', ()): 1, ('links_created', ()): 1}
+    assert sink.stages() == {'validate_email', 'ratelimit', 'user_lookup', 'form_validation', 'create_link', 'sign_token', 'render_email'}
+    assert ('send_seconds', {}) in sink.observed
+
+    # The link of the first request is too recent to be replaced
+    client.post(url, {'email': user.email})
+    assert sink.counters[('throttled', (('scope', 'link'),))] == 1
+
+    token = unquote_plus(mail.outbox[0].body.split('token=')[1].split()[0])
+    assert MagicLinksBackend().authenticate(HttpRequest(), token=token)
+    assert sink.counters[('consumed', ())] == 1
+    assert {'decode_token', 'consume', 'fetch_user'} <= sink.stages()
+
+
+@pytest.mark.django_db
+def test_verify_failed_reasons(sink, user, magic_link):  # NOQA: F811
+    backend = MagicLinksBackend()
+    token = unquote_plus(magic_link(HttpRequest()).split('=')[1])
+    assert backend.authenticate(HttpRequest(), token=token, expiry_seconds=-1) is None
+    assert backend.authenticate(HttpRequest(), token=token + 'x') is None
+    assert backend.authenticate(HttpRequest(), token=token)
+    assert backend.authenticate(HttpRequest(), token=token) is None
+    assert backend.authenticate(HttpRequest(), token='x' * 22) is None
+
+    link = create_magiclink(email='unknown@example.com', domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=0)
+    assert backend.authenticate(HttpRequest(), token=unquote_plus(link.split('=')[1])) is None
+    User.objects.filter(pk=user.pk).update(is_active=False)
+    assert backend.authenticate(HttpRequest(), token=unquote_plus(magic_link(HttpRequest()).split('=')[1])) is None
+
+    failed = {dict(labels)['reason']: count for (name, labels), count in sink.counters.items() if name == 'verify_failed'}
+    assert failed == {'expired': 1, 'bad_signature': 1, 'already_used': 1, 'not_found': 1, 'unknown_user': 1, 'inactive_user': 1}
+    assert sink.counters[('consumed', ())] == 3
+
+
+@pytest.mark.django_db
+def test_throttled_scope(client, sink, mocker):
+    mocker.patch('magiclinks.ratelimit.RATELIMITS', {'ip': (1, 60)})
+    url = reverse('magiclinks:login')
+    client.post(url, {'email': 'a@example.com'})
+    client.post(url, {'email': 'b@example.com'})
+    assert sink.counters[('throttled', (('scope', 'ip'),))] == 1
+
+
+@pytest.fixture()
+def cache_sink(mocker):
+    sink = metrics.CacheMetricsSink()
+    sink.cache.clear()
+    mocker.patch('magiclinks.metrics.get_metrics', return_value=sink)
+    mocker.patch('magiclinks.storage.get_metrics', return_value=sink)
+    mocker.patch('magiclinks.views.get_metrics', return_value=sink)
+    yield sink
+    sink.cache.clear()
+
+
+@pytest.mark.django_db
+def test_metrics_view(client, cache_sink, user, freezer):  # NOQA: F811
+    url = reverse('magiclinks:login')
+    client.post(url, {'email': user.email})
+    freezer.tick(10)
+    client.post(url, {'email': user.email})
+    create_magiclink(email='other@example.com', domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=0)
+    token = unquote_plus(mail.outbox[-1].body.split('token=')[1].split()[0])
+    assert MagicLinksBackend().authenticate(HttpRequest(), token=token)
+    assert MagicLinksBackend().authenticate(HttpRequest(), token=token) is None
+
+    response = MetricsView.as_view()(RequestFactory().get('/metrics/'))
+    assert response['Content-Type'] == 'text/plain; version=0.0.4; charset=utf-8'
+    body = response.content.decode()
+    assert '# TYPE magiclinks_issued_total counter\nmagiclinks_issued_total 3\n' in body
+    assert 'magiclinks_consumed_total 1\n' in body
+    assert 'magiclinks_verify_failed_total{reason="already_used"} 1\n' in body
+    assert 'magiclinks_throttled_total{scope="link"} 0\n' in body
+    # The second login replaced the first link, the third link is consumed
+    assert body.endswith('magiclinks_outstanding 1\n')
+    assert MagicLink.objects.count() == 1
+
+    freezer.tick(EXPIRY_SECONDS + 1)
+    assert purge_magiclinks(expiry_seconds=EXPIRY_SECONDS) == 1
+    assert metrics.render_prometheus(cache_sink.collect()).endswith('magiclinks_outstanding 0\n')
+
+
+@pytest.mark.django_db
+def test_upsert_counts_replaced_links(cache_sink, freezer, django_assert_num_queries):
+    for email in ['a@example.com', 'b@example.com', 'a@example.com', 'b@example.com', 'b@example.com']:
+        freezer.tick(10)
+        with django_assert_num_queries(1):
+            create_magiclink(email=email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=3)
+    assert cache_sink.collect()['links_created', ''] == 5
+    assert cache_sink.collect()['links_removed', ''] == 3
+    assert MagicLink.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_metrics_view_requires_cache_sink():
+    with pytest.raises(Http404):
+        MetricsView.as_view()(RequestFactory().get('/metrics/'))
+
+
+@pytest.mark.django_db
+def test_sync_magiclinks_metrics_command(cache_sink):
+    MagicLink.objects.bulk_create([MagicLink(email='{n}@example.com'.format(n=n)) for n in range(3)])
+    out = StringIO()
+    call_command('sync_magiclinks_metrics', stdout=out)
+    assert out.getvalue() == 'Outstanding magic links: 3\n'
+    assert cache_sink.collect()['links_created', ''] == 3
@@ -0,0 +1,114 @@
+from __future__ import annotations
+
+from datetime import timedelta
+from io import StringIO
+
+import pytest
+from django.core import mail
+from django.core.management import call_command
+from django.urls import reverse
+from django.utils import timezone
+
+from magiclinks.models import MagicLink, OutboxEmail
+from magiclinks.services import claim_outbox_emails, send_magiclink, send_outbox_emails
+
+from .fixtures import smtp_sink, user  # NOQA: F401
+
+
+@pytest.mark.django_db
+def test_send_magiclink_outbox(mocker, user):  # NOQA: F811
+    mocker.patch('magiclinks.services.EMAIL_DISPATCH', 'outbox')
+    send_magiclink(email=user.email, magiclink='https://127.0.0.1:8000/?token=abc', subject='Your login magic link')
+    assert mail.outbox == []
+    item = OutboxEmail.objects.get()
+    assert item.email == user.email
+    assert 'token=abc' in item.message
+    assert 'token=abc' in item.html_message
+
+
+@pytest.mark.django_db
+def test_login_outbox_same_transaction(mocker, client, user):  # NOQA: F811
+    mocker.patch('magiclinks.services.EMAIL_DISPATCH', 'outbox')
+    mocker.patch('magiclinks.views.EMAIL_DISPATCH', 'outbox')
+    mocker.patch('magiclinks.services.OutboxEmail.objects.create', side_effect=RuntimeError)
+    with pytest.raises(RuntimeError):
+        client.post(reverse('magiclinks:login'), {'email': user.email})
+    assert not MagicLink.objects.exists()
+
+
+@pytest.mark.django_db
+def test_claim_outbox_emails_lease():
+    for number in range(3):
+        OutboxEmail.objects.create(email='test{number}@example.com'.format(number=number), from_email='from@example.com', subject='s', message='m')
+    first = claim_outbox_emails(batch_size=2, lease_seconds=60, max_attempts=5)
+    second = claim_outbox_emails(batch_size=2, lease_seconds=60, max_attempts=5)
+    assert len(first) == 2
+    assert len(second) == 1
+    assert not {item.pk for item in first} & {item.pk for item in second}
+    assert claim_outbox_emails(batch_size=2, lease_seconds=60, max_attempts=5) == []
+
+    OutboxEmail.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+    assert len(claim_outbox_emails(batch_size=10, lease_seconds=60, max_attempts=2)) == 3
+    OutboxEmail.objects.update(locked_until=timezone.now() - timedelta(seconds=1))
+    assert claim_outbox_emails(batch_size=10, lease_seconds=60, max_attempts=2) == []
+
+
+@pytest.mark.django_db
+def test_send_outbox_emails(smtp_sink):  # NOQA: F811
+    for number in range(5):
+        OutboxEmail.objects.create(email='test{number}@example.com'.format(number=number), from_email='from@example.com', subject='s', message='m',
+                                   html_message='<p>m</p>')
+    assert send_outbox_emails(batch_size=3) == 3
+    assert send_outbox_emails(batch_size=3) == 2
+    assert send_outbox_emails(batch_size=3) == 0
+    assert len(smtp_sink.messages) == 5
+    # Batches share the pooled connection
+    assert smtp_sink.connections == 1
+    assert not OutboxEmail.objects.exists()
+
+
+@pytest.mark.django_db
+def test_send_outbox_emails_failure_keeps_lease(mocker):
+    OutboxEmail.objects.create(email='test@example.com', from_email='from@example.com', subject='s', message='m')
+    mocker.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError)
+    with pytest.raises(OSError):
+        send_outbox_emails()
+    item = OutboxEmail.objects.get()
+    assert item.attempts == 1
+    assert item.locked_until > timezone.now()
+
+
+@pytest.mark.django_db
+def test_send_outbox_emails_partial_failure(mocker):
+    for number in range(3):
+        OutboxEmail.objects.create(email='test{number}@example.com'.format(number=number), from_email='from@example.com', subject='s', message='m')
+    send_messages = mocker.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=[1, OSError, 1])
+    with pytest.raises(OSError):
+        send_outbox_emails()
+    # Only the delivered e-mail is gone, the rest is retried after the lease
+    delivered = send_messages.call_args_list[0].args[0][0].to[0]
+    assert OutboxEmail.objects.count() == 2
+    assert not OutboxEmail.objects.filter(email=delivered).exists()
+
+
+@pytest.mark.django_db
+def test_send_outbox_emails_discards_exhausted(caplog):
+    exhausted = OutboxEmail.objects.create(email='exhausted@example.com', from_email='from@example.com', subject='s', message='m', attempts=2)
+    OutboxEmail.objects.create(email='leased@example.com', from_email='from@example.com', subject='s', message='m', attempts=2,
+                               locked_until=timezone.now() + timedelta(seconds=60))
+    OutboxEmail.objects.create(email='pending@example.com', from_email='from@example.com', subject='s', message='m', attempts=1)
+    assert send_outbox_emails(max_attempts=2) == 1
+    assert [message.to for message in mail.outbox] == [['pending@example.com']]
+    assert list(OutboxEmail.objects.values_list('email', flat=True)) == ['leased@example.com']
+    assert 'Giving up on 1 outbox e-mails after 2 attempts: {pk}'.format(pk=exhausted.pk) in caplog.text
+    assert 'exhausted@example.com' not in caplog.text
+
+
+@pytest.mark.django_db
+def test_send_magiclink_outbox_command():
+    for number in range(3):
+        OutboxEmail.objects.create(email='test{number}@example.com'.format(number=number), from_email='from@example.com', subject='s', message='m')
+    out = StringIO()
+    call_command('send_magiclink_outbox', '--batch-size=2', stdout=out)
+    assert 'Sent 3 e-mails' in out.getvalue()
+    assert len(mail.outbox) == 3
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from io import StringIO
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+
+from magiclinks.models import MagicLink
+from magiclinks.services import purge_magiclinks
+
+
+def create_magiclinks(freezer, moment: str, count: int) -> None:
+    freezer.move_to(moment)
+    for number in range(count):
+        MagicLink.objects.create(email='{moment}-{number}@example.com'.format(moment=moment[11:16].replace(':', ''), number=number))
+
+
+@pytest.mark.django_db
+def test_purge_magiclinks(freezer):
+    create_magiclinks(freezer, '2000-01-01T00:00:00', 5)
+    create_magiclinks(freezer, '2000-01-01T00:10:00', 2)
+    freezer.move_to('2000-01-01T00:16:00')
+    assert purge_magiclinks(expiry_seconds=900, batch_size=2) == 5
+    assert MagicLink.objects.count() == 2
+    assert purge_magiclinks(expiry_seconds=900, batch_size=2) == 0
+
+
+@pytest.mark.django_db
+def test_purge_magiclinks_batches(freezer, django_assert_num_queries):
+    create_magiclinks(freezer, '2000-01-01T00:00:00', 5)
+    freezer.move_to('2000-01-01T01:00:00')
+    # Three batch DELETEs with a LIMIT subquery and the final empty one
+    with django_assert_num_queries(4):
+        assert purge_magiclinks(expiry_seconds=900, batch_size=2) == 5
+
+
+@pytest.mark.django_db
+def test_purge_magiclinks_batches_mysql(freezer, mocker, django_assert_num_queries):
+    mocker.patch.object(connection, 'vendor', 'mysql')
+    create_magiclinks(freezer, '2000-01-01T00:00:00', 5)
+    freezer.move_to('2000-01-01T01:00:00')
+    # Every batch selects its pks first, the final empty batch deletes nothing
+    with django_assert_num_queries(7):
+        assert purge_magiclinks(expiry_seconds=900, batch_size=2) == 5
+    assert not MagicLink.objects.exists()
+
+
+@pytest.mark.django_db
+def test_purge_magiclinks_command(freezer):
+    create_magiclinks(freezer, '2000-01-01T00:00:00', 3)
+    freezer.move_to('2000-01-01T01:00:00')
+    out = StringIO()
+    call_command('purge_magiclinks', '--batch-size=2', stdout=out)
+    assert out.getvalue().startswith('Deleted 3 magic links')
+    assert not MagicLink.objects.exists()
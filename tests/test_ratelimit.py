@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+import pytest
+from django.http import HttpRequest
+from django.urls import reverse
+
+from magiclinks.models import MagicLink
+from magiclinks.ratelimit import SlidingWindowRateLimiter, get_client_ip, is_ratelimited
+
+from .fixtures import user  # NOQA: F401
+
+
+def make_request(ip: str = '127.0.0.1') -> HttpRequest:
+    request = HttpRequest()
+    request.META['REMOTE_ADDR'] = ip
+    return request
+
+
+def test_sliding_window(freezer):
+    freezer.move_to('2000-01-01T00:00:00')
+    limiter = SlidingWindowRateLimiter()
+    assert limiter.hit('key', limit=2, period=10)
+    assert limiter.hit('key', limit=2, period=10)
+    assert not limiter.hit('key', limit=2, period=10)
+
+    # Half of the previous window still counts
+    freezer.move_to('2000-01-01T00:00:15')
+    assert not limiter.hit('key', limit=2, period=10)
+
+    freezer.move_to('2000-01-01T00:00:29')
+    assert limiter.hit('key', limit=2, period=10)
+
+
+def test_email_key_hashed(mocker):
+    mocker.patch('magiclinks.ratelimit.RATELIMITS', {'email': (1, 60)})
+    hit = mocker.spy(SlidingWindowRateLimiter, 'hit')
+    email = '{local}@example.com'.format(local='a' * 300)
+    assert not is_ratelimited(None, email=email)
+    assert is_ratelimited(None, email=email)
+    key = hit.call_args.args[1]
+    assert email not in key
+    assert len(key) < 100
+
+
+def test_get_client_ip(mocker):
+    request = make_request()
+    assert get_client_ip(request) == '127.0.0.1'
+    mocker.patch('magiclinks.ratelimit.RATELIMIT_IP_META', 'HTTP_X_FORWARDED_FOR')
+    request.META['HTTP_X_FORWARDED_FOR'] = '10.0.0.1'
+    assert get_client_ip(request) == '10.0.0.1'
+    # Entries before the one appended by the proxy come from the client
+    request.META['HTTP_X_FORWARDED_FOR'] = '10.0.0.2, 10.0.0.1'
+    assert get_client_ip(request) == '10.0.0.1'
+
+
+def test_is_ratelimited_scopes(mocker):
+    mocker.patch('magiclinks.ratelimit.RATELIMITS', {'email': (1, 60), 'ip': (2, 60)})
+    assert not is_ratelimited(make_request(), email='first@example.com')
+    assert is_ratelimited(make_request(), email='first@example.com')
+    # Per IP quota is spent by the two requests above
+    assert is_ratelimited(make_request(), email='second@example.com')
+    assert not is_ratelimited(make_request('10.0.0.1'), email='second@example.com')
+
+
+def test_is_ratelimited_global(mocker):
+    mocker.patch('magiclinks.ratelimit.RATELIMITS', {'global': (1, 60)})
+    assert not is_ratelimited(make_request(), email='first@example.com')
+    assert is_ratelimited(make_request('10.0.0.1'), email='second@example.com')
+
+
+@pytest.mark.django_db
+def test_login_ratelimited_without_queries(mocker, client, user, django_assert_num_queries):  # NOQA: F811
+    mocker.patch('magiclinks.ratelimit.RATELIMITS', {'email': (1, 60)})
+    url = reverse('magiclinks:login')
+    response = client.post(url, {'email': user.email})
+    assert response.status_code == 302
+    MagicLink.objects.all().delete()
+
+    with django_assert_num_queries(0):
+        response = client.post(url, {'email': user.email})
+    assert response.status_code == 200
+    assert response.context_data['login_form'].errors['email'] == ['Too many magic login requests']
+
+
+@pytest.mark.django_db
+def test_signup_ratelimited(mocker, client):
+    mocker.patch('magiclinks.ratelimit.RATELIMITS', {'ip': (1, 60)})
+    url = reverse('magiclinks:signup')
+    assert client.post(url, {'email': 'first@example.com'}).status_code == 302
+    response = client.post(url, {'email': 'second@example.com'})
+    assert response.status_code == 200
+    assert response.context_data['signup_form'].errors['email'] == ['Too many magic login requests']
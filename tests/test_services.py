@@ -4,7 +4,8 @@ from urllib.parse import unquote_plus
 
 import pytest
 from django.contrib.auth import get_user_model
-from django.core import signing
+from django.core import mail, signing
+from django.db import IntegrityError
 from django.http import HttpRequest
 from django.urls import reverse
 
@@ -51,9 +52,6 @@ def test_create_magiclink_next_url(settings):
 
 @pytest.mark.django_db
 def test_send_email(mocker, settings, user, magic_link):  # NOQA: F811
-    send_mail = mocker.patch('magiclinks.services.send_mail')
-    # render_to_string = mocker.patch('magiclinks.services.render_to_string')
-
     request = HttpRequest()
     request.META['SERVER_NAME'] = '127.0.0.1'
     request.META['SERVER_PORT'] = 80
@@ -71,10 +69,54 @@ def test_send_email(mocker, settings, user, magic_link):  # NOQA: F811
     #     mocker.call('magiclinks/login_email.txt', context),
     #     mocker.call('magiclinks/login_email.html', context),
     # ])
-    send_mail.assert_called_once_with(
-        subject='Your login magic link',
-        message=mocker.ANY,
-        recipient_list=[user.email],
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        html_message=mocker.ANY,
-    )
+    assert len(mail.outbox) == 1
+    message = mail.outbox[0]
+    assert message.subject == 'Your login magic link'
+    assert message.to == [user.email]
+    assert message.from_email == settings.DEFAULT_FROM_EMAIL
+    assert message.alternatives[0][1] == 'text/html'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('upsert', [True, False])
+def test_create_magiclink_replaces_old(mocker, freezer, upsert):
+    mocker.patch('magiclinks.storage.UPSERT', upsert)
+    freezer.move_to('2000-01-01T00:00:00')
+    email = 'test@example.com'
+    create_magiclink(email=email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=3)
+    old = MagicLink.objects.get(email=email)
+    with pytest.raises(MagicLinkError):
+        create_magiclink(email=email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=3)
+
+    freezer.move_to('2000-01-01T00:00:04')
+    magic_link = create_magiclink(email=email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=3)  # NOQA: F811
+    token = unquote_plus(magic_link.split('=')[1])
+    new = MagicLink.objects.get(email=email)
+    assert new.pk != old.pk
+    assert str(new.pk) == signing.loads(token, salt=REGISTRATION_SALT)['pk']
+    assert new.date_created > old.date_created
+
+
+@pytest.mark.django_db
+def test_create_magiclink_upsert_num_queries(django_assert_num_queries):
+    with django_assert_num_queries(1):
+        create_magiclink(email='test@example.com', domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=3)
+
+
+@pytest.mark.django_db
+def test_create_magiclink_concurrent_insert(mocker):
+    mocker.patch('magiclinks.storage.UPSERT', False)
+    mocker.patch('magiclinks.storage.MagicLink.save', side_effect=IntegrityError)
+    with pytest.raises(MagicLinkError):
+        create_magiclink(email='test@example.com', domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url='', limit_seconds=3)
+
+
+@pytest.mark.django_db
+def test_send_email_with_user(user, django_assert_num_queries):  # NOQA: F811
+    with django_assert_num_queries(0):
+        send_magiclink(email=user.email, magiclink='https://127.0.0.1:8000/?token=abc', subject='Your login magic link', user=user)
+    assert len(mail.outbox) == 1
+
+    user.is_active = False
+    send_magiclink(email=user.email, magiclink='https://127.0.0.1:8000/?token=abc', subject='Your login magic link', user=user)
+    assert len(mail.outbox) == 1
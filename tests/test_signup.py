@@ -47,7 +47,6 @@ def test_signup_get(client):
 
 @pytest.mark.django_db
 def test_signup_post(mocker, client, settings):  # NOQA: F811
-    send_mail = mocker.patch('magiclinks.services.send_mail')
 
     url = reverse('magiclinks:signup')
     email = 'test@example.com'
@@ -64,13 +63,12 @@ def test_signup_post(mocker, client, settings):  # NOQA: F811
     magiclink = MagicLink.objects.get(email=email)
     assert magiclink
 
-    send_mail.assert_called_once_with(
-        subject='Your login magic link',
-        message=mocker.ANY,
-        recipient_list=[email],
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        html_message=mocker.ANY,
-    )
+    assert len(mail.outbox) == 1
+    message = mail.outbox[0]
+    assert message.subject == 'Your login magic link'
+    assert message.to == [email]
+    assert message.from_email == settings.DEFAULT_FROM_EMAIL
+    assert message.alternatives[0][1] == 'text/html'
 
 
 @pytest.mark.django_db
@@ -0,0 +1,85 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.contrib.sites.models import Site
+from django.test import RequestFactory, modify_settings
+
+from magiclinks import utils
+from magiclinks.sites import SITE_DOMAINS, aget_site_domain, clear_site_domains, get_site_domain
+from magiclinks.utils import get_verify_url
+
+
+@pytest.fixture()
+def current_site(mocker):
+    SITE_DOMAINS.clear()
+    yield mocker.patch('magiclinks.sites.get_current_site', side_effect=lambda request: SimpleNamespace(domain='site-{host}'.format(host=request.get_host())))
+    SITE_DOMAINS.clear()
+
+
+def test_get_site_domain_cached(settings, current_site):
+    settings.ALLOWED_HOSTS = ['a.example.com', 'b.example.com']
+    settings.SITE_ID = None
+    factory = RequestFactory()
+    assert get_site_domain(factory.get('/', HTTP_HOST='a.example.com')) == 'site-a.example.com'
+    assert get_site_domain(factory.get('/', HTTP_HOST='a.example.com')) == 'site-a.example.com'
+    assert async_to_sync(aget_site_domain)(factory.get('/', HTTP_HOST='b.example.com')) == 'site-b.example.com'
+    assert async_to_sync(aget_site_domain)(factory.get('/', HTTP_HOST='b.example.com')) == 'site-b.example.com'
+    assert current_site.call_count == 2
+
+    # Site saved or deleted
+    clear_site_domains()
+    get_site_domain(factory.get('/', HTTP_HOST='a.example.com'))
+    assert current_site.call_count == 3
+
+
+def test_get_site_domain_bounded(mocker, settings, current_site):
+    factory = RequestFactory()
+    # With SITE_ID every host has the same Site
+    for port in range(3):
+        assert get_site_domain(factory.get('/', HTTP_HOST='a.example.com:{port}'.format(port=port))) == 'site-a.example.com:0'
+    assert list(SITE_DOMAINS) == ['id:1']
+
+    settings.SITE_ID = None
+    mocker.patch('magiclinks.sites.SITE_DOMAINS_SIZE', 3)
+    for port in range(5):
+        get_site_domain(factory.get('/', HTTP_HOST='a.example.com:{port}'.format(port=port)))
+    assert len(SITE_DOMAINS) == 3
+
+
+@pytest.mark.django_db
+def test_get_site_domain_cleared_on_site_change():
+    SITE_DOMAINS.clear()
+    request = RequestFactory().get('/')
+    assert get_site_domain(request) == 'example.com'
+    Site.objects.filter(pk=1).update(domain='stale.example.com')
+    assert get_site_domain(request) == 'example.com'
+
+    site = Site.objects.get(pk=1)
+    site.domain = 'new.example.com'
+    site.save()
+    assert get_site_domain(request) == 'new.example.com'
+    Site.objects.create(domain='other.example.com', name='other')
+    assert SITE_DOMAINS == {}
+    SITE_DOMAINS.clear()
+
+
+def test_get_site_domain_without_sites():
+    with modify_settings(INSTALLED_APPS={'remove': 'django.contrib.sites'}):
+        assert get_site_domain(RequestFactory().get('/')) == 'testserver'
+        assert async_to_sync(aget_site_domain)(RequestFactory().get('/', HTTP_HOST='other.example.com')) == 'other.example.com'
+    assert SITE_DOMAINS == {}
+
+
+def test_get_verify_url_cached(mocker, settings):
+    utils._build_verify_url.cache_clear()
+    reverse = mocker.spy(utils, 'reverse')
+    for _ in range(2):
+        assert get_verify_url(domain='example.com', url_name='magiclinks:login_verify') == 'https://example.com/accounts/login/verify/'
+    assert reverse.call_count == 1
+    assert get_verify_url(domain='example.org', url_name='magiclinks:login') == 'https://example.org/accounts/login/'
+
+    settings.ROOT_URLCONF = 'tests.urls'
+    assert utils._build_verify_url.cache_info().currsize == 0
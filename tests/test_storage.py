@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+from urllib.parse import unquote_plus
+
+import pytest
+from django.core import mail
+from django.http import HttpRequest
+from django.urls import reverse
+
+from magiclinks.backends import MagicLinksBackend
+from magiclinks.exceptions import MagicLinkError
+from magiclinks.models import MagicLink
+from magiclinks.storage import CacheStorage, ModelStorage, get_storage
+
+from .fixtures import cache_storage, magic_link, user  # NOQA: F401
+
+
+def test_get_storage():
+    assert isinstance(get_storage(), ModelStorage)
+
+
+def test_cache_storage_create(cache_storage):  # NOQA: F811
+    pk = cache_storage.create(email='test@example.com', limit_seconds=3)
+    with pytest.raises(MagicLinkError):
+        cache_storage.create(email='test@example.com', limit_seconds=3)
+    assert cache_storage.consume(pk=pk) is True
+    assert cache_storage.consume(pk=pk) is False
+
+
+def test_cache_storage_replaces_old(cache_storage):  # NOQA: F811
+    old_pk = cache_storage.create(email='test@example.com', limit_seconds=0)
+    new_pk = cache_storage.create(email='test@example.com', limit_seconds=0)
+    assert old_pk != new_pk
+    assert cache_storage.consume(pk=old_pk) is False
+    assert cache_storage.consume(pk=new_pk) is True
+
+
+def test_cache_storage_delete(cache_storage):  # NOQA: F811
+    first = cache_storage.create(email='first@example.com', limit_seconds=0)
+    second = cache_storage.create(email='second@example.com', limit_seconds=0)
+    cache_storage.delete(pk=first)
+    cache_storage.delete(email='second@example.com')
+    assert cache_storage.consume(pk=first) is False
+    assert cache_storage.consume(pk=second) is False
+
+
+def test_cache_storage_long_email(cache_storage, mocker):  # NOQA: F811
+    email = '{local}@example.com'.format(local='a' * 300)
+    set_many = mocker.spy(cache_storage.cache, 'set_many')
+    first = cache_storage.create(email=email, limit_seconds=3)
+    assert all(email not in key and len(key) < 100 for key in set_many.call_args.args[0])
+    with pytest.raises(MagicLinkError):
+        cache_storage.create(email=email, limit_seconds=3)
+    cache_storage.delete(email=email)
+    assert cache_storage.consume(pk=first) is False
+
+
+def test_cache_storage_expiry(cache_storage, freezer):  # NOQA: F811
+    storage = CacheStorage(timeout=60)
+    pk = storage.create(email='test@example.com', limit_seconds=0)
+    freezer.tick(61)
+    assert storage.consume(pk=pk) is False
+
+
+@pytest.mark.django_db
+def test_cache_storage_backend(user, cache_storage, magic_link):  # NOQA: F811
+    request = HttpRequest()
+    token = unquote_plus(magic_link(request).split('=')[1])
+    assert not MagicLink.objects.exists()
+    assert MagicLinksBackend().authenticate(request=request, token=token)
+    assert MagicLinksBackend().authenticate(request=request, token=token) is None
+
+
+@pytest.mark.django_db
+def test_cache_storage_login_end_to_end(client, user, cache_storage):  # NOQA: F811
+    client.post(reverse('magiclinks:login'), {'email': user.email})
+    verify_url = mail.outbox[0].body.split('\n')[2]
+    response = client.get(verify_url)
+    assert response.status_code == 302
+    assert response.url == reverse('needs_login')
+    assert not MagicLink.objects.exists()
@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from urllib.parse import unquote_plus
+
+import pytest
+from django.http import HttpRequest
+from django.urls import reverse
+
+from magiclinks.backends import MagicLinksBackend
+from magiclinks.models import MagicLink
+from magiclinks.services import create_magiclink
+from magiclinks.utils import hash_token
+
+from .fixtures import cache_storage, user  # NOQA: F401
+
+
+@pytest.fixture()
+def opaque_link(mocker, user):  # NOQA: F811
+    mocker.patch('magiclinks.services.TOKEN_FORMAT', 'opaque')
+
+    def _create(next_url: str = '') -> str:
+        return create_magiclink(email=user.email, domain='127.0.0.1:8000', url_name='magiclinks:login_verify', next_url=next_url, limit_seconds=3)
+
+    return _create
+
+
+@pytest.mark.django_db
+def test_create_opaque_magiclink(opaque_link):
+    url = opaque_link('/test/')
+    token = unquote_plus(url.split('=')[1])
+    assert len(token) == 22
+    assert len(url) < 80
+    magiclink = MagicLink.objects.get()
+    assert magiclink.token_hash == hash_token(token)
+    assert magiclink.next_url == '/test/'
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('delete_returning', [True, False])
+def test_auth_backend_opaque(mocker, user, opaque_link, delete_returning):  # NOQA: F811
+    mocker.patch('magiclinks.storage.ModelStorage._supports_delete_returning', return_value=delete_returning)
+    token = unquote_plus(opaque_link('/test/').split('=')[1])
+    authenticated = MagicLinksBackend().authenticate(request=HttpRequest(), token=token)
+    assert authenticated == user
+    assert authenticated.magiclink_data['next'] == '/test/'
+    assert authenticated.magiclink_data['email'] == user.email
+    assert not MagicLink.objects.exists()
+    assert MagicLinksBackend().authenticate(request=HttpRequest(), token=token) is None
+
+
+@pytest.mark.django_db
+def test_auth_backend_opaque_num_queries(django_assert_num_queries, user, opaque_link):  # NOQA: F811
+    token = unquote_plus(opaque_link().split('=')[1])
+    # SAVEPOINT, DELETE ... RETURNING, SELECT user, RELEASE SAVEPOINT
+    with django_assert_num_queries(4):
+        assert MagicLinksBackend().authenticate(request=HttpRequest(), token=token)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('token', ['garbage', 'x' * 21, 'x' * 21 + '!'])
+def test_auth_backend_junk_token_num_queries(django_assert_num_queries, token):
+    with django_assert_num_queries(0):
+        assert MagicLinksBackend().authenticate(request=HttpRequest(), token=token) is None
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('delete_returning', [True, False])
+def test_auth_backend_opaque_expired(mocker, user, opaque_link, delete_returning):  # NOQA: F811
+    mocker.patch('magiclinks.storage.ModelStorage._supports_delete_returning', return_value=delete_returning)
+    token = unquote_plus(opaque_link().split('=')[1])
+    assert MagicLinksBackend().authenticate(request=HttpRequest(), token=token, expiry_seconds=-1) is None
+
+
+@pytest.mark.django_db
+def test_auth_backend_opaque_cache_storage(freezer, user, cache_storage, opaque_link):  # NOQA: F811
+    token = unquote_plus(opaque_link('/test/').split('=')[1])
+    authenticated = MagicLinksBackend().authenticate(request=HttpRequest(), token=token)
+    assert authenticated.magiclink_data['next'] == '/test/'
+    assert MagicLinksBackend().authenticate(request=HttpRequest(), token=token) is None
+
+    freezer.tick(4)
+    token = unquote_plus(opaque_link().split('=')[1])
+    freezer.tick(61)
+    assert MagicLinksBackend().authenticate(request=HttpRequest(), token=token, expiry_seconds=60) is None
+
+
+@pytest.mark.django_db
+def test_login_verify_opaque(client, user, opaque_link):  # NOQA: F811
+    response = client.get(opaque_link(reverse('no_login')))
+    assert response.status_code == 302
+    assert response.url == reverse('no_login')
@@ -0,0 +1,86 @@
+from __future__ import annotations
+
+from contextlib import nullcontext
+
+import pytest
+from django.core import mail
+from django.urls import reverse
+
+from magiclinks import tracing
+from magiclinks.mail import BackgroundSender, CoalescingSender
+
+from .fixtures import smtp_sink, user  # NOQA: F401
+
+
+def test_disabled_by_default():
+    assert type(tracing.get_tracer()) is tracing.Tracer
+    assert isinstance(tracing.get_tracer().span('magiclinks.consume'), nullcontext)
+    job = object
+    assert tracing.propagate(job) is job
+
+
+@pytest.fixture()
+def spans(mocker):
+    sdk_trace = pytest.importorskip('opentelemetry.sdk.trace')
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    exporter = InMemorySpanExporter()
+    provider = sdk_trace.TracerProvider()
+    provider.add_span_processor(SimpleSpanProcessor(exporter))
+    tracer = tracing.OpenTelemetryTracer()
+    tracer.tracer = provider.get_tracer('magiclinks')
+    for module in ('tracing', 'metrics', 'mail'):
+        mocker.patch('magiclinks.{module}.get_tracer'.format(module=module), return_value=tracer)
+    return exporter
+
+
+@pytest.mark.django_db
+def test_login_and_verify_spans(client, spans, user):  # NOQA: F811
+    client.post(reverse('magiclinks:login'), {'email': user.email})
+    assert [span.name for span in spans.get_finished_spans()] == [
+        'magiclinks.validate_email', 'magiclinks.ratelimit', 'magiclinks.user_lookup', 'magiclinks.form_validation',
+        'magiclinks.create_link', 'magiclinks.sign_token', 'magiclinks.render_email', 'magiclinks.smtp_send']
+    spans.clear()
+
+    client.get(mail.outbox[0].body.split('\n')[2])
+    assert [span.name for span in spans.get_finished_spans()] == ['magiclinks.decode_token', 'magiclinks.consume', 'magiclinks.fetch_user']
+
+
+def test_background_sender_continues_trace(spans):
+    tracer = tracing.get_tracer()
+
+    def send():
+        with tracer.span('magiclinks.smtp_send'):
+            pass
+
+    sender = BackgroundSender(queue_size=10, workers=1)
+    with tracer.span('request'):
+        sender.submit(send)
+    sender.shutdown(timeout=5)
+
+    finished = {span.name: span for span in spans.get_finished_spans()}
+    request = finished['request'].context
+    for name in ('magiclinks.email_queued', 'magiclinks.smtp_send'):
+        assert finished[name].context.trace_id == request.trace_id
+        assert finished[name].parent.span_id == request.span_id
+    assert finished['magiclinks.email_queued'].end_time >= finished['magiclinks.email_queued'].start_time
+
+
+def test_coalescing_sender_links_traces(spans, smtp_sink):  # NOQA: F811
+    tracer = tracing.get_tracer()
+    sender = CoalescingSender(max_batch=2, max_latency=1)
+    for name in ('first', 'second'):
+        with tracer.span(name):
+            sender.submit_message(mail.EmailMessage('s', 'm', 'from@example.com', ['to@example.com']))
+    sender.shutdown(timeout=5)
+
+    finished = spans.get_finished_spans()
+    requests = [span.context for span in finished if span.name in ('first', 'second')]
+    queued = [span for span in finished if span.name == 'magiclinks.email_queued']
+    assert sorted(span.parent.span_id for span in queued) == sorted(context.span_id for context in requests)
+    batch = next(span for span in finished if span.name == 'magiclinks.send_batch')
+    assert sorted(link.context.span_id for link in batch.links) == sorted(context.span_id for context in requests)
+    assert batch.attributes['batch_size'] == 2
+    send = next(span for span in finished if span.name == 'magiclinks.smtp_send')
+    assert send.parent.span_id == batch.context.span_id
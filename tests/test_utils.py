@@ -1,8 +1,15 @@
 from __future__ import annotations
 
+from datetime import datetime, timezone
 from uuid import UUID
 
-from magiclinks.utils import generate_timeflake, get_url_path
+import pytest
+from django.core.exceptions import ImproperlyConfigured
+from django.urls import set_script_prefix
+from django.utils import translation
+
+from magiclinks import utils
+from magiclinks.utils import generate_timeflake, get_url_path, get_verify_url, load_callable, timeflake_floor
 
 
 def test_generate_timeflake():
@@ -20,3 +27,49 @@ def test_get_url_path_with_path():
     url_name = '/test/'
     url = get_url_path(url_name)
     assert url == '/test/'
+
+
+def test_get_url_path_cached(mocker, settings):
+    utils._resolve_url_path.cache_clear()
+    reverse = mocker.spy(utils, 'reverse')
+    assert get_url_path('no_login') == '/no-login/'
+    assert get_url_path('no_login') == '/no-login/'
+    assert get_url_path('/test/') == '/test/'
+    assert get_url_path('/test/') == '/test/'
+    assert reverse.call_count == 2
+
+    # Script prefix is part of the key
+    set_script_prefix('/app/')
+    try:
+        assert get_url_path('no_login') == '/app/no-login/'
+    finally:
+        set_script_prefix('/')
+
+    settings.ROOT_URLCONF = 'magiclinks.urls'
+    assert get_url_path('no_login') == 'no_login'
+
+
+def test_get_url_path_cached_per_language(settings):
+    # Changing ROOT_URLCONF clears the caches
+    settings.ROOT_URLCONF = 'tests.urls_i18n'
+    for language in ('en', 'de', 'en'):
+        with translation.override(language):
+            assert get_url_path('dash') == '/{language}/dash/'.format(language=language)
+            assert get_verify_url(domain='example.com', url_name='dash') == 'https://example.com/{language}/dash/'.format(language=language)
+
+
+def test_load_callable():
+    from tests.settings import create_user
+    assert load_callable('tests.settings:create_user') is create_user
+    for path in ('tests.settings.create_user', 'tests.missing:create_user', 'tests.settings:missing', 'tests.settings:LOGIN_URL'):
+        with pytest.raises(ImproperlyConfigured):
+            load_callable(path)
+
+
+def test_timeflake_floor(freezer):
+    freezer.move_to('2000-01-01T00:00:00')
+    before = generate_timeflake()
+    freezer.move_to('2000-01-01T00:00:01')
+    floor = timeflake_floor(datetime(2000, 1, 1, 0, 0, 1, tzinfo=timezone.utc))
+    after = generate_timeflake()
+    assert before < floor <= after
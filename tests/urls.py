@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import django
 from django.contrib.auth.decorators import login_required
 from django.http.response import HttpResponse
 from django.urls import include, path
@@ -19,3 +20,7 @@ urlpatterns = [
     path('needs-login/', needs_login, name='needs_login'),
     path('accounts/', include('magiclinks.urls', namespace='magiclinks')),
 ]
+
+# Async views need Django 5.0 (alogin, request.auser)
+if django.VERSION >= (5, 0):
+    urlpatterns.append(path('async-accounts/', include('magiclinks.async_urls', namespace='magiclinks_async')))
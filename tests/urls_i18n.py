@@ -0,0 +1,10 @@
+from __future__ import annotations
+
+from django.conf.urls.i18n import i18n_patterns
+from django.urls import path
+
+from .urls import no_login
+
+urlpatterns = i18n_patterns(
+    path('dash/', no_login, name='dash'),
+)